@@ -0,0 +1,141 @@
+"""
+Microbenchmark for the conversion of volume buffers into texture chunks.
+
+This times prepare_chunks for synthetic float32 volumes of increasing size,
+with and without NaN values, for each texture precision, and compares it
+with the previous implementation, which converted each chunk with several
+passes over memory and temporary arrays. The throughput is given in
+millions of voxels per second.
+
+The largest volumes need a lot of memory (16 GB for 1024^3 voxels), so the
+sizes can be chosen with e.g.::
+
+    python volume_chunks.py --sizes 128 256 512
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from glue.utils import iterate_chunks
+
+from glue_vispy_viewers.volume import pipeline
+from glue_vispy_viewers.volume.volume_visual import (TEXTURE_PRECISIONS, data_range,
+                                                     prepare_chunks)
+
+
+class ArrayProxy(object):
+
+    def __init__(self, array):
+        self.array = array
+
+    def compute_fixed_resolution_buffer(self, bounds):
+        return self.array
+
+
+def quantize(values, vrange, precision):
+    dtype = np.dtype(TEXTURE_PRECISIONS[precision][1])
+    maxval = np.iinfo(dtype).max if dtype.kind == 'u' else 1.
+    if vrange[1] > vrange[0]:
+        factor = maxval / (vrange[1] - vrange[0])
+    else:
+        factor = 0.
+    values = (values - np.float32(vrange[0])) * np.float32(factor)
+    if dtype.kind == 'u':
+        values += 0.5
+        np.clip(values, 0, maxval, out=values)
+    return values.astype(dtype, copy=False)
+
+
+def previous_prepare_chunks(array, precision):
+    """
+    The conversion of the buffer into chunks before it was done in blocks.
+    """
+
+    vrange = None if precision == 'float32' else data_range(array)
+
+    chunks = []
+    has_nan = False
+
+    for view in iterate_chunks(array.shape, chunk_shape=[min(x, 128) for x in array.shape]):
+        chunk = array[view].astype(np.float32)
+        invalid = np.isnan(chunk)
+        if invalid.any():
+            chunk[invalid] = 0. if vrange is None else vrange[0]
+            has_nan = True
+        else:
+            invalid = None
+        if vrange is not None:
+            chunk = quantize(chunk, vrange, precision)
+        chunks.append((view, chunk, invalid))
+
+    for ichunk, (view, chunk, invalid) in enumerate(chunks):
+        if has_nan:
+            valid = quantize(np.ones(chunk.shape, dtype=np.float32), (0, 1), precision)
+            if invalid is not None:
+                valid[invalid] = 0
+            chunk = np.stack([chunk, valid], axis=-1)
+        chunks[ichunk] = (view, chunk)
+
+    return chunks
+
+
+def current_prepare_chunks(array, precision):
+    n = array.shape[0]
+    shape, chunks, has_nan, vrange, cells = prepare_chunks(None, ArrayProxy(array),
+                                                           [(0, n - 1, n)] * 3, n,
+                                                           precision=precision)
+    # The chunks are computed as they are consumed
+    for offset, chunk in chunks:
+        pass
+
+
+def best_time(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512, 1024])
+    parser.add_argument('--precisions', nargs='+', default=list(TEXTURE_PRECISIONS),
+                        choices=list(TEXTURE_PRECISIONS))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('Processing chunks with {0} thread(s)'.format(pipeline.CHUNK_WORKERS))
+    print('{0:>6s} {1:>9s} {2:>5s} {3:>10s} {4:>10s} {5:>10s} {6:>8s}'.format(
+        'size', 'precision', 'nan', 'previous', 'current', 'Mvoxel/s', 'speedup'))
+
+    rng = np.random.RandomState(0)
+
+    for n in args.sizes:
+
+        array = rng.random_sample((n, n, n)).astype(np.float32)
+
+        for with_nan in (False, True):
+
+            if with_nan:
+                array[tuple(rng.randint(0, n, (3, n)))] = np.nan
+
+            for precision in args.precisions:
+
+                previous = best_time(lambda: previous_prepare_chunks(array, precision),
+                                     args.repeat)
+                current = best_time(lambda: current_prepare_chunks(array, precision),
+                                    args.repeat)
+
+                print('{0:>6d} {1:>9s} {2:>5s} {3:>7.1f} ms {4:>7.1f} ms {5:>10.0f} '
+                      '{6:>7.2f}x'.format(n, precision, str(with_nan), previous * 1000,
+                                          current * 1000, array.size / current / 1e6,
+                                          previous / current))
+
+
+if __name__ == "__main__":
+    main()
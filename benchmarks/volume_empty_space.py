@@ -0,0 +1,133 @@
+"""
+Benchmark for empty space skipping in the volume renderer.
+
+This renders sparse synthetic volumes (and a dense volume for comparison)
+with and without empty space skipping and reports the time per frame, as
+well as the maximum difference between the images, which should be at most
+a few levels due to rounding.
+
+To benchmark software rendering (e.g. Mesa's llvmpipe) without a display,
+run with e.g.::
+
+    EGL_PLATFORM=surfaceless LIBGL_ALWAYS_SOFTWARE=1 python volume_empty_space.py --app egl
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+import vispy
+from vispy import scene
+
+from glue.config import LinearStretch
+
+from glue_vispy_viewers.common.vispy_widget import NestedSTTransform
+from glue_vispy_viewers.volume.colors import get_translucent_cmap
+from glue_vispy_viewers.volume.volume_visual import MultiVolume
+
+
+class ArrayProxy(object):
+
+    def __init__(self, array):
+        self.array = array
+
+    def compute_fixed_resolution_buffer(self, bounds):
+        return self.array
+
+
+def blobs(n, count, radius, seed=0):
+    """
+    A volume with a few small Gaussian blobs, similar to a sparse astronomy
+    cube.
+    """
+    rng = np.random.RandomState(seed)
+    array = np.zeros((n, n, n), dtype=np.float32)
+    z, y, x = np.indices((2 * radius + 1,) * 3) - radius
+    blob = np.exp(-(x ** 2 + y ** 2 + z ** 2) / (radius / 2) ** 2)
+    for center in rng.randint(radius, n - radius - 1, (count, 3)):
+        view = tuple(slice(c - radius, c + radius + 1) for c in center)
+        array[view] = np.maximum(array[view], blob)
+    return array
+
+
+def shell(n, width):
+    """
+    A thin spherical shell, similar to a subset selected on a threshold.
+    """
+    z, y, x = np.indices((n, n, n)) - (n - 1) / 2
+    r = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+    return (np.abs(r - n / 3) < width / 2).astype(np.float32)
+
+
+def render_time(canvas, frames):
+    canvas.render()
+    start = time.perf_counter()
+    for i in range(frames):
+        image = canvas.render()
+    return (time.perf_counter() - start) / frames, image
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--app', default=None, help='the VisPy application backend')
+    parser.add_argument('--resolution', type=int, default=128)
+    parser.add_argument('--size', type=int, default=400, help='the canvas size in pixels')
+    parser.add_argument('--frames', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.app is not None:
+        vispy.use(app=args.app)
+
+    n = args.resolution
+
+    volumes = {'dense': np.random.random((n, n, n)).astype(np.float32),
+               'blobs': blobs(n, count=10, radius=n // 16),
+               'shell': shell(n, width=3)}
+
+    canvas = scene.SceneCanvas(show=False, size=(args.size, args.size), bgcolor='white')
+    view = canvas.central_widget.add_view()
+    view.camera = scene.cameras.TurntableCamera(fov=0., distance=4., azimuth=30, elevation=20)
+
+    print(canvas.context.shared.parser.capabilities.get('gl_renderer', ''))
+    print('{0:>8s} {1:>9s} {2:>12s} {3:>12s} {4:>8s} {5:>10s}'.format(
+        'volume', 'occupied', 'no skipping', 'skipping', 'speedup', 'max diff'))
+
+    for name, array in volumes.items():
+
+        visual = MultiVolume(bgcolor='white', resolution=n)
+        visual.transform = NestedSTTransform()
+        view.add(visual)
+
+        visual.allocate(name)
+        visual.set_cmap(name, get_translucent_cmap(1, 0, 0, LinearStretch()))
+        visual.set_clim(name, (0.1, 1))
+        visual.set_data(name, ArrayProxy(array))
+        visual.set_weight(name, 1)
+        visual.enable(name)
+        visual._update_slice_transform(-0.5, n - 0.5, -0.5, n - 0.5, -0.5, n - 0.5)
+
+        scale = 2. / n
+        visual.transform.scale = [scale] * 3
+        visual.transform.translate = [-(n - 1) / 2 * scale] * 3
+
+        visual.set_skip_empty(False)
+        time_full, image_full = render_time(canvas, args.frames)
+
+        visual.set_skip_empty(True)
+        time_skip, image_skip = render_time(canvas, args.frames)
+
+        # The images can differ very slightly due to rounding when jumping
+        # over several steps at once.
+        difference = np.abs(image_full.astype(int) - image_skip.astype(int)).max()
+
+        print('{0:>8s} {1:>8.1f}% {2:>9.1f} ms {3:>9.1f} ms {4:>7.2f}x {5:>10d}'.format(
+            name, visual._occupied_cells().mean() * 100, time_full * 1000, time_skip * 1000,
+            time_full / time_skip, difference))
+
+        visual.parent = None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Benchmark for packing several volume layers into the channels of shared
+textures.
+
+This renders one to four synthetic layers at full resolution with and without
+packing, and reports the time per frame. When the layers are packed, the
+shader samples a single texture per step for up to four layers rather than
+one texture per layer.
+
+To benchmark software rendering (e.g. Mesa's llvmpipe) without a display,
+run with e.g.::
+
+    EGL_PLATFORM=surfaceless LIBGL_ALWAYS_SOFTWARE=1 python volume_packing.py --app egl
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+import vispy
+from vispy import scene
+
+from glue.config import LinearStretch
+
+from glue_vispy_viewers.common.vispy_widget import NestedSTTransform
+from glue_vispy_viewers.volume.colors import get_translucent_cmap
+from glue_vispy_viewers.volume.volume_visual import MultiVolume, TEXTURE_PRECISIONS
+
+COLORS = [(1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 0)]
+
+
+class ArrayProxy(object):
+
+    def __init__(self, array):
+        self.array = array
+
+    def compute_fixed_resolution_buffer(self, bounds):
+        return self.array
+
+
+def render_time(canvas, frames):
+    canvas.render()
+    start = time.perf_counter()
+    for i in range(frames):
+        canvas.render()
+    return (time.perf_counter() - start) / frames
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--app', default=None, help='the VisPy application backend')
+    parser.add_argument('--resolution', type=int, default=128)
+    parser.add_argument('--size', type=int, default=400, help='the canvas size in pixels')
+    parser.add_argument('--frames', type=int, default=5)
+    parser.add_argument('--precision', default='float32', choices=list(TEXTURE_PRECISIONS))
+    args = parser.parse_args()
+
+    if args.app is not None:
+        vispy.use(app=args.app)
+
+    n = args.resolution
+
+    rng = np.random.RandomState(0)
+    arrays = [rng.random_sample((n, n, n)).astype(np.float32) for color in COLORS]
+
+    canvas = scene.SceneCanvas(show=False, size=(args.size, args.size), bgcolor='white')
+    view = canvas.central_widget.add_view()
+    view.camera = scene.cameras.TurntableCamera(fov=0., distance=4., azimuth=30, elevation=20)
+
+    print(canvas.context.shared.parser.capabilities.get('gl_renderer', ''))
+    print('{0:>8s} {1:>10s} {2:>10s} {3:>8s}'.format('layers', 'separate', 'packed', 'speedup'))
+
+    for n_layers in range(1, len(arrays) + 1):
+
+        results = {}
+
+        for packed in (False, True):
+
+            visual = MultiVolume(bgcolor='white', resolution=n, packed=packed)
+            visual.transform = NestedSTTransform()
+            view.add(visual)
+
+            for i in range(n_layers):
+                label = 'layer{0}'.format(i)
+                visual.allocate(label)
+                visual.set_cmap(label, get_translucent_cmap(*COLORS[i], LinearStretch()))
+                visual.set_clim(label, (0, 1))
+                visual.set_precision(label, args.precision)
+                visual.set_data(label, ArrayProxy(arrays[i]))
+                visual.set_weight(label, 1)
+                visual.enable(label)
+            visual.set_skip_empty(False)
+            visual._update_slice_transform(-0.5, n - 0.5, -0.5, n - 0.5, -0.5, n - 0.5)
+
+            scale = 2. / n
+            visual.transform.scale = [scale] * 3
+            visual.transform.translate = [-(n - 1) / 2 * scale] * 3
+
+            results[packed] = render_time(canvas, args.frames)
+
+            visual.parent = None
+
+        print('{0:>8d} {1:>7.1f} ms {2:>7.1f} ms {3:>7.2f}x'.format(
+            n_layers, results[False] * 1000, results[True] * 1000,
+            results[False] / results[True]))
+
+
+if __name__ == "__main__":
+    main()
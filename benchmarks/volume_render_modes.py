@@ -0,0 +1,162 @@
+"""
+Benchmark for the maximum intensity and compositing render modes.
+
+This renders synthetic volumes, most of which are opaque, with each render
+mode and reports the time per frame as well as the mean number of samples
+taken along the rays that hit the volume. With compositing, the rays stop
+once they are opaque, so fewer samples are needed for opaque volumes.
+
+To benchmark software rendering (e.g. Mesa's llvmpipe) without a display,
+run with e.g.::
+
+    EGL_PLATFORM=surfaceless LIBGL_ALWAYS_SOFTWARE=1 python volume_render_modes.py --app egl
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+import vispy
+from vispy import scene
+
+from glue.config import LinearStretch
+
+from glue_vispy_viewers.common.vispy_widget import NestedSTTransform
+from glue_vispy_viewers.volume import volume_visual
+from glue_vispy_viewers.volume.colors import get_translucent_cmap
+from glue_vispy_viewers.volume.volume_visual import MultiVolume
+
+
+class ArrayProxy(object):
+
+    def __init__(self, array):
+        self.array = array
+
+    def compute_fixed_resolution_buffer(self, bounds):
+        return self.array
+
+
+def ball(n, radius):
+    """
+    A solid ball, similar to a subset selected on a threshold.
+    """
+    z, y, x = np.indices((n, n, n)) - (n - 1) / 2
+    return (np.sqrt(x ** 2 + y ** 2 + z ** 2) < radius).astype(np.float32)
+
+
+def blobs(n, count, radius, seed=0):
+    """
+    A volume with a few small Gaussian blobs, most of which is transparent.
+    """
+    rng = np.random.RandomState(seed)
+    array = np.zeros((n, n, n), dtype=np.float32)
+    z, y, x = np.indices((2 * radius + 1,) * 3) - radius
+    blob = np.exp(-(x ** 2 + y ** 2 + z ** 2) / (radius / 2) ** 2)
+    for center in rng.randint(radius, n - radius - 1, (count, 3)):
+        view = tuple(slice(c - radius, c + radius + 1) for c in center)
+        array[view] = np.maximum(array[view], blob)
+    return array
+
+
+def count_samples(get_frag_shader):
+    """
+    Wrap get_frag_shader so that the shader outputs the number of samples
+    taken along each ray instead of the color, as a 16-bit integer stored in
+    the red and green channels, with the blue channel set to indicate that
+    the ray hit the volume.
+    """
+    def wrapper(*args, **kwargs):
+        shader = get_frag_shader(*args, **kwargs)
+        shader = shader.replace("int iter = 0;", "int iter = 0;\n    int samples = 0;")
+        shader = shader.replace("// Advance location deeper into the volume",
+                                "samples++;")
+        shader = shader.replace("gl_FragColor = total_color;",
+                                "gl_FragColor = vec4(mod(float(samples), 256.) / 255., "
+                                "floor(float(samples) / 256.) / 255., 1., 1.);")
+        return shader
+    return wrapper
+
+
+def render_time(canvas, frames):
+    canvas.render()
+    start = time.perf_counter()
+    for i in range(frames):
+        canvas.render()
+    return (time.perf_counter() - start) / frames
+
+
+def samples_per_pixel(canvas, visual):
+    get_frag_shader = volume_visual.get_frag_shader
+    volume_visual.get_frag_shader = count_samples(get_frag_shader)
+    try:
+        visual._update_shader()
+        image = canvas.render(bgcolor=(0, 0, 0, 0)).astype(int)
+    finally:
+        volume_visual.get_frag_shader = get_frag_shader
+        visual._update_shader()
+    hit = image[..., 2] > 0
+    return (image[..., 0] + 256 * image[..., 1])[hit].mean()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--app', default=None, help='the VisPy application backend')
+    parser.add_argument('--resolution', type=int, default=128)
+    parser.add_argument('--size', type=int, default=400, help='the canvas size in pixels')
+    parser.add_argument('--frames', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.app is not None:
+        vispy.use(app=args.app)
+
+    n = args.resolution
+
+    volumes = {'dense': np.random.random((n, n, n)).astype(np.float32),
+               'ball': ball(n, radius=n / 3),
+               'blobs': blobs(n, count=10, radius=n // 16)}
+
+    canvas = scene.SceneCanvas(show=False, size=(args.size, args.size), bgcolor='white')
+    view = canvas.central_widget.add_view()
+    view.camera = scene.cameras.TurntableCamera(fov=0., distance=4., azimuth=30, elevation=20)
+
+    print(canvas.context.shared.parser.capabilities.get('gl_renderer', ''))
+    print('{0:>8s} {1:>10s} {2:>10s} {3:>10s} {4:>10s} {5:>8s}'.format(
+        'volume', 'max', 'composite', 'max', 'composite', 'speedup'))
+    print('{0:>8s} {1:>21s} {2:>21s}'.format('', 'samples per pixel', 'time per frame'))
+
+    for name, array in volumes.items():
+
+        visual = MultiVolume(bgcolor='white', resolution=n)
+        visual.transform = NestedSTTransform()
+        view.add(visual)
+
+        visual.allocate(name)
+        visual.set_cmap(name, get_translucent_cmap(1, 0, 0, LinearStretch()))
+        visual.set_clim(name, (0, 1))
+        visual.set_data(name, ArrayProxy(array))
+        visual.set_weight(name, 1)
+        visual.enable(name)
+        visual._update_slice_transform(-0.5, n - 0.5, -0.5, n - 0.5, -0.5, n - 0.5)
+
+        scale = 2. / n
+        visual.transform.scale = [scale] * 3
+        visual.transform.translate = [-(n - 1) / 2 * scale] * 3
+
+        results = {}
+        for render_mode in ('max', 'composite'):
+            visual.set_render_mode(render_mode)
+            results[render_mode] = (samples_per_pixel(canvas, visual),
+                                    render_time(canvas, args.frames))
+
+        print('{0:>8s} {1:>10.1f} {2:>10.1f} {3:>7.1f} ms {4:>7.1f} ms {5:>7.2f}x'.format(
+            name, results['max'][0], results['composite'][0],
+            results['max'][1] * 1000, results['composite'][1] * 1000,
+            results['max'][1] / results['composite'][1]))
+
+        visual.parent = None
+
+
+if __name__ == "__main__":
+    main()
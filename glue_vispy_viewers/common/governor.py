@@ -0,0 +1,87 @@
+import numpy as np
+
+__all__ = ['FrameTimeGovernor']
+
+
+class FrameTimeGovernor(object):
+    """
+    Choose the level of detail to use while the user is interacting with a
+    viewer so that frames take about ``target`` seconds to draw.
+
+    The level is a factor by which the work needed to draw a frame is reduced,
+    with 1 meaning full quality. It is assumed that the time taken to draw a
+    frame is inversely proportional to the level, and the level is adjusted
+    after each frame based on a moving average of the recent frame times.
+    Between interactions, the last level is remembered so that the next
+    interaction starts from it.
+    """
+
+    def __init__(self, target=1 / 20, tolerance=1.25, smoothing=0.5):
+        self.target = target
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.active = False
+        self.level = 1.
+        self.max_level = 1.
+        self._initial_level = 1.
+        self._frame_time = None
+
+    def start(self, max_level):
+        """
+        Start an interaction, during which the level can go up to
+        ``max_level``. If an interaction is already in progress, only the
+        maximum level is updated. Returns whether the level has changed.
+        """
+        self.max_level = max(1., max_level)
+        if self.active:
+            return self._set_level(self.level)
+        self.active = True
+        self._frame_time = None
+        return self._set_level(self._initial_level)
+
+    def stop(self):
+        """
+        Stop an interaction and go back to full quality. Returns whether the
+        level has changed.
+        """
+        if not self.active:
+            return False
+        self.active = False
+        self._initial_level = self.level
+        self._frame_time = None
+        return self._set_level(1.)
+
+    def record(self, frame_time):
+        """
+        Record the time taken to draw a frame, and adjust the level if needed.
+        Returns whether the level has changed.
+        """
+
+        if not self.active:
+            return False
+
+        if self._frame_time is None:
+            self._frame_time = frame_time
+        else:
+            self._frame_time += self.smoothing * (frame_time - self._frame_time)
+
+        ratio = self._frame_time / self.target
+
+        if 1 / self.tolerance <= ratio <= self.tolerance:
+            return False
+
+        # We don't change the level by more than a factor of two at a time
+        # since the frame times can be noisy.
+        if self._set_level(self.level * np.clip(ratio, 0.5, 2.)):
+            # The previous frame times don't apply to the new level
+            self._frame_time = None
+            return True
+        else:
+            return False
+
+    def _set_level(self, level):
+        level = float(np.clip(level, 1., self.max_level))
+        if level == self.level:
+            return False
+        self.level = level
+        return True
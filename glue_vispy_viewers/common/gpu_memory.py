@@ -0,0 +1,114 @@
+# This file implements the accounting of the GPU memory used by the visuals
+# of all viewers in the session, which is used to keep the memory used by the
+# textures and vertex buffers within a budget. OpenGL doesn't provide a
+# portable way of finding out how much memory is available, so the budget is
+# a setting rather than being determined automatically.
+#
+# The visuals that are tracked should provide the following methods:
+#
+# * ``memory_usage()``, which returns a dictionary giving the number of bytes
+#   used by each layer, with the key `None` for the memory shared between the
+#   layers.
+#
+# * ``evictable()``, which returns a list of ``(viewed, label)`` tuples for
+#   the layers that use memory but are not shown, where ``viewed`` is the
+#   value returned by `GPUMemoryTracker.tick` when the layer was last shown.
+#
+# * ``evict(label)``, which releases the memory used by a layer. The memory
+#   should be allocated again once the layer is shown.
+
+import weakref
+
+__all__ = ['GPUMemoryTracker', 'gpu_memory']
+
+# By default, the layers that are not shown are evicted from the GPU once the
+# visuals use more than this much memory (in bytes).
+GPU_MEMORY_BUDGET = 2 * 1024 ** 3
+
+
+class GPUMemoryTracker(object):
+    """
+    Keep track of the GPU memory used by visuals, and evict the layers that
+    were least recently shown once more than ``budget`` bytes are used. The
+    budget can be set to `None` to never evict layers.
+    """
+
+    def __init__(self, budget=GPU_MEMORY_BUDGET):
+        self.budget = budget
+        self.evictions = 0
+        self._visuals = weakref.WeakSet()
+        self._clock = 0
+
+    def register(self, visual):
+        """
+        Start keeping track of the memory used by ``visual``.
+        """
+        self._visuals.add(visual)
+
+    def tick(self):
+        """
+        Return a number that is larger than the ones returned previously, to
+        record when layers are shown.
+        """
+        self._clock += 1
+        return self._clock
+
+    @property
+    def nbytes(self):
+        """
+        The number of bytes used by all the visuals.
+        """
+        return sum(sum(visual.memory_usage().values()) for visual in list(self._visuals))
+
+    def set_budget(self, budget):
+        """
+        Set the budget (in bytes), evicting layers if needed.
+        """
+        self.budget = budget
+        self.enforce()
+
+    def enforce(self):
+        """
+        Evict the layers that are not shown, starting with the ones that were
+        least recently shown, until the visuals use at most ``budget`` bytes
+        or there are no more layers to evict.
+        """
+
+        if self.budget is None:
+            return
+
+        nbytes = self.nbytes
+        if nbytes <= self.budget:
+            return
+
+        candidates = []
+        for visual in list(self._visuals):
+            for viewed, label in visual.evictable():
+                candidates.append((viewed, id(visual), visual, label))
+        candidates.sort(key=lambda candidate: candidate[:2])
+
+        for _, _, visual, label in candidates:
+            visual.evict(label)
+            self.evictions += 1
+            nbytes = self.nbytes
+            if nbytes <= self.budget:
+                break
+
+    def report(self):
+        """
+        Return a list with a dictionary for each visual, giving the
+        ``visual``, the ``canvas`` it is shown in (which identifies the
+        viewer), the number of bytes used by each of its ``layers`` (with the
+        key `None` for the memory shared between the layers), and the total
+        ``nbytes``.
+        """
+        report = []
+        for visual in list(self._visuals):
+            layers = visual.memory_usage()
+            report.append({'visual': visual, 'canvas': getattr(visual, 'canvas', None),
+                           'layers': layers, 'nbytes': sum(layers.values())})
+        return report
+
+
+# The tracker shared by all viewers
+gpu_memory = GPUMemoryTracker()
@@ -37,10 +37,20 @@ class VispyOptionsWidget(QtWidgets.QWidget):
         if not hasattr(viewer_state, 'downsample'):
             self.ui.bool_downsample.hide()
 
+        if not hasattr(viewer_state, 'downscale'):
+            self.ui.bool_downscale.hide()
+
+        if not hasattr(viewer_state, 'refine'):
+            self.ui.bool_refine.hide()
+
         if not hasattr(viewer_state, 'resolution'):
             self.ui.label_resolution.hide()
             self.ui.combosel_resolution.hide()
 
+        if not hasattr(viewer_state, 'render_mode'):
+            self.ui.label_render_mode.hide()
+            self.ui.combosel_render_mode.hide()
+
         if not hasattr(viewer_state, 'reference_data'):
             self.ui.label_reference_data.hide()
             self.ui.combosel_reference_data.hide()
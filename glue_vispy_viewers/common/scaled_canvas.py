@@ -0,0 +1,169 @@
+# This file implements a SceneCanvas that can draw the scene at a lower
+# resolution than that of the canvas, which is useful to keep the viewers
+# responsive on large or high-density displays while the user is interacting
+# with them, and that can average successive frames, which is used to refine
+# the rendering once the user has stopped interacting. In both cases, the scene
+# is drawn into an offscreen framebuffer which is then stretched over the
+# canvas.
+
+from vispy import gloo, scene
+
+__all__ = ['ScaledSceneCanvas']
+
+# The internal format of the texture in which frames are averaged. With 8 bits
+# per channel, the contribution of each new frame to the average is rounded
+# off after a few frames, which causes banding.
+ACCUMULATION_FORMAT = 'rgba16f'
+
+VERT_SHADER = """
+attribute vec2 a_position;
+varying vec2 v_texcoord;
+
+void main() {
+    v_texcoord = (a_position + 1.0) / 2.0;
+    gl_Position = vec4(a_position, 0.0, 1.0);
+}
+"""
+
+FRAG_SHADER = """
+uniform sampler2D u_texture;
+varying vec2 v_texcoord;
+
+void main() {
+    gl_FragColor = texture2D(u_texture, v_texcoord);
+}
+"""
+
+
+class ScaledSceneCanvas(scene.SceneCanvas):
+    """
+    A SceneCanvas which draws the scene with ``render_scale`` times as many
+    pixels along each direction as the canvas. Rendering the canvas to an
+    image with ``render()`` is always done at the full resolution.
+
+    If ``accumulate`` is `True`, the canvas shows the average of the frames
+    drawn since the scene last changed, the number of which is given by
+    ``accumulated``. Use `update_accumulation` to draw another frame without
+    discarding the previous ones.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.render_scale = 1.
+        self.accumulate = False
+        self.accumulated = 0
+        self._scaled_fbo = None
+        self._accumulation_fbo = None
+        self._accumulation_format = ACCUMULATION_FORMAT
+        self._scaled_program = None
+        super().__init__(*args, **kwargs)
+
+    def update(self, node=None):
+        # The scene has changed, so the frames drawn so far are out of date
+        self.accumulated = 0
+        super().update(node=node)
+
+    def update_accumulation(self):
+        """
+        Draw another frame to average with the previous ones.
+        """
+        super().update()
+
+    def _scaled_shape(self):
+        width, height = self.physical_size
+        return (max(1, int(round(height * self.render_scale))),
+                max(1, int(round(width * self.render_scale))))
+
+    def _update_transforms(self):
+        # SceneCanvas assumes that framebuffers have the size of the region of
+        # the canvas they cover, so we need to map the canvas to the smaller
+        # framebuffer ourselves.
+        if len(self._fb_stack) > 0 and self._fb_stack[-1][0] is self._scaled_fbo:
+            height, width = self._scaled_fbo.color_buffer.shape[:2]
+            self.transforms.configure(viewport=self._vp_stack[-1], fbo_size=(width, height),
+                                      fbo_rect=(0, 0) + tuple(self.physical_size))
+        else:
+            super()._update_transforms()
+
+    def _draw_scene(self, bgcolor=None):
+
+        # If a framebuffer is already active, the scene is being rendered to
+        # an image, which should be at full resolution.
+        if (self.render_scale == 1 and not self.accumulate) or len(self._fb_stack) > 0:
+            self._scaled_fbo = self._accumulation_fbo = None
+            self.accumulated = 0
+            super()._draw_scene(bgcolor=bgcolor)
+            return
+
+        shape = self._scaled_shape()
+
+        if self._scaled_fbo is None or self._scaled_fbo.color_buffer.shape[:2] != shape:
+            texture = gloo.Texture2D(shape=shape + (4,), interpolation='linear')
+            self._scaled_fbo = gloo.FrameBuffer(color=texture, depth=gloo.RenderBuffer(shape))
+
+        if self._scaled_program is None:
+            self._scaled_program = gloo.Program(VERT_SHADER, FRAG_SHADER)
+            self._scaled_program['a_position'] = [(-1, -1), (1, -1), (-1, 1), (1, 1)]
+
+        self.push_fbo(self._scaled_fbo, (0, 0), self.size)
+        try:
+            super()._draw_scene(bgcolor=bgcolor)
+        finally:
+            self.pop_fbo()
+
+        self._scaled_program['u_texture'] = self._scaled_fbo.color_buffer
+
+        if self.accumulate:
+
+            if (self._accumulation_fbo is None or
+                    self._accumulation_fbo.color_buffer.shape[:2] != shape):
+                self._accumulation_fbo = self._create_accumulation_fbo(shape)
+                self.accumulated = 0
+
+            # Blend the new frame with the running average of the previous
+            # frames, which replaces them for the first frame.
+            self.push_fbo(self._accumulation_fbo, (0, 0), self.size)
+            try:
+                self.context.set_state(depth_test=False, blend=True, cull_face=False,
+                                       blend_func=('constant_alpha', 'one_minus_constant_alpha'))
+                self.context.set_blend_color((0, 0, 0, 1 / (self.accumulated + 1)))
+                self._scaled_program.draw('triangle_strip')
+            finally:
+                self.pop_fbo()
+
+            self.accumulated += 1
+            self._scaled_program['u_texture'] = self._accumulation_fbo.color_buffer
+
+        else:
+
+            self._accumulation_fbo = None
+            self.accumulated = 0
+
+        self.context.set_state(depth_test=False, blend=False, cull_face=False)
+        self._scaled_program.draw('triangle_strip')
+
+    def _create_accumulation_fbo(self, shape):
+
+        # If floating-point textures can't be rendered to, we fall back to the
+        # default format. Errors only show up once the commands are sent to
+        # OpenGL, so we do this straight away (having first sent the commands
+        # that are already queued, so that their errors aren't mistaken for
+        # ours).
+        if self._accumulation_format is not None:
+            self.context.flush_commands()
+            texture = gloo.Texture2D(shape=shape + (4,), interpolation='linear',
+                                     internalformat=self._accumulation_format)
+            fbo = gloo.FrameBuffer(color=texture)
+            try:
+                fbo.activate()
+                fbo.deactivate()
+                self.context.flush_commands()
+            except RuntimeError:
+                self._accumulation_format = None
+                fbo.deactivate()
+                fbo.delete()
+                texture.delete()
+            else:
+                return fbo
+
+        texture = gloo.Texture2D(shape=shape + (4,), interpolation='linear')
+        return gloo.FrameBuffer(color=texture)
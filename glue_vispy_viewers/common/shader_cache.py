@@ -0,0 +1,124 @@
+# This file implements a cache, shared by all viewers in the session, for the
+# work that VisPy does on the CPU when building a shader program that only
+# depends on the generated GLSL code. VisPy parses the uniforms and attributes
+# out of the full code of each program with regular expressions, which takes
+# longer than compiling the shaders for long fragment shaders such as the one
+# used for volume rendering, and the code is the same in all viewers showing
+# the same combination of layers.
+#
+# Note that the compiled OpenGL programs themselves can't be shared, since
+# each viewer has its own OpenGL context and the uniforms are stored in the
+# program objects, but the drivers usually cache compiled shaders based on
+# the code.
+
+import inspect
+from collections import OrderedDict
+
+from vispy.visuals.shaders import ModularProgram, MultiProgram
+
+__all__ = ['ShaderCache', 'CachedModularProgram', 'CachedMultiProgram', 'shader_cache']
+
+
+class ShaderCache(object):
+    """
+    A cache of values computed from shader code, which keeps the values for
+    at most ``max_size`` pieces of code, discarding the least recently used
+    ones first. The numbers of ``hits`` and ``misses`` are kept for
+    diagnostics.
+    """
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, code, func):
+        """
+        Return the value for ``code``, calling ``func(code)`` to compute it if
+        it isn't in the cache.
+        """
+        if code in self._values:
+            self.hits += 1
+            self._values.move_to_end(code)
+            return self._values[code]
+        self.misses += 1
+        value = func(code)
+        self._values[code] = value
+        while len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+        return value
+
+    def clear(self):
+        """
+        Remove all values from the cache and reset the counters.
+        """
+        self._values.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """
+        Return a dictionary with the numbers of hits and misses and the number
+        of values in the cache.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+
+# The cache used by all programs created with CachedMultiProgram
+shader_cache = ShaderCache()
+
+
+def _supports_variable_cache():
+    # CachedModularProgram relies on private methods of vispy.gloo.Program to
+    # replace the parsing of the code, so we only enable the cache if these
+    # still look the way we expect - otherwise programs are built as usual.
+    parse = getattr(ModularProgram, '_parse_variables_from_code', None)
+    if parse is None or not hasattr(ModularProgram, '_process_pending_variables'):
+        return False
+    try:
+        parameters = inspect.signature(parse).parameters
+    except (TypeError, ValueError):
+        return False
+    return list(parameters) == ['self', 'update_variables']
+
+
+VARIABLE_CACHE_SUPPORTED = _supports_variable_cache()
+
+
+class CachedModularProgram(ModularProgram):
+    """
+    A ModularProgram which looks up the variables declared in the code in
+    ``shader_cache`` rather than parsing the code each time it is built.
+    """
+
+    def _parse_variables_from_code(self, update_variables=True):
+        if not VARIABLE_CACHE_SUPPORTED:
+            return super()._parse_variables_from_code(update_variables=update_variables)
+        code = '\n\n'.join(shader.code for shader in self._shaders)
+        self._code_variables = dict(shader_cache.get(code, self._parse_variables))
+        if update_variables:
+            self._process_pending_variables()
+
+    def _parse_variables(self, code):
+        super()._parse_variables_from_code(update_variables=False)
+        return dict(self._code_variables)
+
+
+class CachedMultiProgram(MultiProgram):
+    """
+    A MultiProgram which creates instances of CachedModularProgram.
+    """
+
+    def add_program(self, name=None):
+        prog = super().add_program(name=name)
+        # MultiProgram always creates a plain ModularProgram, but the code is
+        # only parsed when the program is built, so we can simply change the
+        # class of the new program here. CachedModularProgram doesn't define
+        # any attributes of its own, so this is safe.
+        if type(prog) is ModularProgram:
+            prog.__class__ = CachedModularProgram
+        return prog
@@ -0,0 +1,61 @@
+import pytest
+
+from ..governor import FrameTimeGovernor
+
+
+def simulate(governor, full_quality_time, frames):
+    # The time taken to draw a frame is inversely proportional to the level
+    for i in range(frames):
+        governor.record(full_quality_time / governor.level)
+
+
+def test_governor():
+
+    governor = FrameTimeGovernor(target=0.05)
+
+    # Frame times are ignored outside of interactions
+    assert not governor.record(1.)
+    assert governor.level == 1
+
+    assert not governor.start(max_level=20)
+
+    # Slow frames increase the level until the target is met
+    simulate(governor, 0.4, 20)
+    assert 0.4 / governor.level == pytest.approx(0.05, rel=0.25)
+
+    # Fast frames decrease it again
+    simulate(governor, 0.1, 20)
+    assert 0.1 / governor.level == pytest.approx(0.05, rel=0.25)
+
+    level = governor.level
+
+    # The interaction ends at full quality, and the next one starts at the
+    # previous level.
+    assert governor.stop()
+    assert governor.level == 1
+    assert not governor.stop()
+    assert governor.start(max_level=20)
+    assert governor.level == level
+
+
+def test_governor_limits():
+
+    governor = FrameTimeGovernor(target=0.05)
+    governor.start(max_level=3)
+
+    # The level changes by at most a factor of two per frame
+    assert governor.record(1.)
+    assert governor.level == 2
+    simulate(governor, 1., 10)
+    assert governor.level == 3
+
+    # The maximum level can be changed during an interaction
+    assert governor.start(max_level=1.5)
+    assert governor.level == 1.5
+
+    governor.stop()
+
+    # Frames that are fast enough don't change the level
+    governor.start(max_level=3)
+    simulate(governor, 0.01, 10)
+    assert governor.level == 1
@@ -0,0 +1,61 @@
+from ..gpu_memory import GPUMemoryTracker
+
+
+class Visual(object):
+    """
+    Minimal visual with layers that use a fixed amount of memory, some of
+    which are hidden.
+    """
+
+    def __init__(self, tracker, **layers):
+        self.layers = layers
+        self.viewed = {}
+        tracker.register(self)
+
+    def memory_usage(self):
+        return dict(self.layers)
+
+    def evictable(self):
+        return [(viewed, label) for label, viewed in self.viewed.items() if self.layers[label] > 0]
+
+    def evict(self, label):
+        self.layers[label] = 0
+
+
+def test_gpu_memory_tracker():
+
+    tracker = GPUMemoryTracker(budget=None)
+
+    visual1 = Visual(tracker, a=100, b=100)
+    visual2 = Visual(tracker, c=100, d=100)
+    assert tracker.nbytes == 400
+
+    # The layers are hidden in the order b, d, a
+    visual1.viewed['b'] = tracker.tick()
+    visual2.viewed['d'] = tracker.tick()
+    visual1.viewed['a'] = tracker.tick()
+
+    # Nothing is evicted without a budget
+    tracker.enforce()
+    assert tracker.nbytes == 400
+
+    # The least recently shown layers are evicted first, regardless of
+    # which visual these belong to, until the budget is met.
+    tracker.set_budget(250)
+    assert visual1.layers == {'a': 100, 'b': 0}
+    assert visual2.layers == {'c': 100, 'd': 0}
+    assert tracker.evictions == 2
+
+    # Layers that are shown are never evicted, even if over budget
+    tracker.set_budget(50)
+    assert tracker.nbytes == 100
+    assert tracker.evictions == 3
+
+    report = {id(entry['visual']): entry for entry in tracker.report()}
+    assert report[id(visual1)]['layers'] == {'a': 0, 'b': 0}
+    assert report[id(visual2)]['nbytes'] == 100
+    assert report[id(visual2)]['canvas'] is None
+
+    # Visuals that no longer exist are no longer tracked
+    del visual1, report
+    assert len(tracker.report()) == 1
@@ -0,0 +1,83 @@
+import sys
+
+import numpy as np
+import pytest
+
+from vispy import gloo, scene
+
+from ..scaled_canvas import ScaledSceneCanvas
+
+IS_WIN = sys.platform == 'win32'
+
+
+def centroid(image):
+    weights = 255 - image[..., :3].mean(axis=-1)
+    y, x = np.indices(weights.shape)
+    return (weights * y).sum() / weights.sum(), (weights * x).sum() / weights.sum()
+
+
+@pytest.mark.skipif('IS_WIN', reason='Windows fatal exception: access violation')
+def test_scaled_canvas():
+
+    canvas = ScaledSceneCanvas(keys=None, size=(100, 80), show=True, bgcolor='white')
+
+    if hasattr(canvas.native, 'context') and not canvas.native.context().isValid():  # Qt
+        canvas.native.close()
+        pytest.skip('OpenGL is not available')
+    view = canvas.central_widget.add_view()
+    view.camera = scene.cameras.TurntableCamera(fov=0., distance=4.0)
+
+    markers = scene.visuals.Markers(parent=view.scene)
+    markers.set_data(np.array([[0.5, 0.3, 0.2]]), face_color='red', size=20)
+
+    def draw(render_scale):
+        canvas.render_scale = render_scale
+        canvas.set_current()
+        canvas.on_draw(None)
+        return gloo.read_pixels(viewport=(0, 0) + tuple(canvas.physical_size))
+
+    expected = canvas.render()
+
+    # At a lower resolution, the scene is stretched over the whole canvas
+    scaled = draw(0.5)
+    assert canvas._scaled_fbo.color_buffer.shape[:2] == (40, 50)
+    assert scaled.shape == expected.shape
+    np.testing.assert_allclose(centroid(scaled), centroid(expected), atol=1)
+
+    # Images of the canvas are always at full resolution
+    np.testing.assert_equal(canvas.render(), expected)
+
+    np.testing.assert_equal(draw(1), expected)
+    assert canvas._scaled_fbo is None
+
+    # Frames of the same scene are averaged until the scene changes
+    canvas.accumulate = True
+    for i in range(3):
+        np.testing.assert_equal(draw(1), expected)
+    assert canvas.accumulated == 3
+    assert canvas._accumulation_fbo.color_buffer.internalformat == 'rgba16f'
+    markers.set_data(np.array([[-0.5, 0.3, 0.2]]), face_color='red', size=20)
+    assert canvas.accumulated == 0
+    moved = draw(1)
+    assert canvas.accumulated == 1
+    assert centroid(moved)[1] < centroid(expected)[1]
+
+    # If floating-point textures can't be rendered to, the frames are
+    # averaged in a texture with the default format.
+    activate = gloo.FrameBuffer.activate
+
+    def fail(fbo):
+        if fbo.color_buffer.internalformat == 'rgba16f':
+            raise RuntimeError('FrameBuffer attachments are incomplete.')
+        activate(fbo)
+
+    gloo.FrameBuffer.activate = fail
+    try:
+        canvas._accumulation_fbo = None
+        np.testing.assert_equal(draw(1), moved)
+    finally:
+        gloo.FrameBuffer.activate = activate
+    assert canvas._accumulation_fbo.color_buffer.internalformat is None
+
+    if hasattr(canvas.native, 'show'):  # Qt
+        canvas.native.close()
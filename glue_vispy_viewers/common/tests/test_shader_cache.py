@@ -0,0 +1,89 @@
+import pytest
+
+from vispy.visuals.shaders import ModularProgram
+
+from ..shader_cache import (ShaderCache, CachedModularProgram, CachedMultiProgram,
+                            VARIABLE_CACHE_SUPPORTED, shader_cache)
+
+VERT_SHADER = """
+attribute vec2 a_position;
+uniform float u_scale;
+void main() {
+    gl_Position = vec4(a_position * u_scale, 0.0, 1.0);
+}
+"""
+
+FRAG_SHADER = """
+uniform vec4 u_color;
+void main() {
+    gl_FragColor = u_color;
+}
+"""
+
+
+def test_shader_cache():
+
+    cache = ShaderCache(max_size=2)
+    computed = []
+
+    def compute(code):
+        computed.append(code)
+        return code.upper()
+
+    assert cache.get('a', compute) == 'A'
+    assert cache.get('b', compute) == 'B'
+    assert cache.get('a', compute) == 'A'
+    assert computed == ['a', 'b']
+    assert cache.info() == {'hits': 1, 'misses': 2, 'size': 2}
+
+    # The least recently used value is discarded first
+    cache.get('c', compute)
+    cache.get('a', compute)
+    cache.get('b', compute)
+    assert computed == ['a', 'b', 'c', 'b']
+
+    cache.clear()
+    assert cache.info() == {'hits': 0, 'misses': 0, 'size': 0}
+
+
+def test_cached_programs():
+
+    shader_cache.clear()
+
+    # Programs in different MultiPrograms (e.g. in different viewers) with the
+    # same code share the variables parsed from the code.
+    programs = [CachedMultiProgram(VERT_SHADER, FRAG_SHADER).add_program() for i in range(3)]
+    for program in programs:
+        program['u_scale'] = 2.
+        program.build_if_needed()
+
+    assert shader_cache.info() == {'hits': 2, 'misses': 1, 'size': 1}
+
+    reference = ModularProgram(VERT_SHADER, FRAG_SHADER)
+    reference.build_if_needed()
+    for program in programs:
+        assert program.variables == reference.variables
+        assert program['u_scale'] == 2.
+
+    shader_cache.clear()
+
+
+def test_variable_cache_supported():
+
+    # This fails if the private methods of vispy.gloo.Program which
+    # CachedModularProgram overrides change, in which case the programs are
+    # still built correctly but the cache is no longer used.
+    assert VARIABLE_CACHE_SUPPORTED
+
+
+def test_cached_multi_program():
+
+    # The programs should be set up in the same way as by MultiProgram
+    multi = CachedMultiProgram(VERT_SHADER, FRAG_SHADER)
+    multi['u_scale'] = 3.
+    program = multi.add_program('main')
+    assert isinstance(program, CachedModularProgram)
+    assert program['u_scale'] == 3.
+    assert list(multi) == [program]
+    with pytest.raises(KeyError):
+        multi.add_program('main')
@@ -40,9 +40,11 @@ class RotateTool(Tool):
             self.timer = app.Timer(connect=self.rotate)
         self.rotating = not self.rotating
         if self.rotating:
+            self.viewer._start_interaction()
             self.timer.start(0.1)
         else:
             self.timer.stop()
+            self.viewer._stop_interaction()
 
     def rotate(self, event):
         self.viewer._vispy_widget.view.camera.azimuth -= 1.  # set speed as constant first
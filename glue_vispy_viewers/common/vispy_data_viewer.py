@@ -1,13 +1,32 @@
+import time
+
 import numpy as np
 
 from echo import delay_callback
 
+from vispy import app
 from vispy.util import keys
 
 from glue.viewers.common3d.viewer_state import ViewerState3D as Vispy3DViewerState
 
 from .vispy_widget import VispyWidgetHelper
 from .compat import update_viewer_state
+from .governor import FrameTimeGovernor
+from .gpu_memory import gpu_memory
+
+# How long to wait after the last mouse wheel event before considering that
+# the interaction has finished (in seconds).
+INTERACTION_TIMEOUT = 0.25
+
+# The fraction of the canvas resolution along each direction at which the
+# scene is drawn while the user is interacting with the viewer, if the
+# ``downscale`` option of the viewer state is enabled.
+INTERACTION_RENDER_SCALE = 0.5
+
+# The number of frames averaged to refine the rendering once the user has
+# stopped interacting with the viewer, if the ``refine`` option of the viewer
+# state is enabled.
+REFINEMENT_FRAMES = 8
 
 
 class BaseVispyViewerMixin:
@@ -41,13 +60,124 @@ class BaseVispyViewerMixin:
         viewbox.events.mouse_press.connect(self.camera_mouse_press)
         viewbox.events.mouse_release.connect(self.camera_mouse_release)
 
+        # While the user is interacting with the viewer, the level of detail
+        # is adjusted based on the time taken to draw each frame.
+        self._governor = FrameTimeGovernor()
+        self._draw_start = None
+        self._interaction_timer = None
+
+        canvas = self._vispy_widget.canvas
+        canvas.events.draw.connect(self._on_draw_start, position='first')
+        canvas.events.draw.connect(self._on_draw_end, position='last')
+
     def _update_appearance_from_settings(self, message):
         self._vispy_widget._update_appearance_from_settings()
 
+    def show_status(self, text):
+        # Viewers that have somewhere to show status messages should
+        # override this.
+        pass
+
     def redraw(self):
         if self._ready_draw:
             self._vispy_widget.canvas.render()
 
+    def _start_interaction(self):
+        """
+        Lower the level of detail and optionally the resolution as needed to
+        keep the viewer responsive until `_stop_interaction` is called.
+        """
+        canvas = self._vispy_widget.canvas
+        canvas.accumulate = False
+        if getattr(self.state, 'downscale', False):
+            canvas.render_scale = INTERACTION_RENDER_SCALE
+        if not getattr(self.state, 'downsample', True):
+            return
+        if self._governor.start(max_level=self._max_level_of_detail()):
+            self._update_level_of_detail(self._governor.level)
+
+    def _stop_interaction(self, *event):
+        """
+        Go back to full quality once the interaction has finished.
+        """
+        canvas = self._vispy_widget.canvas
+        changed = self._governor.stop()
+        if changed:
+            self._update_level_of_detail(1.)
+        if canvas.render_scale != 1:
+            canvas.render_scale = 1.
+            changed = True
+        if changed or getattr(self.state, 'refine', False):
+            self._update_refinement()
+
+    def _update_refinement(self, *args):
+        """
+        Start refining the rendering by averaging several frames if enabled.
+        """
+        canvas = self._vispy_widget.canvas
+        canvas.accumulate = getattr(self.state, 'refine', False)
+        self._update_jitter(0)
+        canvas.update()
+
+    def _max_level_of_detail(self):
+        # Viewers whose visuals can be drawn with less detail should override
+        # this and _update_level_of_detail.
+        return 1.
+
+    def _update_level_of_detail(self, level):
+        pass
+
+    def _update_jitter(self, index):
+        # Viewers whose visuals can be drawn slightly differently for each of
+        # the frames averaged when refining the rendering should override this.
+        pass
+
+    def _on_draw_start(self, event=None):
+        self._draw_start = time.perf_counter()
+
+    def _on_draw_end(self, event=None):
+        if self._draw_start is None:
+            return
+        # The commands for the frame have only been submitted at this point,
+        # so while interacting we wait for the GPU to finish drawing the
+        # frame, otherwise we would only measure how long it took to submit
+        # the commands rather than how long the GPU takes to draw the frame.
+        if self._governor.active:
+            self._vispy_widget.canvas.context.finish()
+        frame_time = time.perf_counter() - self._draw_start
+        self._draw_start = None
+        if self._governor.record(frame_time):
+            self._update_level_of_detail(self._governor.level)
+        canvas = self._vispy_widget.canvas
+        if canvas.accumulate and canvas.accumulated > 0:
+            if canvas.accumulated < REFINEMENT_FRAMES:
+                self._update_jitter(canvas.accumulated)
+                canvas.update_accumulation()
+            else:
+                self._update_jitter(0)
+
+    def gpu_memory_report(self):
+        """
+        Return a dictionary giving the number of bytes of GPU memory used by
+        each of the ``layers`` of the viewer (as a list of ``(layer_artist,
+        nbytes)`` tuples), the memory ``shared`` between the layers, and the
+        total ``nbytes``. The memory used by all viewers is given by
+        ``gpu_memory.report()``.
+        """
+        layer_artists = {getattr(layer_artist, 'id', None): layer_artist
+                         for layer_artist in self._layer_artist_container}
+        layers, shared = [], 0
+        for entry in gpu_memory.report():
+            if entry['visual'] not in self._vispy_widget.limit_transforms:
+                continue
+            for label, nbytes in entry['layers'].items():
+                if label in layer_artists:
+                    layers.append((layer_artists[label], nbytes))
+                else:
+                    shared += nbytes
+        return {'layers': layers, 'shared': shared,
+                'nbytes': shared + sum(nbytes for _, nbytes in layers)}
+
     def get_layer_artist(self, cls, layer=None, layer_state=None):
         return cls(self, layer=layer, layer_state=layer_state)
 
@@ -64,6 +194,16 @@ class BaseVispyViewerMixin:
 
     def camera_mouse_wheel(self, event=None):
 
+        # There is no event at the end of the scrolling, so we consider that
+        # the interaction has finished once there haven't been mouse wheel
+        # events for a little while.
+        self._start_interaction()
+        if self._interaction_timer is None:
+            self._interaction_timer = app.Timer(interval=INTERACTION_TIMEOUT, iterations=1,
+                                                connect=self._stop_interaction)
+        self._interaction_timer.stop()
+        self._interaction_timer.start()
+
         scale = (1.1 ** - event.delta[1])
 
         with delay_callback(self.state, 'x_min', 'x_max', 'y_min', 'y_max', 'z_min', 'z_max'):
@@ -89,6 +229,8 @@ class BaseVispyViewerMixin:
 
     def camera_mouse_press(self, event=None):
 
+        self._start_interaction()
+
         self._initial_position = (self.state.x_min, self.state.x_max,
                                   self.state.y_min, self.state.y_max,
                                   self.state.z_min, self.state.z_max)
@@ -98,6 +240,7 @@ class BaseVispyViewerMixin:
                        self.state.z_max - self.state.z_min)
 
     def camera_mouse_release(self, event=None):
+        self._stop_interaction()
         self._initial_position = None
         self._width = None
 
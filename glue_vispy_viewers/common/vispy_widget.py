@@ -4,6 +4,7 @@ import numpy as np
 
 from vispy import scene
 from .axes import AxesVisual3D
+from .scaled_canvas import ScaledSceneCanvas
 from ..utils import NestedSTTransform
 
 from matplotlib.colors import ColorConverter
@@ -20,8 +21,9 @@ class VispyWidgetHelper(object):
     def __init__(self, parent=None, viewer_state=None):
 
         # Prepare Vispy canvas. We set the depth_size to 24 to avoid issues
-        # with isosurfaces on MacOS X
-        self.canvas = scene.SceneCanvas(keys=None, show=False,
+        # with isosurfaces on MacOS X. The canvas can draw the scene at a lower
+        # resolution while the user is interacting with the viewer.
+        self.canvas = ScaledSceneCanvas(keys=None, show=False,
                                         config={'depth_size': 24},
                                         bgcolor=rgb(settings.BACKGROUND_COLOR))
 
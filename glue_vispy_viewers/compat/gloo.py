@@ -0,0 +1,22 @@
+from vispy.gloo import gl, glir
+
+__all__ = ['fix_internalformats']
+
+# The correct values of the two-channel texture internal formats. Some
+# versions of VisPy define the wrong values for GL_RG8, GL_RG16, and GL_RG16F,
+# which causes an 'invalid value' error when textures are created with these
+# formats.
+RG_INTERNALFORMATS = {'GL_RG8': 33323,
+                      'GL_RG16': 33324,
+                      'GL_RG16F': 33327,
+                      'GL_RG32F': 33328}
+
+
+def fix_internalformats():
+    """
+    Make sure VisPy uses the correct values for the two-channel texture
+    internal formats.
+    """
+    for name, value in RG_INTERNALFORMATS.items():
+        if name in glir._internalformats and int(glir._internalformats[name]) != value:
+            glir._internalformats[name] = gl.Enum(name, value)
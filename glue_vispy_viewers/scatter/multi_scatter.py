@@ -7,6 +7,14 @@ from matplotlib.colors import ColorConverter
 from vispy import scene
 from vispy.scene.visuals import Arrow
 
+from ..common.gpu_memory import gpu_memory
+
+# The number of bytes used on the GPU for each vertex of the error bars and
+# vectors (the position and color, as float32 values), and for each arrow head
+# (the start and end positions and the color).
+LINE_VERTEX_NBYTES = 28
+ARROW_NBYTES = 40
+
 
 class MultiColorScatter(scene.visuals.Markers):
     """
@@ -22,6 +30,7 @@ class MultiColorScatter(scene.visuals.Markers):
         self._update_called = False
         self._error_vector_widget = None
         super(MultiColorScatter, self).__init__(*args, **kwargs)
+        gpu_memory.register(self)
 
     @contextmanager
     def delay_update(self):
@@ -99,6 +108,18 @@ class MultiColorScatter(scene.visuals.Markers):
         self.layers[label]['zorder'] = zorder
         self._update()
 
+    def memory_usage(self):
+        """
+        Return the number of bytes of GPU memory used by the vertex buffers
+        for each layer. Layers that are not visible are not uploaded.
+        """
+        return {label: layer.get('nbytes', 0) for label, layer in self.layers.items()}
+
+    def evictable(self):
+        # Only the layers that are visible are uploaded, so there is nothing
+        # to evict.
+        return []
+
     def update_line_width(self, width):
         if self._error_vector_widget:
             self._error_vector_widget.set_data(width=width)
@@ -116,6 +137,10 @@ class MultiColorScatter(scene.visuals.Markers):
         line_colors = []
         arrows = []
         arrow_colors = []
+        counts = {}
+
+        for label in self.layers:
+            self.layers[label]['nbytes'] = 0
 
         for label in sorted(self.layers, key=lambda x: self.layers[x]['zorder']()):
 
@@ -132,6 +157,8 @@ class MultiColorScatter(scene.visuals.Markers):
 
             if input_points > 0 and n_points > 0:
 
+                counts[label] = [n_points, 0, 0]
+
                 # Data
 
                 if layer['mask'] is None:
@@ -175,6 +202,7 @@ class MultiColorScatter(scene.visuals.Markers):
                         out = out.reshape((-1, 3))
                         lines.append(out)
                         line_colors.append(np.repeat(rgba, 2, axis=0))
+                        counts[label][1] += len(lines[-1])
 
                 if layer['vectors'] is not None:
                     if layer['mask'] is None:
@@ -183,9 +211,11 @@ class MultiColorScatter(scene.visuals.Markers):
                         out = layer['vectors'][layer['mask']]
                     lines.append(out.reshape((-1, 3)))
                     line_colors.append(np.repeat(rgba, 2, axis=0))
+                    counts[label][1] += len(lines[-1])
                     if layer['draw_arrows']:
                         arrows.append(out)
                         arrow_colors.append(rgba)
+                        counts[label][2] += len(out)
 
         if len(data) == 0:
             self.visible = False
@@ -199,6 +229,16 @@ class MultiColorScatter(scene.visuals.Markers):
 
         self.set_data(data, edge_color=colors, face_color=colors, size=sizes)
 
+        markers = getattr(self, '_data', None)
+        marker_nbytes = 0 if markers is None else markers.itemsize
+        for label, (n_points, n_vertices, n_arrows) in counts.items():
+            self.layers[label]['nbytes'] = (n_points * marker_nbytes +
+                                            n_vertices * LINE_VERTEX_NBYTES +
+                                            n_arrows * ARROW_NBYTES)
+
+        # Hidden volume layers might need to be evicted to make space
+        gpu_memory.enforce()
+
         if len(lines) == 0:
             if self._error_vector_widget is not None:
                 self._error_vector_widget.visible = False
@@ -0,0 +1,255 @@
+# This file implements the bookkeeping used by MultiVolumeVisual to show
+# volumes at their native resolution when they are too large to fit in a
+# single texture at that resolution. The data is split into fixed-size bricks
+# on the pixel grid of the reference data, and the bricks that are visible
+# are loaded on demand into the slots of a fixed-size atlas texture. A page
+# table then tells the fragment shader which slot (if any) holds each brick.
+
+from collections import OrderedDict
+
+import numpy as np
+
+__all__ = ['BrickCache', 'brick_grid', 'visible_bricks', 'prepare_bricks', 'compute_bricks',
+           'page_table']
+
+# The size of the bricks, in voxels of the reference data. Each brick is
+# stored in the atlas with an extra voxel on each side so that interpolation
+# at the edges of the brick doesn't need to look at the neighboring bricks.
+BRICK_SIZE = 32
+
+# The number of bricks in the atlas along each axis. With the default brick
+# size, this means that the atlas uses 80Mb of GPU memory.
+BRICK_CACHE_SHAPE = (4, 8, 8)
+
+# The maximum number of bricks along each axis of the page table. Regions
+# that would need more bricks than this are only shown at the resolution of
+# the viewer.
+BRICK_TABLE_MAX = 64
+
+# The maximum number of bricks to load in one go. Once a batch of bricks has
+# been uploaded, the next batch is requested.
+BRICK_BATCH_SIZE = 16
+
+
+def brick_grid(data_bounds, brick_size=BRICK_SIZE):
+    """
+    Return the ``(first, shape)`` of the range of bricks that cover
+    ``data_bounds``, or `None` if more than ``BRICK_TABLE_MAX`` bricks would
+    be needed along any axis. Voxel ``i`` of the reference data is in brick
+    ``i // brick_size``.
+    """
+    first, shape = [], []
+    for vmin, vmax, _ in data_bounds:
+        start = int(np.floor((vmin + 0.5) / brick_size))
+        stop = int(np.ceil((vmax + 0.5) / brick_size))
+        if stop - start > BRICK_TABLE_MAX:
+            return None
+        first.append(start)
+        shape.append(stop - start)
+    return tuple(first), tuple(shape)
+
+
+def visible_bricks(first, shape, matrix, brick_size=BRICK_SIZE):
+    """
+    Return the indices of the bricks in the range given by ``first`` and
+    ``shape`` that are at least partly inside the view, as a ``(n, 3)`` array
+    sorted by increasing distance of the brick from the center of the view.
+
+    ``matrix`` is the 4x4 matrix that maps homogeneous ``(x, y, z, 1)`` pixel
+    coordinates in the reference data to clip coordinates. All indices are in
+    ``(z, y, x)`` order.
+    """
+
+    indices = np.indices(shape).reshape((3, -1)).T + np.array(first)
+
+    # Find the clip coordinates of the corners of all the bricks
+    corners = np.array(np.meshgrid([0, 1], [0, 1], [0, 1], indexing='ij')).reshape((3, -1)).T
+    points = (indices[:, np.newaxis, :] + corners) * brick_size - 0.5
+    points = np.concatenate([points[..., ::-1], np.ones(points.shape[:2] + (1,))], axis=-1)
+    clip = points @ np.asarray(matrix, dtype=float).T
+
+    # Bricks with corners behind the camera are treated as visible
+    w = clip[..., 3:]
+    behind = (w <= 0).any(axis=(1, 2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ndc = clip[..., :3] / w
+    inside = (ndc.min(axis=1) <= 1).all(axis=1) & (ndc.max(axis=1) >= -1).all(axis=1)
+    visible = inside | behind
+
+    distance = np.hypot(*ndc[visible, :, :2].mean(axis=1).T)
+    distance[behind[visible]] = 0.
+
+    return indices[visible][np.argsort(distance, kind='stable')]
+
+
+def prepare_bricks(job, data, first, shape, matrix, loaded, capacity, count,
+                   brick_size=BRICK_SIZE):
+    """
+    Find the bricks in the range given by ``first`` and ``shape`` that are
+    visible with the given ``matrix`` (see `visible_bricks`), and compute
+    the values for up to ``count`` of the visible bricks that are not in
+    ``loaded``.
+
+    Like `~glue_vispy_viewers.volume.volume_visual.prepare_chunks`, this can
+    be called from a worker thread.
+
+    Returns
+    -------
+    visible : list
+        The ``(z, y, x)`` indices of the first ``capacity`` visible bricks,
+        from the center of the view outwards.
+    bricks : list
+        See `compute_bricks`.
+    """
+    visible = [tuple(brick) for brick in
+               visible_bricks(first, shape, matrix, brick_size=brick_size)[:capacity]]
+    missing = [brick for brick in visible if brick not in loaded][:count]
+    return visible, compute_bricks(job, data, missing, brick_size=brick_size)
+
+
+def compute_bricks(job, data, bricks, brick_size=BRICK_SIZE):
+    """
+    Compute the values of the given ``bricks`` of ``data`` at the resolution
+    of the reference data.
+
+    Returns
+    -------
+    bricks : list
+        A list of ``(brick, values, vrange)`` tuples, where ``values`` has
+        shape ``(brick_size + 2,) * 3 + (2,)`` and contains the values
+        (with NaN values set to zero) and whether each value is valid, and
+        ``vrange`` is the range of the valid values, or `None` if there are
+        no valid values.
+    """
+
+    results = []
+
+    for brick in bricks:
+
+        if job is not None:
+            job.check()
+
+        bounds = [(b * brick_size - 1, (b + 1) * brick_size, brick_size + 2) for b in brick]
+        values = np.asarray(data.compute_fixed_resolution_buffer(bounds), dtype=np.float32)
+
+        valid = ~np.isnan(values)
+        if valid.any():
+            vrange = float(values[valid].min()), float(values[valid].max())
+        else:
+            vrange = None
+
+        values = np.stack([np.where(valid, values, 0), valid], axis=-1).astype(np.float32)
+
+        results.append((tuple(brick), values, vrange))
+
+    return results
+
+
+def page_table(cache, labels, first, shape):
+    """
+    Return the page table for the bricks of the given layers in ``cache``,
+    where the keys are ``(label, brick)`` tuples. The table contains a block
+    of ``shape[0]`` rows for each layer, in the order given by ``labels``,
+    covering the range of bricks given by ``first`` and ``shape``. For each
+    brick, the table contains the ``(x, y, z)`` position of the slot in the
+    atlas followed by 255 if the brick is loaded, and zeros otherwise.
+    """
+
+    rows = {label: row for row, label in enumerate(labels)}
+
+    table = np.zeros((len(labels) * shape[0],) + tuple(shape[1:]) + (4,), dtype=np.uint8)
+
+    for key in cache.keys():
+        label, brick = key
+        if label not in rows:
+            continue
+        index = np.subtract(brick, first)
+        if np.any(index < 0) or np.any(index >= shape):
+            continue
+        index[0] += rows[label] * shape[0]
+        table[tuple(index)] = tuple(cache.slot(key)[::-1]) + (255,)
+
+    return table
+
+
+class BrickCache(object):
+    """
+    Keep track of which bricks are stored in which slots of an atlas with
+    ``shape`` slots along each axis, evicting the least recently used bricks
+    once the atlas is full.
+
+    Bricks are identified by keys, which can be any hashable objects, and a
+    value (such as the range of values in the brick) can be stored with each
+    brick.
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self._slots = OrderedDict()
+        self._values = {}
+        self._free = list(range(self.capacity))[::-1]
+
+    @property
+    def capacity(self):
+        return int(np.prod(self.shape))
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def __len__(self):
+        return len(self._slots)
+
+    def keys(self):
+        return list(self._slots)
+
+    def slot(self, key):
+        """
+        Return the ``(z, y, x)`` position of the slot for ``key`` in the atlas.
+        """
+        return np.unravel_index(self._slots[key], self.shape)
+
+    def value(self, key):
+        return self._values[key]
+
+    def touch(self, keys):
+        """
+        Mark the given keys as used, with the last ones being the most
+        recently used. Keys that are not in the cache are ignored.
+        """
+        for key in keys:
+            if key in self._slots:
+                self._slots.move_to_end(key)
+
+    def insert(self, key, value=None, keep=()):
+        """
+        Add a brick to the cache, evicting the least recently used brick that
+        is not in ``keep`` if needed. Returns the key of the evicted brick, or
+        `None` if no brick was evicted. Raises `KeyError` if all the bricks in
+        the cache are in ``keep``.
+        """
+        if key in self._slots:
+            self._values[key] = value
+            self.touch([key])
+            return None
+        evicted = None
+        if not self._free:
+            for old in self._slots:
+                if old not in keep:
+                    evicted = old
+                    break
+            else:
+                raise KeyError("All bricks in the cache are in use")
+            self.discard([evicted])
+        self._slots[key] = self._free.pop()
+        self._values[key] = value
+        return evicted
+
+    def discard(self, keys):
+        """
+        Remove the given keys from the cache. Keys that are not in the cache
+        are ignored.
+        """
+        for key in keys:
+            if key in self._slots:
+                self._free.append(self._slots.pop(key))
+                del self._values[key]
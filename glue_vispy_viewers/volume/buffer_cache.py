@@ -0,0 +1,304 @@
+# This file implements a cache for the fixed resolution buffers computed for
+# volume layers, which is shared by all volume viewers in a session. When
+# several viewers show the same data with the same bounds and resolution (or
+# the same subset, e.g. when a subset is updated), the buffer is only computed
+# once and the same array is used by all viewers. Only the buffers covering the
+# whole volume at full resolution are kept, since the other requests (e.g. for
+# bricks, slabs or coarse previews) are only needed once - these should go
+# through `uncached`.
+
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+from glue.core.data import Subset
+from glue.viewers.volume3d.data_proxy import DataProxy
+
+__all__ = ['BufferCache', 'CachedDataProxy', 'buffer_cache', 'uncached']
+
+# By default, the buffers that are not in use by any viewer are discarded once
+# all the buffers in the cache use more than this much memory (in bytes).
+BUFFER_CACHE_MAX_BYTES = 1024 ** 3
+
+
+class BufferCache(object):
+    """
+    A thread-safe cache of arrays, using at most ``max_bytes`` bytes.
+
+    The first item of each key should identify the dataset that the array is
+    computed from, and the second item the values computed (e.g. an attribute
+    or a subset), so that the arrays for a dataset, or for some values of a
+    dataset, can be invalidated with `invalidate` once these have changed.
+
+    Each array is referenced by the owners that last requested it (an owner
+    only references the array it requested last). Arrays that are referenced
+    are never discarded, since these are still in use, and the other arrays
+    are discarded starting with the least recently used ones once the cache
+    uses more than ``max_bytes`` bytes. The numbers of ``hits`` and
+    ``misses`` are kept for diagnostics.
+    """
+
+    def __init__(self, max_bytes=BUFFER_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._arrays = OrderedDict()
+        self._owners = {}
+        self._owned = weakref.WeakKeyDictionary()
+        self._pending = {}
+        self._generations = {}
+
+    def __len__(self):
+        return len(self._arrays)
+
+    @property
+    def nbytes(self):
+        """
+        The number of bytes used by the arrays in the cache.
+        """
+        with self._lock:
+            return sum(array.nbytes for array in self._arrays.values())
+
+    def refcount(self, key):
+        """
+        Return the number of owners that reference the array for ``key``.
+        """
+        with self._lock:
+            return len(self._owners.get(self._full_key(key), ()))
+
+    def get(self, key, func, owner=None):
+        """
+        Return the array for ``key``, calling ``func()`` to compute it if it
+        isn't in the cache. If another thread is already computing the array
+        for the same key, we wait for it rather than computing it again. If
+        given, ``owner`` (which should support weak references) then
+        references the array.
+        """
+
+        while True:
+            with self._lock:
+                full_key = self._full_key(key)
+                if full_key in self._arrays:
+                    self.hits += 1
+                    self._arrays.move_to_end(full_key)
+                    self._reference(full_key, owner)
+                    return self._arrays[full_key]
+                pending = self._pending.get(full_key)
+                if pending is None:
+                    self.misses += 1
+                    pending = self._pending[full_key] = threading.Event()
+                    break
+            # If computing the array fails in the other thread, we compute it
+            # ourselves on the next iteration.
+            pending.wait()
+
+        try:
+            array = func()
+        finally:
+            with self._lock:
+                self._pending.pop(full_key).set()
+
+        with self._lock:
+            # If the data has been invalidated while we were computing the
+            # array, it may be out of date so we don't keep it.
+            if full_key == self._full_key(key):
+                self._arrays[full_key] = array
+                self._reference(full_key, owner)
+                self._evict()
+
+        return array
+
+    def release(self, owner):
+        """
+        Remove the reference from ``owner``, if any.
+        """
+        with self._lock:
+            self._reference(None, owner)
+            self._evict()
+
+    def invalidate(self, data_key, values_key=None):
+        """
+        Discard the arrays for the dataset identified by ``data_key``, as
+        well as the arrays currently being computed for it. If
+        ``values_key`` is given, only the arrays for these values of the
+        dataset are discarded.
+        """
+        with self._lock:
+            key = data_key if values_key is None else (data_key, values_key)
+            self._generations[key] = self._generations.get(key, 0) + 1
+            for full_key in list(self._arrays):
+                if full_key[2] == data_key and (values_key is None or
+                                                full_key[3] == values_key):
+                    self._arrays.pop(full_key)
+                    self._owners.pop(full_key, None)
+
+    def clear(self):
+        """
+        Remove all arrays from the cache and reset the counters.
+        """
+        with self._lock:
+            self._arrays.clear()
+            self._owners.clear()
+            self._owned.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """
+        Return a dictionary with the numbers of hits and misses, the number of
+        arrays in the cache and the memory these use.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self), 'nbytes': self.nbytes}
+
+    # The following methods should be called with the lock held
+
+    def _full_key(self, key):
+        key = tuple(key)
+        return (self._generations.get(key[0], 0), self._generations.get(key[:2], 0)) + key
+
+    def _reference(self, full_key, owner):
+        if owner is None:
+            return
+        previous = self._owned.get(owner)
+        if previous is not None and previous in self._owners:
+            self._owners[previous].discard(owner)
+        if full_key is None:
+            self._owned.pop(owner, None)
+        else:
+            self._owned[owner] = full_key
+            self._owners.setdefault(full_key, weakref.WeakSet()).add(owner)
+
+    def _evict(self):
+        nbytes = sum(array.nbytes for array in self._arrays.values())
+        for full_key in list(self._arrays):
+            if nbytes <= self.max_bytes:
+                break
+            if len(self._owners.get(full_key, ())) == 0:
+                nbytes -= self._arrays.pop(full_key).nbytes
+                self._owners.pop(full_key, None)
+
+
+# The cache shared by all volume viewers
+buffer_cache = BufferCache()
+
+
+class CachedDataProxy(DataProxy):
+    """
+    A DataProxy which gets the fixed resolution buffers from ``buffer_cache``
+    so that these are shared with the other viewers. Floating-point values
+    are kept with single precision, since the textures use single precision
+    at most.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    def _compute_buffer(self, bounds):
+        # The buffers are computed by glue with the id of the layer artist as
+        # the cache_id, and glue's caches aren't thread-safe, so we compute
+        # the buffers for each layer one at a time (e.g. for the texture and
+        # the bricks, which are prepared in different threads).
+        with self._lock:
+            return DataProxy.compute_fixed_resolution_buffer(self, bounds)
+
+    def _cache_key(self, bounds):
+
+        layer_artist = self.layer_artist
+        viewer_state = self.viewer_state
+
+        if layer_artist is None or viewer_state is None:
+            return None
+
+        layer = layer_artist.layer
+        if isinstance(layer, Subset):
+            # Subset states don't define equality, so the key changes
+            # whenever the subset state is replaced. Changes to the subset
+            # state itself are dealt with by invalidating the subset.
+            data, values = layer.data, (layer.uuid, layer.subset_state)
+        elif layer_artist.state.attribute is None:
+            return None
+        else:
+            data, values = layer, (layer_artist.state.attribute.uuid,)
+
+        return (data.uuid,) + values + (viewer_state.reference_data.uuid,
+                                        tuple(viewer_state.slices), viewer_state.x_att.axis,
+                                        viewer_state.y_att.axis, viewer_state.z_att.axis,
+                                        tuple(tuple(bound) for bound in bounds))
+
+    def compute_fixed_resolution_buffer(self, bounds=None):
+
+        try:
+            key = self._cache_key(bounds)
+        except AttributeError:
+            key = None
+
+        if key is None:
+            return self._compute_buffer(bounds)
+
+        computed = []
+
+        def compute():
+            values = self._compute_buffer(bounds)
+            computed.append(values)
+            # If the layer can't be shown (in which case the values are
+            # zero everywhere, with a stride of zero), we raise an exception
+            # so that the values aren't kept in the cache.
+            if all(stride == 0 for stride in np.asarray(values).strides):
+                raise _NotCached()
+            values = np.asarray(values)
+            if values.dtype.kind == 'f':
+                values = values.astype(np.float32, copy=False)
+            return values
+
+        try:
+            values = buffer_cache.get(key, compute, owner=self)
+        except _NotCached:
+            return computed[0]
+
+        # The layer artist is enabled when the values are computed, which
+        # might have been done by another viewer.
+        if not computed:
+            self.layer_artist.enable()
+
+        return values
+
+    @property
+    def uncached(self):
+        """
+        A version of this proxy which computes the fixed resolution buffers
+        without keeping them in ``buffer_cache``.
+        """
+        return _UncachedDataProxy(self)
+
+
+class _UncachedDataProxy(object):
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    @property
+    def shape(self):
+        return self.proxy.shape
+
+    def compute_fixed_resolution_buffer(self, bounds=None):
+        return self.proxy._compute_buffer(bounds)
+
+
+def uncached(data):
+    """
+    Return a version of ``data`` whose fixed resolution buffers aren't kept
+    in ``buffer_cache``, which should be used for requests that don't cover
+    the whole volume at full resolution, such as bricks or slabs.
+    """
+    if isinstance(data, CachedDataProxy):
+        return data.uncached
+    return data
+
+
+class _NotCached(Exception):
+    pass
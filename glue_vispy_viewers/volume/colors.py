@@ -1,58 +1,39 @@
-from glue.config import AsinhStretch, LinearStretch, LogStretch, SqrtStretch, DictRegistry
+import numpy as np
 from matplotlib.colors import ListedColormap
-from vispy.color import BaseColormap
+from vispy.color import get_colormap
 
+__all__ = ['LUT_SIZE', 'get_translucent_cmap', 'get_mpl_cmap', 'get_lut']
 
-class GLSLStretchRegistry(DictRegistry):
+# Colormaps are passed to the fragment shader as RGBA lookup tables (LUTs)
+# with this many entries. The stretch is baked into the LUT, so we use more
+# entries than the 256 colors of typical colormaps in order to still sample
+# steep stretches (e.g. log) accurately.
+LUT_SIZE = 1024
 
-    def add(self, stretch_cls, glsl):
-        self.members[stretch_cls] = glsl
 
+def lut_positions(n=LUT_SIZE):
+    """
+    Return the normalized values at which the LUT entries are defined.
+    """
+    return np.linspace(0., 1., n)
 
-stretch_glsl = GLSLStretchRegistry()
-stretch_glsl.add(LogStretch, "log({stretch.a} * {parameter} + 1.0) / log({stretch.a} + 1.0)")
-stretch_glsl.add(SqrtStretch, "sqrt({parameter})")
-stretch_glsl.add(AsinhStretch,
-                 "log({parameter} / {stretch.a} + sqrt(pow({parameter} / {stretch.a}, 2) + 1)) / "
-                 "log(1.0 / {stretch.a} + sqrt(pow(1.0 / {stretch.a}, 2) + 1))")
-stretch_glsl.add(LinearStretch, "{parameter}")
 
+def get_translucent_cmap(r, g, b, stretch, n=LUT_SIZE):
+    """
+    Return a LUT for a single color, with the opacity given by the stretched
+    value.
+    """
+    lut = np.empty((n, 4), dtype=np.float32)
+    lut[:, :3] = r, g, b
+    lut[:, 3] = stretch(lut_positions(n))
+    return lut
 
-def create_cmap_template(n, stretch_glsl):
-    ts = tuple((i + 1) / n for i in range(n-1))
-    lines = [
-        "vec4 translucent_colormap(float t) {",
-        f"    float s = {stretch_glsl};"
-    ]
-    for i, t in enumerate(ts):
-        lines.append(f"    if (s <= {t})")
-        lines.append(f"        {{ return $color_{i}; }}")
-    lines.append(f"    return $color_{n-1};")
-    lines.append("}")
 
-    return "\n".join(lines)
-
-
-def glsl_for_stretch(stretch, parameter="t"):
-    template = stretch_glsl.members.get(type(stretch), "{param}")
-    return template.format(stretch=stretch, parameter=parameter)
-
-
-def get_translucent_cmap(r, g, b, stretch):
-
-    func = glsl_for_stretch(stretch)
-
-    class TranslucentCmap(BaseColormap):
-        glsl_map = """
-        vec4 translucent_fire(float t) {{
-            return vec4({0}, {1}, {2}, {3});
-        }}
-        """.format(r, g, b, func)
-
-    return TranslucentCmap()
-
-
-def get_mpl_cmap(cmap, stretch):
+def get_mpl_cmap(cmap, stretch, n=LUT_SIZE):
+    """
+    Return a LUT for a Matplotlib colormap, with the opacity given by the
+    stretched value.
+    """
 
     if isinstance(cmap, ListedColormap):
         colors = cmap.colors
@@ -64,10 +45,33 @@ def get_mpl_cmap(cmap, stretch):
         ts = stretch([index / n_colors for index in range(n_colors)])
         colors = [[*cmap(t)[:3], t] for t in ts]
 
-    stretch_glsl = glsl_for_stretch(stretch)
-    template = create_cmap_template(n_colors, stretch_glsl)
+    colors = np.asarray(colors, dtype=np.float32)
+
+    # Color i is used for stretched values in the interval (i/n, (i+1)/n]
+    thresholds = np.arange(1, n_colors) / n_colors
+    indices = np.searchsorted(thresholds, stretch(lut_positions(n)), side='left')
+
+    return colors[indices]
+
+
+def get_lut(cmap, n=LUT_SIZE):
+    """
+    Convert ``cmap`` to a ``(n, 4)`` float32 LUT.
+
+    ``cmap`` can be an existing LUT, in which case it is resampled if needed,
+    or a VisPy colormap or colormap name.
+    """
+
+    if isinstance(cmap, np.ndarray):
+        lut = cmap
+    else:
+        lut = get_colormap(cmap).map(lut_positions(n))
+
+    lut = np.asarray(lut, dtype=np.float32)
 
-    class MatplotlibCmap(BaseColormap):
-        glsl_map = template
+    if lut.shape[0] != n:
+        x = lut_positions(lut.shape[0])
+        lut = np.stack([np.interp(lut_positions(n), x, lut[:, i])
+                        for i in range(4)], axis=-1).astype(np.float32)
 
-    return MatplotlibCmap(colors=colors)
+    return lut
@@ -31,6 +31,11 @@ class Volume3DLayerStateWidget(v.VuetifyTemplate):
     stretch_items = traitlets.List().tag(sync=True)
     stretch_selected = traitlets.Int(allow_none=True).tag(sync=True)
 
+    # Precision
+
+    precision_items = traitlets.List().tag(sync=True)
+    precision_selected = traitlets.Int(allow_none=True).tag(sync=True)
+
     subset = traitlets.Bool().tag(sync=True)
 
     def __init__(self, layer_state):
@@ -45,6 +50,10 @@ class Volume3DLayerStateWidget(v.VuetifyTemplate):
         link_glue_choices(self, layer_state, "stretch")
         link_glue_choices(self, layer_state, "color_mode")
 
+        # Layer states from older sessions don't have the precision property
+        if hasattr(layer_state, "precision"):
+            link_glue_choices(self, layer_state, "precision")
+
         self.cmap_items = [
             {"text": cmap[0], "value": cmap[1].name} for cmap in colormaps.members
         ]
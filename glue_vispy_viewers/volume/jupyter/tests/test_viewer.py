@@ -14,6 +14,36 @@ def test_basic_jupyter_volume():
     viewer.cleanup()
 
 
+def test_jupyter_auto_resolution():
+    # The resolution is chosen again once zooming or panning has settled
+    app = jglue()
+    data = Data(x=np.arange(24).reshape((2, 3, 4)), label="cube data")
+    app.add_data(data)
+    viewer = app.new_data_viewer(JupyterVispyVolumeViewer, data=data)
+    viewer.state.resolution = 'auto'
+    multivol = viewer._vispy_widget._multivol
+    resolution = multivol.resolution
+    viewer._vispy_widget.view.camera.scale_factor /= 4
+    viewer._stop_interaction()
+    assert multivol.resolution > resolution
+    viewer.cleanup()
+
+
+def test_jupyter_status():
+    # The status is shown below the canvas, e.g. while the textures are
+    # being updated
+    app = jglue()
+    data = Data(x=np.arange(24).reshape((2, 3, 4)), label="cube data")
+    app.add_data(data)
+    viewer = app.new_data_viewer(JupyterVispyVolumeViewer, data=data)
+    multivol = viewer._vispy_widget._multivol
+    multivol.events.pending(pending=True)
+    assert viewer._status.value == 'Updating volume rendering...'
+    multivol.events.pending(pending=False)
+    assert viewer._status.value == ''
+    viewer.cleanup()
+
+
 def test_jupyter_layer_widgets():
     app = jglue()
     volume_data = Data(x=np.arange(24).reshape((2, 3, 4)), label="cube data")
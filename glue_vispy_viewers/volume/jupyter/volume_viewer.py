@@ -1,5 +1,6 @@
 import os
 
+from ipywidgets import Label, VBox, Widget
 from glue_jupyter.view import IPyWidgetView
 
 from ...scatter.layer_artist import ScatterLayerArtist
@@ -24,10 +25,21 @@ class JupyterVispyVolumeViewer(VispyVolumeViewerMixin, IPyWidgetView):
         # Vispy and jupyter_rfb don't work correctly on Linux unless DISPLAY is set
         if 'DISPLAY' not in os.environ:
             os.environ['DISPLAY'] = ':0'
+        # Status messages, e.g. while the textures are being updated, are
+        # shown below the canvas.
+        self._status = Label()
         super().__init__(*args, **kwargs)
         self.setup_widget_and_callbacks()
+        # The canvas is only a widget with the jupyter_rfb backend
+        self._figure_widget = self._vispy_widget.canvas._backend
+        if isinstance(self._figure_widget, Widget):
+            self._figure_widget = VBox([self._figure_widget, self._status])
         self.create_layout()
+        self._vispy_widget.canvas.events.resize.connect(self._update_auto_resolution)
 
     @property
     def figure_widget(self):
-        return self._vispy_widget.canvas._backend
+        return self._figure_widget
+
+    def show_status(self, text):
+        self._status.value = text
@@ -1,13 +1,15 @@
 import uuid
+import warnings
 
 from matplotlib.colors import ColorConverter
 
 from glue.core.data import Subset, Data
 from glue.core.fixed_resolution_buffer import ARRAY_CACHE, PIXEL_CACHE
-from glue.viewers.volume3d.data_proxy import DataProxy
-from glue.viewers.volume3d.layer_state import VolumeLayerState3D
 
+from .buffer_cache import CachedDataProxy, buffer_cache
 from .colors import get_mpl_cmap, get_translucent_cmap
+from .state import VispyVolumeLayerState
+from .volume_visual import NoFreeSlotsError
 from ..common.layer_artist import VispyLayerArtist
 
 
@@ -23,7 +25,7 @@ class VolumeLayerArtist(VispyLayerArtist):
     each data viewer.
     """
 
-    _layer_state_cls = VolumeLayerState3D
+    _layer_state_cls = VispyVolumeLayerState
 
     def __init__(self, vispy_viewer=None, layer=None, layer_state=None):
 
@@ -39,8 +41,15 @@ class VolumeLayerArtist(VispyLayerArtist):
         # unique.
         self.id = str(uuid.uuid4())
 
+        # The masks for subsets of the same dataset are packed into a single
+        # texture, so we group them by dataset.
+        if isinstance(self.layer, Subset):
+            group = self.layer.data.uuid
+        else:
+            group = None
+
         self._multivol = self.vispy_widget._multivol
-        self._multivol.allocate(self.id)
+        self._multivol.allocate(self.id, group=group)
 
         self._viewer_state.add_global_callback(self._update_volume)
         self.state.add_global_callback(self._update_volume)
@@ -67,6 +76,17 @@ class VolumeLayerArtist(VispyLayerArtist):
         """
         self.vispy_widget.canvas.update()
 
+    # The data proxy enables and disables the layer artist while computing
+    # the fixed resolution buffer, which can happen in a worker thread, so we
+    # make sure that any resulting messages and UI changes happen in the main
+    # thread.
+
+    def enable(self):
+        self._multivol.call_in_main_thread(super().enable)
+
+    def disable(self, reason):
+        self._multivol.call_in_main_thread(super().disable, reason)
+
     def clear(self):
         """
         Remove the layer artist from the visualization
@@ -85,6 +105,8 @@ class VolumeLayerArtist(VispyLayerArtist):
         self._multivol.deallocate(self.id)
         ARRAY_CACHE.pop(self.id, None)
         PIXEL_CACHE.pop(self.id, None)
+        if self._data_proxy is not None:
+            buffer_cache.release(self._data_proxy)
 
     def _update_cmap(self):
         if self.state.color_mode == "Fixed":
@@ -115,10 +137,16 @@ class VolumeLayerArtist(VispyLayerArtist):
             self._multivol.set_multiply(self.id, label)
         self.redraw()
 
+    def _update_precision(self):
+        # Layer states from older sessions don't have the precision property
+        self._multivol.set_precision(self.id, getattr(self.state, 'precision', 'float32'))
+
     def _update_data(self):
 
         if self._data_proxy is None:
-            self._data_proxy = DataProxy(self._viewer_state, self)
+            # The fixed resolution buffers are shared with other viewers
+            # showing the same data with the same bounds.
+            self._data_proxy = CachedDataProxy(self._viewer_state, self)
             self._multivol.set_data(self.id, self._data_proxy, layer=self.layer)
         else:
             self._multivol._update_scaled_data(self.id)
@@ -127,7 +155,15 @@ class VolumeLayerArtist(VispyLayerArtist):
 
     def _update_visibility(self):
         if self.state.visible:
-            self._multivol.enable(self.id)
+            try:
+                self._multivol.enable(self.id)
+            except NoFreeSlotsError as exc:
+                # Only a limited number of textures can be sampled at once,
+                # so we hide the layer again if it can't be shown. We don't
+                # raise the error since this is called from a callback.
+                self.state.visible = False
+                warnings.warn(str(exc))
+                return
         else:
             self._multivol.disable(self.id)
         self.redraw()
@@ -151,6 +187,9 @@ class VolumeLayerArtist(VispyLayerArtist):
         if force or 'alpha' in changed:
             self._update_alpha()
 
+        if force or 'precision' in changed:
+            self._update_precision()
+
         # TODO: Feel like we shouldn't need the axis atts here
         if force or any(att in changed for att in
                         ('layer', 'attribute', 'slices', 'x_att', 'y_att', 'z_att')):
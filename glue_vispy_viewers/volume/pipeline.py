@@ -0,0 +1,311 @@
+# This file implements a small job pipeline that is used by MultiVolumeVisual
+# to prepare volume textures in background threads. The expensive part of
+# updating a volume layer (computing the fixed resolution buffer and converting
+# it to chunks ready for OpenGL) is done in a thread pool, and only the
+# finished chunks are handed back to the main thread through a ChunkQueue,
+# where the actual upload to the GPU has to happen.
+
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+__all__ = ['ChunkQueue', 'JobCancelled', 'TextureJob', 'TexturePipeline', 'is_main_thread',
+           'map_chunks']
+
+# The executor is shared between all viewers in a session - the jobs are
+# mostly limited by memory bandwidth so there is no point in having more
+# threads than this even with many viewers open.
+MAX_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+# The chunks of a texture are processed in parallel in a separate thread pool
+# (see map_chunks), since the jobs already run in the pool above and waiting
+# for tasks submitted to the same pool could deadlock.
+CHUNK_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+# The number of items per worker that map_chunks processes ahead of the
+# results that have been consumed.
+CHUNK_LOOKAHEAD = 2
+
+# How often (in seconds) threads that wait for a ChunkQueue check whether the
+# job has been cancelled.
+QUEUE_TIMEOUT = 0.05
+
+_EXECUTORS = {}
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_executor(name='texture'):
+    """
+    Return the thread pool shared by all texture pipelines, or with
+    ``name='chunks'`` the one used to process chunks in parallel.
+    """
+    with _EXECUTOR_LOCK:
+        if name not in _EXECUTORS:
+            workers = CHUNK_WORKERS if name == 'chunks' else MAX_WORKERS
+            _EXECUTORS[name] = ThreadPoolExecutor(max_workers=workers,
+                                                  thread_name_prefix='glue-vispy-' + name)
+        return _EXECUTORS[name]
+
+
+def map_chunks(job, func, items):
+    """
+    Iterate over ``func(item)`` for each item, in the same order as
+    ``items``, computing the results in parallel in a thread pool shared by
+    all pipelines. This is meant for functions that mostly spend their time
+    in Numpy operations that release the GIL. ``job`` can be `None` or a
+    `TextureJob` that is checked for cancellation before each item.
+
+    The items are only processed a few at a time ahead of the results that
+    have been consumed, so that only a few results exist at once.
+    """
+
+    def run(item):
+        if job is not None:
+            job.check()
+        return func(item)
+
+    if CHUNK_WORKERS == 1:
+        for item in items:
+            yield run(item)
+        return
+
+    executor = get_executor('chunks')
+    futures = deque()
+    try:
+        for item in items:
+            futures.append(executor.submit(run, item))
+            if len(futures) > CHUNK_WORKERS * CHUNK_LOOKAHEAD:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        # If one of the items failed (e.g. because the job was cancelled) or
+        # the results are no longer needed, we don't process the remaining
+        # ones.
+        for future in futures:
+            future.cancel()
+
+
+def is_main_thread():
+    return threading.current_thread() is threading.main_thread()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class TextureJob(object):
+    """
+    A single texture preparation job for a given label.
+
+    Job functions receive the job as their first argument and should call
+    :meth:`check` regularly (e.g. once per chunk) so that stale jobs stop as
+    soon as possible once they have been cancelled. Jobs can also hand back
+    their result before they finish with :meth:`publish`.
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.future = None
+        self.published = False
+        self.delivered = False
+        self.result = None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def publish(self, result):
+        """
+        Hand back ``result`` the next time the pipeline is polled, even though
+        the job is still running. This is used to stream the results of a job
+        through a `ChunkQueue` while they are being computed.
+        """
+        self.result = result
+        self.published = True
+
+    def wait(self):
+        # Note that we deliberately don't call future.result() here since
+        # re-raising the JobCancelled exception would attach the frames of the
+        # caller to the traceback stored in the future, keeping e.g. viewers
+        # alive for longer than needed.
+        if self.future is not None:
+            wait([self.future])
+
+
+class ChunkQueue(object):
+    """
+    A bounded queue through which a job hands chunks to the main thread as
+    soon as they are ready.
+
+    The job calls :meth:`put` for each chunk and :meth:`close` once all of
+    them have been added, and blocks while the queue is full, so that only a
+    few chunks exist at once. The main thread collects the chunks that are
+    ready without waiting with :meth:`get_ready`, or iterates over the queue,
+    which waits for each chunk.
+    """
+
+    _end = object()
+
+    def __init__(self, job, maxsize=None):
+        self.job = job
+        if maxsize is None:
+            maxsize = CHUNK_WORKERS * CHUNK_LOOKAHEAD
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.finished = False
+
+    def put(self, item):
+        while True:
+            self.job.check()
+            try:
+                self._queue.put(item, timeout=QUEUE_TIMEOUT)
+            except queue.Full:
+                continue
+            return
+
+    def close(self):
+        self.put(self._end)
+
+    @property
+    def failed(self):
+        """
+        Whether the job was cancelled or stopped before adding all the chunks.
+        """
+        if self.job.cancelled:
+            return True
+        return (not self.finished and self.job.future is not None and
+                self.job.future.done() and self._queue.empty())
+
+    def get_ready(self):
+        """
+        Return a list of the chunks that are ready, without waiting.
+        """
+        items = []
+        while not self.finished:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is self._end:
+                self.finished = True
+            else:
+                items.append(item)
+        return items
+
+    def __iter__(self):
+        while not self.finished:
+            try:
+                item = self._queue.get(timeout=QUEUE_TIMEOUT)
+            except queue.Empty:
+                if self.failed:
+                    raise JobCancelled()
+                continue
+            if item is self._end:
+                self.finished = True
+            else:
+                yield item
+
+
+class TexturePipeline(object):
+    """
+    Run texture preparation jobs off the main thread.
+
+    There is at most one active job per label - submitting a new job for a
+    label cancels any job that is still pending for it. Finished jobs are
+    collected with :meth:`poll`, which should be called from the main thread.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._cancelled_jobs = []
+        self._main_thread_calls = deque()
+
+    def submit(self, label, func, *args):
+        self.cancel(label)
+        job = TextureJob(label)
+        job.future = get_executor().submit(self._run, job, func, args)
+        self._jobs[label] = job
+        return job
+
+    @staticmethod
+    def _run(job, func, args):
+        job.check()
+        return func(job, *args)
+
+    def cancel(self, label, wait=False):
+        job = self._jobs.pop(label, None)
+        if job is not None:
+            job.cancel()
+            # Cancelled jobs might still be running until they next check
+            # whether they have been cancelled, so we keep track of them in
+            # case we need to wait for them later.
+            self._cancelled_jobs.append(job)
+        self._cancelled_jobs = [job for job in self._cancelled_jobs
+                                if not job.future.done()]
+        if wait:
+            for job in self._cancelled_jobs:
+                if job.label == label:
+                    job.wait()
+
+    def cancel_all(self, wait=False):
+        for label in list(self._jobs):
+            self.cancel(label, wait=wait)
+
+    def call_in_main_thread(self, func, *args):
+        """
+        Call ``func`` straight away if we are in the main thread, otherwise
+        queue it up to be called the next time :meth:`poll` is called.
+        """
+        if is_main_thread():
+            func(*args)
+        else:
+            self._main_thread_calls.append((func, args))
+
+    @property
+    def pending(self):
+        return len(self._jobs) > 0
+
+    def is_pending(self, label):
+        return label in self._jobs
+
+    def poll(self):
+        """
+        Return a list of ``(label, result)`` tuples for all jobs that have
+        completed or published their result since the last call. Exceptions
+        raised in a job are re-raised here.
+        """
+
+        while self._main_thread_calls:
+            func, args = self._main_thread_calls.popleft()
+            func(*args)
+
+        results = []
+        for label, job in list(self._jobs.items()):
+            if not job.future.done():
+                if job.published and not job.delivered:
+                    job.delivered = True
+                    results.append((label, job.result))
+                continue
+            self._jobs.pop(label)
+            if job.future.cancelled():
+                continue
+            exc = job.future.exception()
+            if isinstance(exc, JobCancelled):
+                continue
+            elif exc is not None:
+                raise exc
+            if not job.delivered:
+                results.append((label, job.future.result()))
+        return results
@@ -0,0 +1,218 @@
+# This file implements a multi-resolution cache of the values of a layer,
+# which is used by MultiVolumeVisual to update the textures when zooming or
+# panning without computing the fixed resolution buffer again. The pyramid is
+# built once in the background, and then resampled for the new bounds, which
+# is much cheaper than going through the data (and any links or subset
+# states) again. Like mipmaps, each level combines blocks of values of the
+# previous level, so that structures smaller than a value of the level don't
+# disappear or flicker when zooming.
+
+import numpy as np
+
+__all__ = ['Pyramid', 'pyramid_stride', 'reduce_blocks', 'build_pyramid']
+
+# The maximum number of values in the finest level of a pyramid. If the data
+# has more values than this, each value of the finest level is computed from
+# a block of two (or four, and so on) pixels along each axis.
+PYRAMID_MAX_SIZE = 2 ** 24
+
+# The ways in which the values in each block of pixels can be combined into
+# the value of a coarser level - ``'mean'`` averages the values, ignoring NaN
+# values, and ``'max'`` keeps the maximum value, which is what is shown when
+# rendering the maximum intensity along each ray and makes sure that thin
+# structures (or subsets) don't disappear at coarse levels.
+REDUCTIONS = ['mean', 'max']
+
+
+def pyramid_stride(shape, max_size=PYRAMID_MAX_SIZE):
+    """
+    Return the smallest power of two such that reducing blocks of ``stride``
+    values along each axis of an array with the given ``shape`` gives at most
+    ``max_size`` values.
+    """
+    stride = 1
+    while np.prod([np.ceil(n / stride) for n in shape]) > max_size:
+        stride *= 2
+    return stride
+
+
+def reduce_blocks(values, factor, reduction='mean', counts=None):
+    """
+    Reduce ``values`` over blocks of ``factor`` values along each axis, where
+    the last block along each axis can be smaller.
+
+    For the ``'mean'`` reduction, ``counts`` gives the number of pixels that
+    each value is the mean of (by default, one for each value that isn't
+    NaN), so that the result is the mean of all the pixels in each block
+    regardless of how many there are. Returns the reduced values and the
+    number of pixels that each of these is the mean of (or `None` for the
+    ``'max'`` reduction).
+    """
+
+    if reduction not in REDUCTIONS:
+        raise ValueError("reduction should be one of {0}".format(REDUCTIONS))
+
+    starts = [np.arange(0, n, factor) for n in values.shape]
+
+    if reduction == 'max':
+        for axis, indices in enumerate(starts):
+            values = np.fmax.reduceat(values, indices, axis=axis)
+        return values, None
+
+    values = np.asarray(values, dtype=np.float32)
+    if counts is None:
+        counts = (~np.isnan(values)).astype(np.float32)
+    sums = np.where(counts > 0, values, 0) * counts
+    for axis, indices in enumerate(starts):
+        sums = np.add.reduceat(sums, indices, axis=axis)
+        counts = np.add.reduceat(counts, indices, axis=axis)
+
+    # Blocks without any valid values are NaN
+    with np.errstate(invalid='ignore'):
+        return sums / counts, counts
+
+
+def build_pyramid(job, data, shape, max_size=PYRAMID_MAX_SIZE, reduction='mean'):
+    """
+    Compute the pyramid for ``data``, which should have the given ``shape``
+    in the pixel grid of the reference data, combining the values in each
+    block of pixels using ``reduction`` (see `reduce_blocks`). Returns `None`
+    if the data doesn't have the expected shape.
+
+    Like `~glue_vispy_viewers.volume.volume_visual.prepare_chunks`, this can
+    be called from a worker thread.
+    """
+
+    if len(shape) != 3 or min(shape) == 0:
+        return None
+
+    stride = pyramid_stride(shape, max_size=max_size)
+
+    # If the finest level can't contain all the pixels, we compute it from
+    # slabs of pixels along the first axis, each with at most about
+    # ``max_size`` pixels, so that we never need all the pixels at once.
+    rows = max(1, max_size // (stride * shape[1] * shape[2])) * stride
+
+    levels, counts, fill = [], [], 0
+
+    for start in range(0, shape[0], rows):
+
+        if job is not None:
+            job.check()
+
+        stop = min(start + rows, shape[0])
+        bounds = [(start, stop - 1, stop - start), (0, shape[1] - 1, shape[1]),
+                  (0, shape[2] - 1, shape[2])]
+
+        values = np.asarray(data.compute_fixed_resolution_buffer(bounds))
+
+        if values.shape != tuple(bound[2] for bound in bounds):
+            return None
+
+        # Textures are stored with single precision at most, so there is no
+        # point keeping more than that.
+        if values.dtype.kind == 'f':
+            values = values.astype(np.float32, copy=False)
+            fill = np.nan
+
+        if stride > 1:
+            values, slab_counts = reduce_blocks(values, stride, reduction)
+            counts.append(slab_counts)
+
+        levels.append(values)
+
+    if job is not None:
+        job.check()
+
+    values = levels[0] if len(levels) == 1 else np.concatenate(levels)
+    if reduction == 'max' or stride == 1:
+        counts = None
+    else:
+        counts = counts[0] if len(counts) == 1 else np.concatenate(counts)
+
+    return Pyramid(values, stride, shape, reduction=reduction, counts=counts, fill=fill)
+
+
+class Pyramid(object):
+    """
+    A multi-resolution version of the values of a layer on the pixel grid of
+    the reference data, which has the given ``shape``.
+
+    ``values`` should contain the values of the layer combined over blocks of
+    ``stride`` pixels along each axis using ``reduction`` (see
+    `reduce_blocks`), starting from the first pixel. For the ``'mean'``
+    reduction, ``counts`` can give the number of valid pixels in each block.
+    ``fill`` is the value to use outside of the data, which by default is NaN
+    for floating-point values and zero otherwise, as for the fixed resolution
+    buffers of the data. This is the finest level of the pyramid, and each of
+    the other levels combines blocks of two values of the previous level along
+    each axis in the same way.
+
+    The pyramid has a ``compute_fixed_resolution_buffer`` method, so it can
+    be used in place of the data when computing textures for bounds that
+    `can_resample` returns `True` for.
+    """
+
+    def __init__(self, values, stride, shape, reduction='mean', counts=None, fill=None):
+        self.shape = tuple(shape)
+        self.reduction = reduction
+        if fill is None:
+            fill = np.nan if values.dtype.kind == 'f' else 0
+        self.fill = fill
+        self.levels = [(stride, values)]
+        while max(values.shape) > 1:
+            values, counts = reduce_blocks(values, 2, reduction, counts=counts)
+            stride *= 2
+            self.levels.append((stride, values))
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for _, values in self.levels)
+
+    def level(self, bounds):
+        """
+        Return the ``(stride, values)`` of the coarsest level of the pyramid
+        that has at least the resolution of ``bounds``, or `None` if even the
+        finest level is too coarse. If the finest level contains all the
+        values of the layer, it can always be used.
+        """
+        spacing = min([(vmax - vmin) / (n - 1) for vmin, vmax, n in bounds if n > 1] or [np.inf])
+        for stride, values in self.levels[::-1]:
+            if stride <= spacing * (1 + 1e-6):
+                return stride, values
+        if self.levels[0][0] == 1:
+            return self.levels[0]
+        return None
+
+    def can_resample(self, bounds):
+        return self.level(bounds) is not None
+
+    def compute_fixed_resolution_buffer(self, bounds):
+        """
+        Resample the pyramid for ``bounds``, in the same way as the fixed
+        resolution buffer is computed for the data - each value is taken from
+        the nearest pixel of the level, the pixels of coarser levels being at
+        the centres of the blocks that these cover, and values outside of the
+        data are NaN (or zero for integer and boolean values).
+        """
+
+        stride, values = self.level(bounds)
+
+        indices, valid = [], []
+        for (vmin, vmax, n), size, nlevel in zip(bounds, self.shape, values.shape):
+            positions = np.linspace(vmin, vmax, n)
+            pixels = np.round(positions)
+            valid.append((pixels >= 0) & (pixels < size))
+            centres = (positions - (stride - 1) / 2) / stride
+            indices.append(np.clip(np.round(centres).astype(int), 0, nlevel - 1))
+
+        result = values[np.ix_(*indices)]
+
+        invalid = ~(valid[0][:, np.newaxis, np.newaxis] &
+                    valid[1][np.newaxis, :, np.newaxis] &
+                    valid[2][np.newaxis, np.newaxis, :])
+
+        if invalid.any():
+            result[invalid] = self.fill
+
+        return result
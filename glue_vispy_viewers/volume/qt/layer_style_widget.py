@@ -46,17 +46,43 @@ class VolumeLayerStyleWidget(QtWidgets.QWidget):
             self.ui.label_limits.hide()
             self.ui.label_color_mode.hide()
             self.ui.combotext_color_mode.hide()
+            # Subsets are always stored as bits so the precision doesn't apply
+            self.ui.label_precision.hide()
+            self.ui.combosel_precision.hide()
         else:
             self.ui.radio_subset_outline.hide()
             self.ui.radio_subset_data.hide()
             self.ui.label_subset_mode.hide()
 
+        # Show how much GPU memory the layer uses - the texture is updated
+        # asynchronously so we listen for the visual to tell us about it.
+        if hasattr(self.state, 'precision'):
+            self.layer_artist.visual.events.upload.connect((self, '_update_memory'))
+            self._update_memory()
+        else:
+            self.ui.label_precision.hide()
+            self.ui.combosel_precision.hide()
+            self.ui.label_memory.hide()
+
     def _update_subset_mode(self):
         if self.ui.radio_subset_outline.isChecked():
             self.state.subset_mode = 'outline'
         else:
             self.state.subset_mode = 'data'
 
+    def _update_memory(self, event=None):
+        if event is not None and event.label != self.layer_artist.id:
+            return
+        nbytes, nbytes_full = self.layer_artist.visual.texture_memory(self.layer_artist.id)
+        if nbytes == 0:
+            text = ''
+        elif nbytes < nbytes_full:
+            text = '{0:.1f} MB ({1:.1f} MB saved)'.format(nbytes / 1024 ** 2,
+                                                          (nbytes_full - nbytes) / 1024 ** 2)
+        else:
+            text = '{0:.1f} MB'.format(nbytes / 1024 ** 2)
+        self.ui.label_memory.setText(text)
+
     def _update_color_mode(self, *args):
         fixed_color = self.state.color_mode == "Fixed"
         if fixed_color:
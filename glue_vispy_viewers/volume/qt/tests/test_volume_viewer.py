@@ -1,4 +1,5 @@
 import sys
+import time
 import pytest
 import numpy as np
 from string import ascii_lowercase
@@ -6,11 +7,18 @@ from string import ascii_lowercase
 from glue.config import colormaps
 from glue.core import DataCollection, Data
 from glue_qt.app.application import GlueApplication
+from glue_qt.utils import process_events
 from glue.core.component import Component
 from glue.core.link_helpers import LinkSame
+from glue.core.subset import RangeSubsetState
+from glue.viewers.volume3d.data_proxy import DataProxy
 
-from ...layer_artist import DataProxy
+from ...buffer_cache import buffer_cache
+from ....common.gpu_memory import gpu_memory
+from ...shaders import MAX_SAMPLED_TEXTURES
+from ..layer_style_widget import VolumeLayerStyleWidget
 from ..volume_viewer import VispyVolumeViewer
+from ...volume_viewer import AUTO_MEMORY_BUDGET, auto_resolution
 
 IS_WIN = sys.platform == 'win32'
 
@@ -70,6 +78,7 @@ def test_volume_viewer(tmpdir):
     layer_state.color = "#ff0000"
     layer_state.cmap = colormaps['Red-Blue']
     layer_state.color_mode = "Fixed"
+    layer_state.precision = "uint16"
 
     # Check that writing a session works as expected.
 
@@ -111,6 +120,7 @@ def test_volume_viewer(tmpdir):
     assert layer_state.color == "#ff0000"
     assert layer_state.cmap == colormaps['Red-Blue']
     assert layer_state.color_mode == "Fixed"
+    assert layer_state.precision == "uint16"
 
     ga2.close()
 
@@ -429,3 +439,396 @@ def test_data_proxy_shape():
     assert proxy2.shape == (6, 7, 3)
 
     ga.close()
+
+
+@pytest.mark.skipif('IS_WIN', reason='Windows fatal exception: access violation')
+def test_background_texture_update():
+
+    # Make sure that textures prepared in the background are picked up and
+    # that the pending state is shown in the status bar while waiting.
+
+    data = make_test_data()
+
+    dc = DataCollection([data])
+    ga = GlueApplication(dc)
+    ga.show()
+
+    volume = ga.new_data_viewer(VispyVolumeViewer)
+    volume.add_data(data)
+
+    multivol = volume._vispy_widget._multivol
+
+    assert multivol.pending
+    assert volume.statusBar().currentMessage() == 'Updating volume rendering...'
+
+    start = time.time()
+    while multivol.pending and time.time() - start < 10:
+        process_events(wait=0.01)
+
+    assert not multivol.pending
+    assert volume.statusBar().currentMessage() == ''
+
+    ga.close()
+
+
+def test_texture_precision():
+
+    data = make_test_data()
+
+    dc = DataCollection([data])
+    ga = GlueApplication(dc)
+    ga.show()
+
+    volume = ga.new_data_viewer(VispyVolumeViewer)
+    volume.add_data(data)
+
+    multivol = volume._vispy_widget._multivol
+    layer_artist = volume.layers[0]
+
+    def wait_for_textures():
+        start = time.time()
+        while multivol.pending and time.time() - start < 10:
+            process_events(wait=0.01)
+
+    wait_for_textures()
+
+    assert layer_artist.state.precision == 'float32'
+
+    size = np.prod(multivol.volumes[layer_artist.id]['texture_shape'])
+    assert multivol.texture_memory(layer_artist.id) == (size * 4, size * 4)
+
+    widget = VolumeLayerStyleWidget(layer_artist)
+    assert widget.ui.combosel_precision.currentText() == '32-bit float'
+    assert widget.ui.label_memory.text() == '{0:.1f} MB'.format(size * 4 / 1024 ** 2)
+
+    layer_artist.state.precision = 'uint8'
+    wait_for_textures()
+
+    assert multivol.volumes[layer_artist.id]['vrange'] is not None
+    assert multivol.texture_memory(layer_artist.id) == (size, size * 4)
+    assert widget.ui.combosel_precision.currentText() == '8-bit'
+    assert widget.ui.label_memory.text() == '{0:.1f} MB ({1:.1f} MB saved)'.format(
+        size / 1024 ** 2, size * 3 / 1024 ** 2)
+
+    ga.close()
+
+
+def test_auto_resolution_value():
+    assert auto_resolution(400) == 416
+    assert auto_resolution(416) == 416
+    assert auto_resolution(1) == 32
+    assert auto_resolution(10000) == 2048
+
+
+def test_auto_resolution(tmpdir):
+
+    data = make_test_data(dimensions=(20, 400, 400))
+
+    dc = DataCollection([data])
+    ga = GlueApplication(dc)
+    ga.show()
+
+    volume = ga.new_data_viewer(VispyVolumeViewer)
+    volume.add_data(data)
+    volume.viewer_size = (300, 300)
+    process_events()
+
+    multivol = volume._vispy_widget._multivol
+
+    assert volume.state.resolution == 256
+    assert multivol._vol_shape == (20, 256, 256)
+
+    # The resolution follows the size of the volume on the screen
+    volume.state.resolution = 'auto'
+    resolution, voxel_budget = volume._auto_resolution()
+    assert resolution < 2048
+    assert multivol.resolution == resolution
+    assert multivol.voxel_budget == voxel_budget
+    assert multivol._vol_shape == (20, resolution, resolution)
+
+    # The voxel budget only depends on the layers and their precisions, not on
+    # the textures currently allocated.
+    assert voxel_budget == AUTO_MEMORY_BUDGET // 8
+    volume.layers[0].state.precision = 'uint8'
+    assert volume._auto_resolution()[1] == AUTO_MEMORY_BUDGET // 2
+
+    # The resolution is chosen again once an interaction has finished
+    volume._vispy_widget.view.camera.scale_factor /= 4
+    volume._stop_interaction()
+    assert multivol.resolution > resolution
+
+    # Sessions with the automatic resolution can be restored
+    session_file = tmpdir.join('test_auto_resolution.glu').strpath
+    ga.save_session(session_file)
+    ga.close()
+
+    ga2 = GlueApplication.restore_session(session_file)
+    ga2.show()
+    assert ga2.viewers[0][0].state.resolution == 'auto'
+    ga2.close()
+
+
+def test_interactive_downsampling(monkeypatch):
+
+    data = make_test_data(dimensions=(40, 80, 80))
+
+    dc = DataCollection([data])
+    ga = GlueApplication(dc)
+    ga.show()
+
+    volume = ga.new_data_viewer(VispyVolumeViewer)
+    volume.add_data(data)
+    process_events()
+
+    multivol = volume._vispy_widget._multivol
+
+    def slow_draw(duration):
+        volume._on_draw_start()
+        volume._draw_start -= duration
+        volume._on_draw_end()
+
+    # While interacting, we wait for the GPU to finish drawing each frame so
+    # that the frame time isn't just the time taken to submit the commands.
+    finished = []
+    monkeypatch.setattr(volume._vispy_widget.canvas.context, 'finish',
+                        lambda: finished.append(True))
+
+    # Slow frames while interacting lower the level of detail
+    volume.mouse_press()
+    slow_draw(1.)
+    assert volume._governor.level == 2
+    assert multivol.shared_program['u_downsample'] == 2
+    assert len(finished) == 1
+
+    # Bricks aren't loaded while interacting
+    assert multivol._interacting
+
+    # The level of detail can't go lower than about 20 steps across the
+    # shortest axis of the volume
+    for i in range(5):
+        slow_draw(1.)
+    assert multivol.shared_program['u_downsample'] == 2.
+
+    # Full quality is restored once the interaction has finished, and we
+    # no longer wait for the GPU after each frame.
+    volume.mouse_release()
+    assert multivol.shared_program['u_downsample'] == 1
+    assert not multivol._interacting
+    del finished[:]
+    slow_draw(1.)
+    assert len(finished) == 0
+
+    # Frame times are ignored if downsampling is disabled
+    volume.state.downsample = False
+    volume.mouse_press()
+    slow_draw(1.)
+    assert multivol.shared_program['u_downsample'] == 1
+    volume.mouse_release()
+
+    # The scene can also be drawn at a lower resolution while interacting
+    canvas = volume._vispy_widget.canvas
+    assert canvas.render_scale == 1
+    volume.state.downscale = True
+    volume.mouse_press()
+    assert canvas.render_scale == 0.5
+    volume.mouse_release()
+    assert canvas.render_scale == 1
+
+    # Once the interaction has finished, the rendering can be refined by
+    # averaging frames drawn with different offsets along the rays.
+    volume.state.refine = True
+    assert canvas.accumulate
+    canvas.accumulated = 1
+    slow_draw(0.)
+    assert multivol.shared_program['u_jitter'] == 1
+    canvas.accumulated = 8
+    slow_draw(0.)
+    assert multivol.shared_program['u_jitter'] == 0
+    volume.mouse_press()
+    assert not canvas.accumulate
+    volume.mouse_release()
+    assert canvas.accumulate
+
+    ga.close()
+
+
+def test_render_mode(tmpdir):
+
+    data = make_test_data(dimensions=(20, 40, 40))
+
+    dc = DataCollection([data])
+    ga = GlueApplication(dc)
+    ga.show()
+
+    volume = ga.new_data_viewer(VispyVolumeViewer)
+    volume.add_data(data)
+
+    multivol = volume._vispy_widget._multivol
+
+    assert volume.state.render_mode == 'max'
+    volume.state.render_mode = 'composite'
+    assert multivol._render_mode == 'composite'
+    assert 'composite.a' in multivol._shader_cache
+
+    session_file = tmpdir.join('test_render_mode.glu').strpath
+    ga.save_session(session_file)
+    ga.close()
+
+    ga2 = GlueApplication.restore_session(session_file)
+    ga2.show()
+    volume = ga2.viewers[0][0]
+    assert volume.state.render_mode == 'composite'
+    assert volume._vispy_widget._multivol._render_mode == 'composite'
+    ga2.close()
+
+
+def test_shared_buffers():
+
+    # Viewers showing the same data with the same bounds share the fixed
+    # resolution buffers rather than computing them again.
+
+    data = make_test_data(dimensions=(20, 20, 20))
+
+    dc = DataCollection([data])
+    ga = GlueApplication(dc)
+    ga.show()
+
+    buffer_cache.clear()
+
+    viewers = []
+    for i in range(2):
+        volume = ga.new_data_viewer(VispyVolumeViewer)
+        volume.state.resolution = 32
+        volume.add_data(data)
+        multivol = volume._vispy_widget._multivol
+        start = time.time()
+        while multivol.pending and time.time() - start < 10:
+            process_events(wait=0.01)
+        viewers.append(volume)
+
+    assert buffer_cache.hits > 0
+    misses = buffer_cache.misses
+
+    # The buffers are computed again once the values have changed
+    data.update_components({data.id['a']: np.zeros((20, 20, 20))})
+    for volume in viewers:
+        multivol = volume._vispy_widget._multivol
+        start = time.time()
+        while multivol.pending and time.time() - start < 10:
+            process_events(wait=0.01)
+    assert buffer_cache.misses > misses
+
+    # The full resolution buffer for the texture of each layer was requested
+    # last by the layers in both viewers.
+    bounds = viewers[0]._vispy_widget._multivol._data_bounds
+    proxy = viewers[0].layers[0]._data_proxy
+    assert buffer_cache.refcount(proxy._cache_key(bounds)) == 2
+
+    # The buffers for a subset are computed again when its subset state is
+    # changed in place.
+    subset_state = RangeSubsetState(0.2, 0.4, data.id['b'])
+    subset = dc.new_subset_group(subset_state=subset_state, label='Subset 1').subsets[0]
+    for volume in viewers:
+        multivol = volume._vispy_widget._multivol
+        start = time.time()
+        while multivol.pending and time.time() - start < 10:
+            process_events(wait=0.01)
+    misses = buffer_cache.misses
+    subset_state.hi = 0.8
+    subset.broadcast('subset_state')
+    for volume in viewers:
+        multivol = volume._vispy_widget._multivol
+        start = time.time()
+        while multivol.pending and time.time() - start < 10:
+            process_events(wait=0.01)
+    assert buffer_cache.misses > misses
+    subset_proxy = viewers[0].layers[1]._data_proxy
+    values = buffer_cache.get(subset_proxy._cache_key(bounds), None)
+    np.testing.assert_equal(values, subset_proxy.uncached.compute_fixed_resolution_buffer(bounds))
+    assert values.mean() > 0.5
+
+    # Only the buffers for the whole volume at full resolution are kept
+    assert all(key[-1] == tuple(bounds) for key in buffer_cache._arrays)
+
+    ga.close()
+
+
+def test_max_shown_layers():
+
+    # Only a limited number of textures can be sampled at once, so layers
+    # can't be added or shown once these are all in use.
+
+    datasets = [make_test_data() for i in range(MAX_SAMPLED_TEXTURES + 1)]
+
+    dc = DataCollection(datasets)
+    for data in datasets[1:]:
+        for i in range(3):
+            dc.add_link(LinkSame(datasets[0].pixel_component_ids[i],
+                                 data.pixel_component_ids[i]))
+
+    ga = GlueApplication(dc)
+    ga.show()
+
+    volume = ga.new_data_viewer(VispyVolumeViewer)
+    for data in datasets[:-1]:
+        volume.add_data(data)
+
+    with pytest.raises(Exception, match='maximum number of volume layers'):
+        volume.add_data(datasets[-1])
+
+    # Hiding a layer makes room for another one, but the hidden layer can't
+    # then be shown again.
+    volume.layers[0].state.visible = False
+    volume.add_data(datasets[-1])
+    with pytest.warns(UserWarning, match='Not enough texture units'):
+        volume.layers[0].state.visible = True
+    assert not volume.layers[0].state.visible
+
+    ga.close()
+
+
+def test_gpu_memory_report():
+
+    data = make_test_data()
+
+    dc = DataCollection([data])
+    ga = GlueApplication(dc)
+    ga.show()
+
+    volume = ga.new_data_viewer(VispyVolumeViewer)
+    volume.add_data(data)
+
+    multivol = volume._vispy_widget._multivol
+    layer_artist = volume.layers[0]
+
+    def wait_for_textures():
+        start = time.time()
+        while multivol.pending and time.time() - start < 10:
+            process_events(wait=0.01)
+
+    wait_for_textures()
+
+    nbytes = multivol.texture_memory(layer_artist.id)[0]
+    assert nbytes > 0
+
+    report = volume.gpu_memory_report()
+    assert report['layers'] == [(layer_artist, nbytes)]
+    assert report['shared'] > 0
+    assert report['nbytes'] == nbytes + report['shared']
+    assert any(entry['visual'] is multivol for entry in gpu_memory.report())
+
+    # Layers that are hidden are evicted if over budget, and are shown
+    # again once visible.
+    budget = gpu_memory.budget
+    try:
+        layer_artist.state.visible = False
+        gpu_memory.set_budget(0)
+        assert volume.gpu_memory_report()['layers'] == [(layer_artist, 0)]
+        gpu_memory.set_budget(budget)
+        layer_artist.state.visible = True
+        wait_for_textures()
+        assert volume.gpu_memory_report()['layers'] == [(layer_artist, nbytes)]
+    finally:
+        gpu_memory.budget = budget
+
+    ga.close()
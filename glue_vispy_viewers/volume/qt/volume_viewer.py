@@ -26,8 +26,8 @@ class VispyVolumeViewer(VispyVolumeViewerMixin, BaseVispyViewer):
         super(VispyVolumeViewer, self).__init__(*args, **kwargs)
 
         # We now make it so that is the user clicks to drag or uses the
-        # mouse wheel (or scroll on a trackpad), we downsample the volume
-        # rendering temporarily.
+        # mouse wheel (or scroll on a trackpad), the volume rendering is
+        # downsampled temporarily, as much as needed to keep it responsive.
 
         canvas = self._vispy_widget.canvas
 
@@ -42,8 +42,6 @@ class VispyVolumeViewer(VispyVolumeViewerMixin, BaseVispyViewer):
         viewbox.events.mouse_press.connect(self.camera_mouse_press)
         viewbox.events.mouse_release.connect(self.camera_mouse_release)
 
-        self._downsampled = False
-
         # For the mouse wheel, we receive discrete events so we need to have
         # a buffer (for now 250ms) before which we consider the mouse wheel
         # event to have stopped.
@@ -54,26 +52,18 @@ class VispyVolumeViewer(VispyVolumeViewerMixin, BaseVispyViewer):
         self._downsample_timer.timeout.connect(self.mouse_release)
 
     def mouse_press(self, event=None):
-        if self.state.downsample:
-            if hasattr(self._vispy_widget, '_multivol') and not self._downsampled:
-                self._vispy_widget._multivol.downsample()
-                self._downsampled = True
+        self._start_interaction()
 
     def mouse_release(self, event=None):
-        if self.state.downsample:
-            if hasattr(self._vispy_widget, '_multivol') and self._downsampled:
-                self._vispy_widget._multivol.upsample()
-                self._downsampled = False
-                self._vispy_widget.canvas.update()
-
+        # This is called once zooming or resizing has settled, which is also
+        # when the resolution is chosen again if needed (see
+        # _stop_interaction).
+        self._stop_interaction()
         self._update_slice_transform()
         self._update_clip()
 
     def mouse_wheel(self, event=None):
-        if self.state.downsample:
-            if hasattr(self._vispy_widget, '_multivol'):
-                if not self._downsampled:
-                    self.mouse_press()
+        self._start_interaction()
         self._downsample_timer.start()
         if event is not None:
             event.handled = True
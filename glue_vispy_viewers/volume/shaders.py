@@ -69,11 +69,20 @@ FRAG_SHADER = """
 {declarations}
 uniform vec3 u_shape;
 uniform float u_downsample;
+uniform float u_jitter;
+uniform float u_voxel_scale;
 uniform vec4 u_bgcolor;
 
 uniform vec3 u_clip_min;
 uniform vec3 u_clip_max;
 
+uniform sampler2D u_colormaps;
+uniform vec2 u_colormaps_shape;
+
+uniform $sampler_type u_occupancy;
+uniform vec3 u_occupancy_shape;
+uniform int u_skip_empty;
+
 //varyings
 // varying vec3 v_texcoord;
 varying vec3 v_position;
@@ -92,6 +101,55 @@ const float u_shininess = 40.0;
 vec3 view_ray;
 
 
+// Normalize a raw texture value using the color limits. The value is the
+// first component of texel, and the rescale vector contains (scale, offset,
+// has_nan) - if has_nan is 1, the second component of texel is 1 for valid
+// values and 0 for NaN values (and in between for interpolated values), in
+// which case the offset is only applied to the valid fraction so that NaN
+// values end up being zero.
+float rescale(vec2 texel, vec3 params) {{
+    float valid = mix(1., texel.y, params.z);
+    return clamp(texel.x * params.x + params.y * valid, 0., 1.);
+}}
+
+// Test whether a bit is set in a channel of a texture with packed 16-bit
+// masks, where bit is the value of the bit (1, 2, 4, ...). Bitwise operations
+// on integers are not available in GLSL 1.20, but this is exact with
+// floating-point values.
+float mask_bit(float channel, float bit) {{
+    float value = floor(channel * 65535. + 0.5);
+    return mod(floor(value / bit), 2.);
+}}
+
+// Look up the color for a normalized value. The colormaps for all layers are
+// stored as lookup tables in the rows of a single 2D texture, and we make
+// sure we sample at the center of the first and last texels so that 0 and 1
+// map exactly to the first and last colors.
+vec4 colormap(float val, float index) {{
+    vec2 pos = vec2((val * (u_colormaps_shape.x - 1.) + 0.5) / u_colormaps_shape.x,
+                    (index + 0.5) / u_colormaps_shape.y);
+    return texture2D(u_colormaps, pos);
+}}
+
+{bricks}
+
+// Return the value of the occupancy texture at loc, which is 0 if all layers
+// are empty in the corresponding cell of the occupancy grid.
+float occupancy(vec3 loc) {{
+    return $sample(u_occupancy, loc).r;
+}}
+
+// Return the number of steps along the ray needed to leave the cell of the
+// occupancy grid that contains loc. The occupancy texture contains 0 for
+// cells where all layers are empty, and sampling it uses nearest-neighbor
+// interpolation so the cell is given by floor(loc * u_occupancy_shape).
+float steps_to_exit(vec3 loc, vec3 dir) {{
+    vec3 cell = floor(loc * u_occupancy_shape);
+    vec3 edge = (cell + step(vec3(0.), dir)) / u_occupancy_shape;
+    vec3 t = abs(edge - loc) / max(abs(dir), vec3(1e-12));
+    return floor(min(t.x, min(t.y, t.z))) + 1.;
+}}
+
 // for some reason, this has to be the last function in order for the
 // filters to be inserted in the correct place...
 
@@ -139,6 +197,13 @@ void main() {{
     vec3 loc = start_loc;
     int iter = 0;
 
+    // When the rendering is refined by averaging several frames, the samples
+    // along each ray are offset by a random fraction of a step, which is
+    // different for each frame.
+    if (u_jitter > 0.) {{
+        loc += rand(start_loc + u_jitter) * step;
+    }}
+
     {before_loop}
 
     // We avoid putting this if statement in the loop for performance
@@ -150,7 +215,12 @@ void main() {{
         // enough to still make the downsampling worth it.
 
         while (iter < nsteps) {{
-            for (iter=iter; iter<nsteps; iter++)
+
+            int end = nsteps;
+
+            {skip_empty}
+
+            for (iter=iter; iter<end; iter++)
             {{
 
                 {in_loop}
@@ -164,7 +234,12 @@ void main() {{
     }} else {{
 
         while (iter < nsteps) {{
-            for (iter=iter; iter<nsteps; iter++)
+
+            int end = nsteps;
+
+            {skip_empty}
+
+            for (iter=iter; iter<end; iter++)
             {{
 
                 {in_loop}
@@ -222,67 +297,269 @@ void main() {{
 """
 
 
-def get_frag_shader(volumes, clipped=False, n_volume_max=5):
+# Declarations and function used to sample layers that are stored at the
+# resolution of the reference data in bricks (see bricks.py). The position in
+# the reference data is used to find the brick, and the page table texture
+# (in which each layer uses a block of rows) then gives the slot of the brick
+# in the atlas, or has zero alpha if the brick isn't loaded, in which case
+# sample_brick returns -1 and we fall back to the texture for the layer at the
+# resolution of the viewer. The raw values in the atlas always have a channel
+# with valid values.
+BRICKS = """
+uniform $sampler_type u_brick_atlas;
+uniform vec3 u_brick_atlas_shape;
+uniform $sampler_type u_brick_table;
+uniform vec3 u_brick_table_shape;
+uniform vec3 u_brick_table_size;
+uniform vec3 u_brick_first;
+uniform vec3 u_brick_origin;
+uniform vec3 u_brick_extent;
+uniform float u_brick_size;
+
+float sample_brick(float row, vec2 params, vec3 loc) {
+    vec3 pos = u_brick_origin + loc * u_brick_extent;
+    vec3 brick = floor((pos + 0.5) / u_brick_size);
+    vec3 index = brick - u_brick_first;
+    if (all(greaterThanEqual(index, vec3(0.))) && all(lessThan(index, u_brick_table_shape))) {
+        index.z += row * u_brick_table_shape.z;
+        vec4 entry = $sample(u_brick_table, (index + 0.5) / u_brick_table_size);
+        if (entry.a > 0.5) {
+            vec3 slot = floor(entry.rgb * 255. + 0.5);
+            vec3 texel = slot * (u_brick_size + 2.) + (pos - brick * u_brick_size) + 1.5;
+            vec4 value = $sample(u_brick_atlas, texel / u_brick_atlas_shape);
+            return rescale(value.rg, vec3(params, 1.));
+        }
+    }
+    return -1.;
+}
+"""
+
+
+# Code used in the raytracing loop to jump over the cells of the occupancy
+# grid where all layers are empty. Since the final value for each layer is the
+# maximum along the ray, skipping samples that are zero doesn't change the
+# result. The occupancy is checked once per cell, and the inner loop then
+# only takes the steps inside the current cell.
+SKIP_EMPTY = """
+if (u_skip_empty == 1) {
+    float skip = steps_to_exit(loc, step);
+    if (occupancy(loc) == 0.) {
+        iter += int(skip);
+        loc += skip * step;
+        continue;
+    }
+    end = min(iter + int(skip), nsteps);
+}
+"""
+
+
+# Code used at the end of each step of the raytracing loop when compositing,
+# to stop once the ray is almost opaque, since the samples further along the
+# ray then make little difference.
+EARLY_TERMINATION = """
+if (composite.a > 0.99) {
+    nsteps = iter + 1;
+    end = nsteps;
+}
+"""
+
+RENDER_MODES = ['max', 'composite']
+
+# OpenGL only guarantees that 16 textures can be sampled in the fragment shader
+# (GL_MAX_TEXTURE_IMAGE_UNITS), and up to four of these are used for the
+# colormaps, the occupancy grid and the brick atlas and page table, so this is
+# the maximum number of textures of layers that can be sampled at once.
+MAX_SAMPLED_TEXTURES = 16 - 4
+
+
+def texture_slot(volume):
+    """
+    Return the slot of the texture sampled for a layer.
+    """
+    return volume.get('pack', volume.get('slot', volume['index']))
+
+
+def shown_layers(volumes):
     """
-    Get the fragment shader code - we use the shader_program object to determine
-    which layers are enabled and therefore what to include in the shader code.
+    Return the sorted labels of the layers that are enabled. Layers are
+    skipped, in the order in which these were allocated, if their textures
+    (or those of the layers these are multiplied by) can't be sampled along
+    with those of the other layers (see `MAX_SAMPLED_TEXTURES`).
     """
+    shown, slots = [], set()
+    for label in sorted(volumes, key=lambda label: volumes[label]['index']):
+        if not volumes[label].get('enabled'):
+            continue
+        needed = {texture_slot(volumes[label])}
+        if volumes[label].get('multiply') in volumes:
+            needed.add(texture_slot(volumes[volumes[label]['multiply']]))
+        if len(slots | needed) <= MAX_SAMPLED_TEXTURES:
+            shown.append(label)
+            slots |= needed
+    return sorted(shown)
+
+
+def sampled_slots(volumes):
+    """
+    Return the set of slots of the textures sampled for the layers shown.
+    """
+    slots = set()
+    for label in shown_layers(volumes):
+        slots.add(texture_slot(volumes[label]))
+        if volumes[label].get('multiply') in volumes:
+            slots.add(texture_slot(volumes[volumes[label]['multiply']]))
+    return slots
+
+
+def get_frag_shader(volumes, clipped=False, skip_empty=False, render_mode='max'):
+    """
+    Get the fragment shader code - we use the ``enabled`` item of each volume
+    to determine which layers to include in the shader code, and the textures
+    of other layers are not sampled at all.
+    If ``skip_empty`` is `True`, the raytracing skips over empty regions using
+    the occupancy texture. Layers with ``bricked`` set are sampled from the
+    brick atlas where their bricks are loaded. Layers with ``pack`` set are
+    sampled from the texture in that slot, starting at the given ``channel``,
+    rather than from the texture in their own ``slot``.
+
+    With the ``'max'`` render mode, the color of each layer is given by the
+    maximum value along the ray. With the ``'composite'`` render mode, the
+    colors of the samples along the ray are composited from front to back, and
+    the raytracing stops once the ray is almost opaque.
+    """
+
+    if render_mode not in RENDER_MODES:
+        raise ValueError("render_mode should be one of {0}".format(RENDER_MODES))
 
     declarations = ""
     before_loop = ""
     in_loop = ""
     after_loop = ""
 
-    for index in range(n_volume_max):
-        declarations += "uniform $sampler_type u_volumetex_{0:d};\n".format(index)
-        before_loop += "dummy = $sample(u_volumetex_{0:d}, loc).g;\n".format(index)
-
-    declarations += "uniform $sampler_type dummy1;\n"
-    declarations += "float dummy;\n"
-
-    for label in sorted(volumes):
+    # Only the enabled layers, and the layers these are multiplied by, are
+    # sampled, so that the shader doesn't do any work for the other layers.
+    # The code then only depends on which layers are shown and how, so that
+    # the compiled programs can be reused when e.g. toggling layers.
+    shown = shown_layers(volumes)
+    multiply = {}
+    for label in shown:
+        if volumes[label].get('multiply') in volumes:
+            multiply[label] = volumes[label]['multiply']
+    sampled = set(shown) | set(multiply.values())
+
+    slots = sorted(set(texture_slot(volumes[label]) for label in sampled))
+    for slot in slots:
+        declarations += "uniform $sampler_type u_volumetex_{0:d};\n".format(slot)
+
+    # Each texture is sampled at most once per step: the textures of the
+    # layers that are shown are sampled at the start of each step, and the
+    # layers packed into the channels of the same texture share the sample.
+    # The textures of the layers shown using bricks, and of the layers these
+    # are multiplied by, are only sampled when needed.
+    fetched = sorted(set(texture_slot(volumes[label]) for label in shown
+                         if not volumes[label].get('bricked')))
+
+    def sample(volume, target):
+        index = volume['index']
+        slot = texture_slot(volume)
+        channel = volume.get('channel', 0)
+        if slot in fetched:
+            texel = "texel_{0:d}".format(slot)
+        else:
+            texel = "$sample(u_volumetex_{0:d}, loc)".format(slot)
+        if 'bit' in volume:
+            return ("{0} = mask_bit({1}.{2}, u_bit_{3:d});\n"
+                    .format(target, texel, 'rgba'[channel], index))
+        # The channel after the one with the values contains the valid values
+        # if the layer has NaN values, and is ignored otherwise.
+        swizzle = 'rgba'[channel] + 'rgba'[min(channel + 1, 3)]
+        code = "{0} = rescale({1}.{2}, u_rescale_{3:d});".format(target, texel, swizzle, index)
+        if volume.get('bricked'):
+            code = ("{0} = sample_brick(u_brick_row_{1:d}, u_brick_rescale_{1:d}, loc);\n"
+                    "if ({0} < 0.) {{ {2} }}").format(target, index, code)
+        return code + "\n"
+
+    for label in sorted(sampled):
 
         index = volumes[label]['index']
 
         # Global declarations
-        declarations += "uniform float u_weight_{0:d};\n".format(index)
-        declarations += "uniform int u_enabled_{0:d};\n".format(index)
-
-        # Declarations before the raytracing loop
-        before_loop += "float max_val_{0:d} = 0;\n".format(index)
+        declarations += "uniform vec3 u_rescale_{0:d};\n".format(index)
+        if 'bit' in volumes[label]:
+            declarations += "uniform float u_bit_{0:d};\n".format(index)
+        if volumes[label].get('bricked'):
+            declarations += "uniform float u_brick_row_{0:d};\n".format(index)
+            declarations += "uniform vec2 u_brick_rescale_{0:d};\n".format(index)
 
-        # Calculation inside the main raytracing loop
+    # Calculation inside the main raytracing loop
 
-        in_loop += "if(u_enabled_{0:d} == 1) {{\n\n".format(index)
+    if clipped:
+        in_loop += ("if(loc.r > u_clip_min.r && loc.r < u_clip_max.r &&\n"
+                    "   loc.g > u_clip_min.g && loc.g < u_clip_max.g &&\n"
+                    "   loc.b > u_clip_min.b && loc.b < u_clip_max.b) {\n\n")
 
-        if clipped:
-            in_loop += ("if(loc.r > u_clip_min.r && loc.r < u_clip_max.r &&\n"
-                        "   loc.g > u_clip_min.g && loc.g < u_clip_max.g &&\n"
-                        "   loc.b > u_clip_min.b && loc.b < u_clip_max.b) {\n\n")
+    for slot in fetched:
+        in_loop += "vec4 texel_{0:d} = $sample(u_volumetex_{0:d}, loc);\n".format(slot)
+    if fetched:
+        in_loop += "\n"
 
-        in_loop += "// Sample texture for layer {0}\n".format(label)
-        in_loop += "val = $sample(u_volumetex_{0:d}, loc).g;\n".format(index)
+    for label in shown:
 
-        if volumes[label].get('multiply') is not None:
-            index_other = volumes[volumes[label]['multiply']]['index']
-            in_loop += ("if (val != 0) {{ val *= $sample(u_volumetex_{0:d}, loc).g; }}\n"
-                        .format(index_other))
+        index = volumes[label]['index']
 
-        in_loop += "max_val_{0:d} = max(val, max_val_{0:d});\n\n".format(index)
+        declarations += "uniform float u_weight_{0:d};\n".format(index)
 
-        if clipped:
-            in_loop += "}\n\n"
+        # Declarations before the raytracing loop
+        if render_mode == 'max':
+            before_loop += "float max_val_{0:d} = 0;\n".format(index)
 
-        in_loop += "}\n\n"
+        in_loop += "// Sample texture for layer {0}\n".format(label)
+        in_loop += sample(volumes[label], 'val')
+
+        if label in multiply:
+            in_loop += ("if (val != 0) {{\n"
+                        "    float other;\n"
+                        "{0}"
+                        "    val *= other;\n"
+                        "}}\n").format(indent(sample(volumes[multiply[label]], 'other'), " " * 4))
+
+        if render_mode == 'max':
+            in_loop += "max_val_{0:d} = max(val, max_val_{0:d});\n\n".format(index)
+        else:
+            # The opacity is for a step of one voxel of the data, so we
+            # correct it for the actual step size.
+            in_loop += ("sample_color = colormap(val, {0:d}.);\n"
+                        "if (sample_color.a > 0.) {{\n"
+                        "    sample_color.a = 1. - pow(1. - min(sample_color.a * u_weight_{0:d}, "
+                        "1.), u_downsample * u_voxel_scale);\n"
+                        "    composite.rgb += (1. - composite.a) * sample_color.a * "
+                        "sample_color.rgb;\n"
+                        "    composite.a += (1. - composite.a) * sample_color.a;\n"
+                        "}}\n\n").format(index)
 
         # Calculation after the main loop
 
-        after_loop += "// Compute final color for layer {0}\n".format(label)
-        after_loop += ("color = $cmap{0:d}(max_val_{0:d});\n"
-                       "color.a *= u_weight_{0:d};\n"
-                       "total_color += color.a * color;\n"
-                       "max_alpha = max(color.a, max_alpha);\n"
-                       "count += color.a;\n\n").format(index)
+        if render_mode == 'max':
+            after_loop += "// Compute final color for layer {0}\n".format(label)
+            after_loop += ("color = colormap(max_val_{0:d}, {0:d}.);\n"
+                           "color.a *= u_weight_{0:d};\n"
+                           "total_color += color.a * color;\n"
+                           "max_alpha = max(color.a, max_alpha);\n"
+                           "count += color.a;\n\n").format(index)
+
+    if clipped:
+        in_loop += "}\n\n"
+
+    if render_mode == 'composite':
+        before_loop += "vec4 sample_color;\n"
+        before_loop += "vec4 composite = vec4(0.);\n"
+        in_loop += EARLY_TERMINATION
+        # The composited color is premultiplied by the opacity
+        after_loop += ("if (composite.a > 0.) {\n"
+                       "    total_color = vec4(composite.rgb / composite.a, 1.);\n"
+                       "    max_alpha = composite.a;\n"
+                       "    count = 1.;\n"
+                       "}\n")
 
     if not clipped:
         before_loop += "\nfloat val3 = u_clip_min.g + u_clip_max.g;\n\n"
@@ -291,9 +568,17 @@ def get_frag_shader(volumes, clipped=False, n_volume_max=5):
     before_loop = indent(before_loop, " " * 4).strip()
     in_loop = indent(in_loop, " " * 16).strip()
     after_loop = indent(after_loop, " " * 4).strip()
+    skip_code = indent(SKIP_EMPTY, " " * 12).strip() if skip_empty else ""
+
+    if any(volumes[label].get('bricked') for label in sampled):
+        bricks = BRICKS.strip()
+    else:
+        bricks = ""
 
     return FRAG_SHADER.format(declarations=declarations,
+                              bricks=bricks,
                               before_loop=before_loop,
+                              skip_empty=skip_code,
                               in_loop=in_loop,
                               after_loop=after_loop)
 
@@ -0,0 +1,126 @@
+# This file implements a wrapper around the data of a layer that remembers
+# the last fixed resolution buffer computed for it. When the bounds are moved
+# by a whole number of steps on the same grid, such as when panning, the
+# values that are still in view are reused and only the slabs that have come
+# into view are computed.
+
+import numpy as np
+
+from .buffer_cache import uncached
+
+__all__ = ['SlabBuffer', 'grid_offsets', 'snap_bounds']
+
+
+def grid_offsets(previous_bounds, bounds):
+    """
+    If ``bounds`` are on the same grid as ``previous_bounds`` and overlap
+    with them, return by how many steps they are shifted along each axis,
+    otherwise return `None`.
+    """
+    offsets = []
+    for (vmin0, vmax0, n0), (vmin1, vmax1, n1) in zip(previous_bounds, bounds):
+        if n0 != n1:
+            return None
+        if n0 == 1:
+            if (vmin0, vmax0) != (vmin1, vmax1):
+                return None
+            offsets.append(0)
+            continue
+        step = (vmax0 - vmin0) / (n0 - 1)
+        if not np.isclose((vmax1 - vmin1) / (n1 - 1), step, rtol=1e-9, atol=0):
+            return None
+        shift = (vmin1 - vmin0) / step
+        offset = int(np.round(shift))
+        if abs(shift - offset) > 1e-6 or abs(offset) >= n0:
+            return None
+        offsets.append(offset)
+    return offsets
+
+
+def snap_bounds(previous_bounds, bounds):
+    """
+    If ``bounds`` have the same shape and spacing as ``previous_bounds``,
+    return them moved by less than half a step so that they are on the same
+    grid as ``previous_bounds`` (see `grid_offsets`). Otherwise, return
+    ``bounds`` unchanged.
+    """
+    snapped = []
+    for (vmin0, vmax0, n0), (vmin1, vmax1, n1) in zip(previous_bounds, bounds):
+        if n0 != n1 or n0 == 1:
+            return bounds
+        step = (vmax0 - vmin0) / (n0 - 1)
+        if not np.isclose((vmax1 - vmin1) / (n1 - 1), step, rtol=1e-9, atol=0):
+            return bounds
+        offset = np.round((vmin1 - vmin0) / step) * step
+        snapped.append((vmin0 + offset, vmax0 + offset, n0))
+    return snapped
+
+
+class SlabBuffer(object):
+    """
+    A wrapper around ``data`` with a ``compute_fixed_resolution_buffer``
+    method that reuses the values of the previous call where the bounds
+    overlap with the previous bounds (see `grid_offsets`).
+
+    The values returned should not be modified, since they are kept for the
+    next call.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._previous = None
+
+    def can_shift(self, bounds):
+        previous = self._previous
+        return previous is not None and grid_offsets(previous[0], bounds) is not None
+
+    def compute_fixed_resolution_buffer(self, bounds):
+
+        bounds = [tuple(bound) for bound in bounds]
+
+        # This can be called from worker threads, so we only read and set the
+        # previous result once, which means that it is always consistent.
+        previous = self._previous
+        offsets = None if previous is None else grid_offsets(previous[0], bounds)
+
+        if offsets is None:
+            values = np.asarray(self.data.compute_fixed_resolution_buffer(bounds))
+            # Textures are stored with single precision at most, so there is
+            # no point keeping more than that.
+            if values.dtype.kind == 'f':
+                values = values.astype(np.float32, copy=False)
+        else:
+            values = self._shift(bounds, offsets, *previous)
+
+        self._previous = bounds, values
+
+        return values
+
+    def _shift(self, bounds, offsets, previous_bounds, previous_values):
+
+        values = np.empty_like(previous_values)
+
+        # Copy the values that are still in view
+        target, source = [], []
+        for offset, (_, _, n) in zip(offsets, bounds):
+            target.append(slice(max(0, -offset), min(n, n - offset)))
+            source.append(slice(max(0, offset), min(n, n + offset)))
+        values[tuple(target)] = previous_values[tuple(source)]
+
+        # Compute the slabs that have come into view along each axis. The
+        # slab along each axis is restricted to the values already in view
+        # along the previous axes, so that no value is computed twice.
+        for axis, offset in enumerate(offsets):
+            if offset == 0:
+                continue
+            n = bounds[axis][2]
+            exposed = slice(n - offset, n) if offset > 0 else slice(0, -offset)
+            view = target[:axis] + [exposed] + [slice(0, b[2]) for b in bounds[axis + 1:]]
+            slab_bounds = []
+            for (vmin, vmax, n), index in zip(bounds, view):
+                step = (vmax - vmin) / (n - 1) if n > 1 else 0.
+                slab_bounds.append((vmin + index.start * step, vmin + (index.stop - 1) * step,
+                                    index.stop - index.start))
+            values[tuple(view)] = uncached(self.data).compute_fixed_resolution_buffer(slab_bounds)
+
+        return values
@@ -0,0 +1,31 @@
+from echo import SelectionCallbackProperty
+from glue.viewers.volume3d.layer_state import VolumeLayerState3D
+
+__all__ = ['VispyVolumeLayerState']
+
+# The precisions that can be used to store volume layers on the GPU, along
+# with the names to show for them in the user interface.
+TEXTURE_PRECISIONS = {'float32': '32-bit float',
+                      'float16': '16-bit float',
+                      'uint16': '16-bit',
+                      'uint8': '8-bit'}
+
+
+class VispyVolumeLayerState(VolumeLayerState3D):
+    """
+    A state object for volume layers, with additional properties that are
+    specific to the VisPy volume viewer.
+    """
+
+    precision = SelectionCallbackProperty(default_index=0,
+                                          docstring='The precision used to store '
+                                                    'the layer on the GPU')
+
+    def __init__(self, layer=None, **kwargs):
+
+        # The choices need to be set before calling the parent __init__,
+        # which sets the properties given in kwargs.
+        VispyVolumeLayerState.precision.set_choices(self, list(TEXTURE_PRECISIONS))
+        VispyVolumeLayerState.precision.set_display_func(self, TEXTURE_PRECISIONS.get)
+
+        super(VispyVolumeLayerState, self).__init__(layer=layer, **kwargs)
@@ -0,0 +1,135 @@
+import numpy as np
+from numpy.testing import assert_equal
+
+import pytest
+
+from ..bricks import BrickCache, brick_grid, compute_bricks, page_table, visible_bricks
+
+
+class ArrayProxy(object):
+    """
+    Stand-in for DataProxy that samples an array at the nearest positions,
+    with NaN values outside the array.
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+    def compute_fixed_resolution_buffer(self, bounds):
+        indices = [np.round(np.linspace(*bound)).astype(int) for bound in bounds]
+        result = np.full([bound[2] for bound in bounds], np.nan)
+        inside = [(index >= 0) & (index < size) for index, size in zip(indices, self.array.shape)]
+        view = np.ix_(*[index[valid] for index, valid in zip(indices, inside)])
+        result[np.ix_(*inside)] = self.array[view]
+        return result
+
+
+def test_brick_grid():
+    assert brick_grid([(-0.5, 99.5, 16), (10, 20, 16), (-0.5, 31.5, 16)], 32) == \
+        ((0, 0, 0), (4, 1, 1))
+    assert brick_grid([(-0.5, 2047.5, 16)] * 3, 32) == ((0, 0, 0), (64, 64, 64))
+    assert brick_grid([(-0.5, 2048.5, 16)] * 3, 32) is None
+
+
+def test_brick_cache():
+
+    cache = BrickCache((1, 1, 3))
+    assert cache.capacity == 3
+
+    for key in 'abc':
+        assert cache.insert(key, value=key.upper()) is None
+
+    assert sorted(cache.slot(key)[2] for key in 'abc') == [0, 1, 2]
+    assert cache.value('b') == 'B'
+
+    # The least recently used brick should be evicted, and its slot reused
+    cache.touch(['a'])
+    slot = cache.slot('b')
+    assert cache.insert('d') == 'b'
+    assert 'b' not in cache
+    assert cache.slot('d') == slot
+
+    # Bricks that should be kept are not evicted
+    assert cache.insert('e', keep={'c'}) == 'a'
+    with pytest.raises(KeyError):
+        cache.insert('f', keep={'c', 'd', 'e'})
+
+    cache.discard(['c', 'x'])
+    assert len(cache) == 2
+    assert cache.insert('f') is None
+    assert sorted(cache.keys()) == ['d', 'e', 'f']
+
+
+def test_visible_bricks():
+
+    # Use an orthographic projection along z with the center of the view at
+    # the center of brick (2, 6) in (y, x), and the near and far planes far
+    # away, so that the view covers 3 bricks on either side of that brick.
+    matrix = np.array([[1 / 41, 0, 0, -103.5 / 41],
+                       [0, 1 / 41, 0, -39.5 / 41],
+                       [0, 0, 1e-6, 0],
+                       [0, 0, 0, 1]])
+
+    bricks = visible_bricks((0, 0, 0), (2, 8, 16), matrix, brick_size=16)
+
+    assert len(bricks) == 2 * 6 * 7
+    assert sorted(set(bricks[:, 0])) == [0, 1]
+    assert sorted(set(bricks[:, 1])) == [0, 1, 2, 3, 4, 5]
+    assert sorted(set(bricks[:, 2])) == [3, 4, 5, 6, 7, 8, 9]
+
+    # The bricks closest to the center of the view come first
+    assert_equal(bricks[:2, 1:], [[2, 6], [2, 6]])
+    distance = np.hypot(bricks[:, 1] - 2, bricks[:, 2] - 6)
+    assert np.all(np.diff(distance) >= 0)
+
+    # Bricks outside of the given range are never included
+    bricks = visible_bricks((0, 4, 8), (1, 2, 2), matrix, brick_size=16)
+    assert sorted(map(tuple, bricks)) == [(0, 4, 8), (0, 4, 9), (0, 5, 8), (0, 5, 9)]
+
+
+def test_compute_bricks():
+
+    array = np.random.random((40, 50, 60))
+    array[10, 20, 30] = np.nan
+
+    bricks = compute_bricks(None, ArrayProxy(array), [(0, 1, 1)], brick_size=16)
+
+    assert len(bricks) == 1
+    brick, values, vrange = bricks[0]
+    assert brick == (0, 1, 1)
+    assert values.shape == (18, 18, 18, 2)
+    assert values.dtype == np.float32
+
+    # Each brick includes an extra value on either side, which are NaN
+    # outside of the data.
+    expected = np.full((18, 18, 18), np.nan)
+    expected[1:, :, :] = array[:17, 15:33, 15:33]
+
+    valid = ~np.isnan(expected)
+    assert_equal(values[..., 1], valid)
+    assert_equal(values[..., 0][~valid], 0)
+    assert_equal(values[..., 0][valid], expected[valid].astype(np.float32))
+    assert vrange == (np.nanmin(expected.astype(np.float32)),
+                      np.nanmax(expected.astype(np.float32)))
+
+    bricks = compute_bricks(None, ArrayProxy(array), [(5, 0, 0)], brick_size=16)
+    assert bricks[0][2] is None
+
+
+def test_page_table():
+
+    cache = BrickCache((2, 2, 2))
+    cache.insert(('a', (0, 1, 2)))
+    cache.insert(('b', (1, 1, 2)))
+    cache.insert(('b', (5, 1, 2)))
+    cache.insert(('c', (0, 1, 2)))
+
+    table = page_table(cache, ['b', 'a'], (0, 1, 1), (2, 2, 3))
+    assert table.shape == (4, 2, 3, 4)
+
+    # The layers use blocks of rows in the order given, and bricks outside
+    # the range or for other layers are not included.
+    expected = np.zeros((4, 2, 3, 4), dtype=np.uint8)
+    expected[1, 0, 1] = cache.slot(('b', (1, 1, 2)))[::-1] + (255,)
+    expected[2 + 0, 0, 1] = cache.slot(('a', (0, 1, 2)))[::-1] + (255,)
+    assert_equal(table, expected)
@@ -0,0 +1,183 @@
+import threading
+import time
+
+import numpy as np
+
+from glue.viewers.volume3d.data_proxy import DataProxy
+
+from ..buffer_cache import BufferCache, CachedDataProxy
+
+
+class Owner(object):
+    pass
+
+
+def test_buffer_cache():
+
+    cache = BufferCache()
+    computed = []
+
+    def compute(value):
+        def func():
+            computed.append(value)
+            return np.full(10, value, dtype=np.float32)
+        return func
+
+    owner1, owner2 = Owner(), Owner()
+
+    assert cache.get(('data', 1), compute(1), owner=owner1)[0] == 1
+    assert cache.get(('data', 1), compute(1), owner=owner2)[0] == 1
+    assert computed == [1]
+    assert cache.info() == {'hits': 1, 'misses': 1, 'size': 1, 'nbytes': 40}
+    assert cache.refcount(('data', 1)) == 2
+
+    # Owners only reference the array they requested last
+    cache.get(('data', 2), compute(2), owner=owner1)
+    assert cache.refcount(('data', 1)) == 1
+    cache.release(owner2)
+    assert cache.refcount(('data', 1)) == 0
+
+    # Owners that no longer exist don't reference arrays
+    del owner1
+    assert cache.refcount(('data', 2)) == 0
+
+    # Once the values of the data have changed, the arrays are computed again
+    cache.invalidate('data')
+    assert len(cache) == 0
+    cache.get(('data', 1), compute(1))
+    assert computed == [1, 2, 1]
+
+
+def test_buffer_cache_eviction():
+
+    # The cache can hold two of the arrays
+    cache = BufferCache(max_bytes=100)
+
+    def compute():
+        return np.zeros(10, dtype=np.float32)
+
+    owner = Owner()
+
+    cache.get(('data', 1), compute, owner=owner)
+    cache.get(('data', 2), compute)
+    cache.get(('data', 3), compute)
+
+    # The least recently used array that isn't referenced is discarded
+    assert len(cache) == 2
+    assert cache.refcount(('data', 1)) == 1
+    cache.get(('data', 1), compute)
+    assert cache.misses == 3
+
+    # Referenced arrays are kept even if the cache is full
+    others = [Owner() for i in range(3)]
+    for i, other in enumerate(others):
+        cache.get(('other', i), compute, owner=other)
+    assert len(cache) == 4
+    assert cache.nbytes == 160
+    assert cache.refcount(('data', 3)) == 0
+
+
+def test_buffer_cache_concurrent():
+
+    # If several threads need the same array at the same time, it is only
+    # computed once.
+
+    cache = BufferCache()
+    started = threading.Event()
+    finish = threading.Event()
+    computed = []
+
+    def compute():
+        computed.append(1)
+        started.set()
+        finish.wait()
+        return np.ones(10)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(('data',), compute)))
+               for i in range(4)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    finish.set()
+    for thread in threads:
+        thread.join()
+
+    assert computed == [1]
+    assert len(results) == 4
+    assert all(result is results[0] for result in results)
+
+
+def test_buffer_cache_invalidate_while_computing():
+
+    # Arrays that were being computed while the data changed are not kept
+
+    cache = BufferCache()
+
+    def compute():
+        cache.invalidate('data')
+        return np.ones(10)
+
+    cache.get(('data',), compute)
+    assert len(cache) == 0
+
+
+def test_buffer_cache_invalidate_values():
+
+    # The arrays for some values of a dataset (e.g. a subset) can be
+    # invalidated without discarding the other arrays for the dataset
+
+    cache = BufferCache()
+
+    def compute():
+        return np.ones(10)
+
+    cache.get(('data', 'subset', 1), compute)
+    cache.get(('data', 'attribute', 1), compute)
+    cache.get(('other', 'subset', 1), compute)
+
+    cache.invalidate('data', 'subset')
+    assert len(cache) == 2
+    cache.get(('data', 'attribute', 1), compute)
+    assert cache.misses == 3
+    cache.get(('data', 'subset', 1), compute)
+    assert cache.misses == 4
+
+    cache.invalidate('data')
+    assert len(cache) == 1
+
+
+def test_proxy_concurrent(monkeypatch):
+
+    # The buffers for the same layer, cached or not, should be computed one
+    # at a time since glue's caches aren't thread-safe.
+
+    active = []
+    overlaps = []
+
+    def compute(self, bounds=None):
+        active.append(bounds)
+        overlaps.append(len(active) > 1)
+        time.sleep(0.01)
+        active.remove(bounds)
+        return np.zeros([bound[2] for bound in bounds])
+
+    monkeypatch.setattr(DataProxy, 'compute_fixed_resolution_buffer', compute)
+
+    proxy = CachedDataProxy(Owner(), Owner())
+
+    def run(data, size):
+        for i in range(5):
+            data.compute_fixed_resolution_buffer([(0, 1, size)] * 3)
+
+    threads = [threading.Thread(target=run, args=(proxy, 2)),
+               threading.Thread(target=run, args=(proxy.uncached, 3)),
+               threading.Thread(target=run, args=(proxy.uncached, 4))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(overlaps) == 15
+    assert not any(overlaps)
@@ -1,82 +1,62 @@
-from re import sub
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
 
-from glue.config import LinearStretch, colormaps
-from glue_vispy_viewers.volume.colors import create_cmap_template, get_mpl_cmap, \
-                                             get_translucent_cmap, glsl_for_stretch
-
-
-def clean_template(template):
-    return sub("( |\n)", "", template)
-
-
-def test_create_cmap_template():
-
-    n_colors = 4
-    stretch = LinearStretch()
-    stretch_glsl = glsl_for_stretch(stretch)
-    template = clean_template(create_cmap_template(n=n_colors, stretch_glsl=stretch_glsl))
-
-    # vispy adds some extra code to the GLSL map for mapping bad values (e.g. NaN)
-    # to a default color, so we need to account for that.
-    # If this becomes more complicated we could use a regex, but with all of the parentheses
-    # and brackets this feels simpler
-    template_start = clean_template("vec4 translucent_colormap(float t) {")
-    template_end = clean_template("""
-        float s = t;
-        if (s <= 0.25)
-            { return $color_0; }
-        if (s <= 0.5)
-            { return $color_1; }
-        if (s <= 0.75)
-            { return $color_2; }
-        return $color_3;
-    }
-    """)
-    assert template.startswith(template_start)
-    assert template.endswith(template_end)
+from glue.config import LinearStretch, LogStretch, colormaps
+from glue_vispy_viewers.volume.colors import LUT_SIZE, get_lut, get_mpl_cmap, \
+                                             get_translucent_cmap
 
 
 def test_translucent_cmap():
     color = (0.3, 0.5, 0.7)
     stretch = LinearStretch()
-    cmap_cls = get_translucent_cmap(*color, stretch)
-    template = clean_template(cmap_cls.glsl_map)
+    lut = get_translucent_cmap(*color, stretch)
+    assert lut.shape == (LUT_SIZE, 4)
+    assert lut.dtype == np.float32
+    assert_allclose(lut[:, :3], np.broadcast_to(color, (LUT_SIZE, 3)))
+    assert_allclose(lut[:, 3], np.linspace(0, 1, LUT_SIZE), atol=1e-7)
 
-    template_start = clean_template("vec4 translucent_fire(float t) {")
-    template_end = clean_template("""
-        return vec4(0.3, 0.5, 0.7, t);
-    }
-    """)
-    assert template.startswith(template_start)
-    assert template.endswith(template_end)
+
+def test_translucent_cmap_stretch():
+    stretch = LogStretch()
+    lut = get_translucent_cmap(1, 0, 0, stretch, n=5)
+    assert_allclose(lut[:, 3], stretch(np.linspace(0, 1, 5)), rtol=1e-6)
 
 
 def test_linear_cmap():
 
     colormap = colormaps['Red-Blue']
     stretch = LinearStretch()
-    stretch_glsl = glsl_for_stretch(stretch)
-    cmap = get_mpl_cmap(colormap, stretch)
-    assert len(cmap.colors) == 256
+    lut = get_mpl_cmap(colormap, stretch)
+    assert lut.shape == (LUT_SIZE, 4)
 
-    template = create_cmap_template(256, stretch_glsl)
-    template_start, template_end = [clean_template(t) for t in template.split("\n", maxsplit=1)]
-    template = clean_template(template)
-    assert template.startswith(template_start)
-    assert template.endswith(template_end)
+    # The first and last colors should be used at the ends of the LUT
+    assert_allclose(lut[0, :3], colormap(0.)[:3])
+    assert_allclose(lut[-1, :3], colormap(255 / 256)[:3])
+    assert_allclose(lut[-1, 3], 255 / 256)
 
 
 def test_listed_cmap():
 
     colormap = colormaps['Viridis']
     stretch = LinearStretch()
-    stretch_glsl = glsl_for_stretch(stretch)
-    cmap = get_mpl_cmap(colormap, stretch)
     n_colors = len(colormap.colors)
-    assert len(cmap.colors) == n_colors
+    lut = get_mpl_cmap(colormap, stretch, n=n_colors * 2)
+
+    # Each color should be used for n / n_colors entries of the LUT, with
+    # color i used for values in (i / n_colors, (i + 1) / n_colors].
+    values = np.linspace(0, 1, n_colors * 2)
+    indices = np.clip(np.ceil(values * n_colors).astype(int) - 1, 0, n_colors - 1)
+    assert_allclose(lut[:, :3], np.asarray(colormap.colors)[indices], rtol=1e-6)
+    assert_allclose(lut[:, 3], indices / n_colors, rtol=1e-6)
+
+
+def test_get_lut():
+
+    lut = np.random.random((LUT_SIZE, 4)).astype(np.float32)
+    assert get_lut(lut) is lut
+
+    lut = get_lut(np.array([[0, 0, 0, 0], [1, 1, 1, 1]]), n=5)
+    assert_equal(lut, np.repeat(np.linspace(0, 1, 5)[:, None], 4, axis=1))
 
-    template = create_cmap_template(n_colors, stretch_glsl)
-    template_start, template_end = [clean_template(t) for t in template.split("\n", maxsplit=1)]
-    template = clean_template(template)
-    assert template.startswith(template_start)
-    assert template.endswith(template_end)
+    lut = get_lut('grays', n=3)
+    assert_allclose(lut, [[0, 0, 0, 1], [0.5, 0.5, 0.5, 1], [1, 1, 1, 1]])
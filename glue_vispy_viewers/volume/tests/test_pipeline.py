@@ -0,0 +1,225 @@
+import time
+import threading
+
+import pytest
+
+from .. import pipeline as pipeline_module
+from ..pipeline import ChunkQueue, JobCancelled, TextureJob, TexturePipeline, map_chunks
+
+
+def wait_for(pipeline, timeout=5):
+    start = time.time()
+    results = []
+    while pipeline.pending:
+        results.extend(pipeline.poll())
+        if time.time() - start > timeout:
+            raise TimeoutError("Pipeline did not finish in time")
+        time.sleep(0.01)
+    return results
+
+
+def test_pipeline_results():
+
+    pipeline = TexturePipeline()
+
+    def job_func(job, value):
+        return value * 2
+
+    pipeline.submit('a', job_func, 2)
+    pipeline.submit('b', job_func, 5)
+
+    assert pipeline.pending
+
+    results = wait_for(pipeline)
+
+    assert sorted(results) == [('a', 4), ('b', 10)]
+    assert not pipeline.pending
+
+
+def test_pipeline_cancel_stale():
+
+    # Submitting a new job for a label should cancel the previous one
+
+    pipeline = TexturePipeline()
+
+    started = threading.Event()
+    release = threading.Event()
+    iterations = []
+
+    def slow_job(job, value):
+        started.set()
+        release.wait(5)
+        for i in range(10):
+            job.check()
+            iterations.append(i)
+        return value
+
+    first = pipeline.submit('a', slow_job, 1)
+    started.wait(5)
+    pipeline.submit('a', lambda job, value: value, 2)
+    release.set()
+
+    results = wait_for(pipeline)
+
+    assert first.cancelled
+    assert iterations == []
+    assert results == [('a', 2)]
+
+
+def test_pipeline_cancel_wait():
+
+    pipeline = TexturePipeline()
+
+    def job_func(job):
+        time.sleep(0.1)
+        job.check()
+        return 1
+
+    pipeline.submit('a', job_func)
+    pipeline.cancel('a', wait=True)
+
+    assert not pipeline.pending
+    assert pipeline.poll() == []
+
+
+def test_pipeline_error():
+
+    pipeline = TexturePipeline()
+
+    def job_func(job):
+        raise ValueError("Something went wrong")
+
+    pipeline.submit('a', job_func)
+
+    with pytest.raises(ValueError, match='Something went wrong'):
+        wait_for(pipeline)
+
+
+def test_call_in_main_thread():
+
+    pipeline = TexturePipeline()
+
+    calls = []
+
+    def record_thread():
+        calls.append(threading.current_thread())
+
+    def job_func(job):
+        pipeline.call_in_main_thread(record_thread)
+        return 1
+
+    pipeline.submit('a', job_func)
+    wait_for(pipeline)
+
+    assert calls == [threading.main_thread()]
+
+    pipeline.call_in_main_thread(calls.append, 2)
+
+    assert calls[-1] == 2
+
+
+def test_chunk_queue():
+
+    # Jobs can hand back a queue before they finish, and add items to it
+    # while the main thread collects them.
+
+    pipeline = TexturePipeline()
+
+    release = threading.Event()
+
+    def job_func(job):
+        chunks = ChunkQueue(job, maxsize=2)
+        job.publish(chunks)
+        for i in range(5):
+            chunks.put(i)
+            release.wait(5)
+        chunks.close()
+        return chunks
+
+    pipeline.submit('a', job_func)
+
+    start = time.time()
+    results = []
+    while not results and time.time() - start < 5:
+        results = pipeline.poll()
+        time.sleep(0.01)
+
+    label, chunks = results[0]
+    assert label == 'a'
+    assert pipeline.pending
+
+    # Only the items that are ready are returned, without waiting
+    items = []
+    while not items:
+        items = chunks.get_ready()
+    assert items == [0]
+    assert not chunks.finished
+
+    release.set()
+    items.extend(chunks)
+    assert items == list(range(5))
+    assert chunks.finished
+
+    # The result is only handed back once
+    assert wait_for(pipeline) == []
+    assert not chunks.failed
+
+
+def test_chunk_queue_cancel():
+
+    # Jobs waiting for space in the queue stop once they are cancelled, and
+    # the queue then reports that it failed.
+
+    pipeline = TexturePipeline()
+
+    def job_func(job):
+        chunks = ChunkQueue(job, maxsize=1)
+        job.publish(chunks)
+        for i in range(5):
+            chunks.put(i)
+        chunks.close()
+
+    job = pipeline.submit('a', job_func)
+
+    start = time.time()
+    results = []
+    while not results and time.time() - start < 5:
+        results = pipeline.poll()
+        time.sleep(0.01)
+
+    chunks = results[0][1]
+    pipeline.cancel('a', wait=True)
+
+    assert isinstance(job.future.exception(), JobCancelled)
+    assert chunks.failed
+    with pytest.raises(JobCancelled):
+        list(chunks)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_map_chunks(monkeypatch, workers):
+
+    monkeypatch.setattr(pipeline_module, 'CHUNK_WORKERS', workers)
+
+    # The results should be in the same order as the items
+    assert list(map_chunks(None, lambda value: value * 2, range(10))) == list(range(0, 20, 2))
+
+    # Only a few items are processed ahead of the results that are consumed
+    processed = []
+    results = map_chunks(None, processed.append, range(100))
+    next(results)
+    assert len(processed) <= workers * pipeline_module.CHUNK_LOOKAHEAD + 1
+    results.close()
+
+    # Once the job has been cancelled, the remaining items aren't processed
+    job = TextureJob('a')
+    processed = []
+
+    def func(value):
+        processed.append(value)
+        job.cancel()
+        return value
+
+    with pytest.raises(JobCancelled):
+        list(map_chunks(job, func, range(10)))
+    assert len(processed) < 10
@@ -0,0 +1,183 @@
+import warnings
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+
+import pytest
+
+from ..pyramid import Pyramid, build_pyramid, pyramid_stride, reduce_blocks
+
+
+class ArrayProxy(object):
+    """
+    Stand-in for DataProxy that samples an array at the nearest positions,
+    with NaN values (or zeros for integer and boolean arrays) outside the
+    array.
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self.calls = 0
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def compute_fixed_resolution_buffer(self, bounds):
+        self.calls += 1
+        indices = [np.round(np.linspace(*bound)).astype(int) for bound in bounds]
+        inside = [(index >= 0) & (index < size) for index, size in zip(indices, self.array.shape)]
+        if self.array.dtype.kind != 'f':
+            result = np.zeros([bound[2] for bound in bounds], dtype=self.array.dtype)
+        else:
+            result = np.full([bound[2] for bound in bounds], np.nan)
+        result[np.ix_(*inside)] = self.array[np.ix_(*[index[valid] for index, valid
+                                                      in zip(indices, inside)])]
+        return result
+
+
+def reduce_reference(array, factor, func):
+    """
+    Reduce an array over blocks of ``factor`` values along each axis one
+    block at a time.
+    """
+    shape = [int(np.ceil(n / factor)) for n in array.shape]
+    result = np.zeros(shape)
+    for index in np.ndindex(*shape):
+        view = tuple(slice(i * factor, (i + 1) * factor) for i in index)
+        result[index] = func(array[view])
+    return result
+
+
+def test_pyramid_stride():
+    assert pyramid_stride((64, 64, 64), max_size=64 ** 3) == 1
+    assert pyramid_stride((65, 64, 64), max_size=64 ** 3) == 2
+    assert pyramid_stride((1000, 1000, 1000), max_size=2 ** 24) == 4
+
+
+@pytest.mark.parametrize(('reduction', 'func'), [('mean', np.nanmean), ('max', np.nanmax)])
+def test_reduce_blocks(reduction, func):
+
+    array = np.random.random((9, 10, 11))
+    array[2, 3, 4] = np.nan
+    array[8:, 8:, 8:] = np.nan
+
+    # The last block only contains NaN values
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = reduce_reference(array, 4, func)
+
+    result, counts = reduce_blocks(array, 4, reduction)
+    assert_allclose(result, expected, rtol=1e-6)
+
+    # The means of the means of blocks are the means of the larger blocks,
+    # even when the blocks have different numbers of valid values.
+    if reduction == 'mean':
+        assert_equal(counts, reduce_reference(~np.isnan(array), 4, np.sum))
+        result, counts = reduce_blocks(array, 2)
+        result, counts = reduce_blocks(result, 4, counts=counts)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            expected = reduce_reference(array, 8, np.nanmean)
+        assert_allclose(result, expected, rtol=1e-6)
+
+
+def test_build_pyramid():
+
+    array = np.random.random((20, 30, 40))
+    proxy = ArrayProxy(array)
+
+    pyramid = build_pyramid(None, proxy, array.shape)
+    assert proxy.calls == 1
+    assert [stride for stride, _ in pyramid.levels] == [1, 2, 4, 8, 16, 32, 64]
+    assert pyramid.levels[0][1].dtype == np.float32
+    assert_equal(pyramid.levels[0][1], array.astype(np.float32))
+    # The coarser levels are the means over blocks of pixels
+    assert_allclose(pyramid.levels[2][1], reduce_reference(array, 4, np.mean), rtol=1e-6)
+
+    pyramid = build_pyramid(None, proxy, array.shape, reduction='max')
+    assert_allclose(pyramid.levels[2][1], reduce_reference(array, 4, np.max), rtol=1e-6)
+
+    # If the data is too large, the finest level combines blocks of pixels,
+    # which are computed in slabs.
+    proxy.calls = 0
+    pyramid = build_pyramid(None, proxy, array.shape, max_size=5000)
+    assert proxy.calls == 5
+    assert pyramid.levels[0][0] == 2
+    assert_allclose(pyramid.levels[0][1], reduce_reference(array, 2, np.mean), rtol=1e-6)
+    assert_allclose(pyramid.levels[2][1], reduce_reference(array, 8, np.mean), rtol=1e-6)
+
+    # Data that doesn't return values with the expected shape can't be used
+    proxy.compute_fixed_resolution_buffer = lambda bounds: array
+    assert build_pyramid(None, proxy, (20, 30, 50)) is None
+    assert build_pyramid(None, proxy, (0, 30, 40)) is None
+
+
+def test_pyramid_level():
+
+    pyramid = Pyramid(np.zeros((16, 16, 16)), 2, (32, 32, 32))
+
+    assert pyramid.level([(-0.5, 31.5, 16)] * 3)[0] == 2
+    assert pyramid.level([(-0.5, 31.5, 8)] * 3)[0] == 4
+    assert pyramid.level([(0, 31, 5)] * 3)[0] == 4
+    assert pyramid.level([(0, 30, 16), (0, 31, 32), (0, 30, 16)]) is None
+    assert not pyramid.can_resample([(-0.5, 31.5, 32)] * 3)
+
+    # If the finest level contains all the values, it can be resampled at
+    # any resolution.
+    pyramid = Pyramid(np.zeros((32, 32, 32)), 1, (32, 32, 32))
+    assert pyramid.level([(0, 3, 64)] * 3)[0] == 1
+
+
+def test_pyramid_resample():
+
+    array = np.random.random((20, 30, 40))
+    proxy = ArrayProxy(array)
+    pyramid = build_pyramid(None, proxy, array.shape)
+
+    # At the resolution of the data, resampling the pyramid is the same as
+    # computing the fixed resolution buffer of the data, including outside
+    # the data.
+    for bounds in ([(-0.5, 19.5, 20), (-0.5, 29.5, 30), (-0.5, 39.5, 40)],
+                   [(-3, 10, 14), (20, 35, 16), (5.2, 45.2, 41)]):
+        expected = proxy.compute_fixed_resolution_buffer(bounds).astype(np.float32)
+        assert_equal(pyramid.compute_fixed_resolution_buffer(bounds), expected)
+
+    # At lower resolution, the values come from a coarser level, where each
+    # value is at the centre of the block of pixels it covers.
+    result = pyramid.compute_fixed_resolution_buffer([(1.5, 17.5, 5), (1.5, 25.5, 7),
+                                                      (1.5, 37.5, 10)])
+    assert_allclose(result, reduce_reference(array, 4, np.mean)[:5, :7, :10], rtol=1e-6)
+
+    # The nearest block centre is used, so resampling a coarser level doesn't
+    # shift the values by more than half a pixel of that level.
+    result = pyramid.compute_fixed_resolution_buffer([(0, 16, 5), (0, 28, 8), (0, 36, 10)])
+    assert_allclose(result, reduce_reference(array, 4, np.mean)[:5, :8, :10], rtol=1e-6)
+
+    # Masks are zero outside of the data
+    mask = ArrayProxy(array > 0.5)
+    pyramid = build_pyramid(None, mask, array.shape, reduction='max')
+    bounds = [(-3, 10, 14), (20, 35, 16), (5.2, 45.2, 41)]
+    result = pyramid.compute_fixed_resolution_buffer(bounds)
+    assert result.dtype == bool
+    assert_equal(result, mask.compute_fixed_resolution_buffer(bounds))
+
+
+def test_pyramid_thin_structures():
+
+    # With the maximum, thin structures are kept at all levels, at the
+    # position of the block that contains them.
+    array = np.zeros((32, 32, 32))
+    array[13, :, :] = 1
+    pyramid = build_pyramid(None, ArrayProxy(array), array.shape, reduction='max')
+    for stride, values in pyramid.levels:
+        assert_equal(values.max(axis=(1, 2)), np.arange(values.shape[0]) == 13 // stride)
+
+    # Integer data is averaged, but is still zero outside of the data
+    array = np.arange(4 * 6 * 8).reshape((4, 6, 8))
+    pyramid = build_pyramid(None, ArrayProxy(array), array.shape, max_size=30)
+    assert pyramid.levels[0][0] == 2
+    result = pyramid.compute_fixed_resolution_buffer([(-3, 3, 3), (0.5, 4.5, 3),
+                                                      (0.5, 6.5, 4)])
+    assert_equal(result[0], 0)
+    assert_allclose(result[1:], reduce_reference(array, 2, np.mean)[:2])
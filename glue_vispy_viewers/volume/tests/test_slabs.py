@@ -0,0 +1,87 @@
+import numpy as np
+from numpy.testing import assert_equal
+
+import pytest
+
+from ..slabs import SlabBuffer, grid_offsets, snap_bounds
+
+
+class ArrayProxy(object):
+    """
+    Stand-in for DataProxy that samples an array at the nearest positions,
+    with NaN values outside the array, and records the number of values
+    computed.
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self.computed = 0
+
+    def compute_fixed_resolution_buffer(self, bounds):
+        self.computed += np.prod([bound[2] for bound in bounds])
+        indices = [np.round(np.linspace(*bound)).astype(int) for bound in bounds]
+        inside = [(index >= 0) & (index < size) for index, size in zip(indices, self.array.shape)]
+        result = np.full([bound[2] for bound in bounds], np.nan)
+        result[np.ix_(*inside)] = self.array[np.ix_(*[index[valid] for index, valid
+                                                      in zip(indices, inside)])]
+        return result
+
+
+def test_grid_offsets():
+
+    bounds = [(0, 15, 16), (-0.5, 31.5, 17), (2, 2, 1)]
+
+    assert grid_offsets(bounds, bounds) == [0, 0, 0]
+    assert grid_offsets(bounds, [(3, 18, 16), (-4.5, 27.5, 17), (2, 2, 1)]) == [3, -2, 0]
+
+    # Different resolution, spacing, or alignment with the grid
+    assert grid_offsets(bounds, [(0, 15, 15), (-0.5, 31.5, 17), (2, 2, 1)]) is None
+    assert grid_offsets(bounds, [(0, 30, 16), (-0.5, 31.5, 17), (2, 2, 1)]) is None
+    assert grid_offsets(bounds, [(0.5, 15.5, 16), (-0.5, 31.5, 17), (2, 2, 1)]) is None
+    assert grid_offsets(bounds, [(0, 15, 16), (-0.5, 31.5, 17), (3, 3, 1)]) is None
+
+    # No overlap
+    assert grid_offsets(bounds, [(16, 31, 16), (-0.5, 31.5, 17), (2, 2, 1)]) is None
+
+
+def test_snap_bounds():
+
+    bounds = [(0, 15, 16), (-0.5, 31.5, 17), (2, 17, 16)]
+
+    snapped = snap_bounds(bounds, [(2.6, 17.6, 16), (-1.2, 30.8, 17), (2, 17, 16)])
+    assert snapped == [(3, 18, 16), (-0.5, 31.5, 17), (2, 17, 16)]
+    assert grid_offsets(bounds, snapped) == [3, 0, 0]
+
+    # Bounds with a different spacing are not changed
+    zoomed = [(2.6, 16.6, 16), (-1.2, 30.8, 17), (2, 17, 16)]
+    assert snap_bounds(bounds, zoomed) is zoomed
+
+
+@pytest.mark.parametrize('offsets', [(0, 0, 0), (3, 0, 0), (0, -5, 0), (2, -3, 7), (-8, 9, -1)])
+def test_slab_buffer(offsets):
+
+    array = np.random.random((30, 40, 50))
+    proxy = ArrayProxy(array)
+    buffer = SlabBuffer(proxy)
+
+    # The bounds extend beyond the array along the first axis, so that the
+    # previous values include NaN values.
+    bounds = [(24, 39, 16), (2, 32, 16), (10, 25, 16)]
+    assert not buffer.can_shift(bounds)
+    assert_equal(buffer.compute_fixed_resolution_buffer(bounds),
+                 proxy.compute_fixed_resolution_buffer(bounds).astype(np.float32))
+
+    step = [1, 2, 1]
+    shifted = [(vmin + o * s, vmax + o * s, n)
+               for (vmin, vmax, n), o, s in zip(bounds, offsets, step)]
+
+    assert buffer.can_shift(shifted)
+    proxy.computed = 0
+    result = buffer.compute_fixed_resolution_buffer(shifted)
+
+    # Only the values that have come into view are computed
+    kept = np.prod([16 - abs(o) for o in offsets])
+    assert proxy.computed == 16 ** 3 - kept
+
+    expected = proxy.compute_fixed_resolution_buffer(shifted).astype(np.float32)
+    assert_equal(result, expected)
@@ -0,0 +1,1048 @@
+import re
+import threading
+import time
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+
+import pytest
+
+from ...common.gpu_memory import GPUMemoryTracker
+from ...common.vispy_widget import NestedSTTransform
+from .. import volume_visual
+from ..colors import LUT_SIZE
+from ..shaders import MAX_SAMPLED_TEXTURES
+from ..volume_visual import (MultiVolumeVisual, NoFreeSlotsError, axis_resolutions, cell_windows,
+                             clim_to_rescale, contains_nan, data_range, level_bounds,
+                             normalize_chunk, prepare_chunks, prepare_mask, progressive_levels,
+                             reduce_cells)
+
+
+class ArrayProxy(object):
+    """
+    Minimal stand-in for DataProxy that returns a fixed array.
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def compute_fixed_resolution_buffer(self, bounds):
+        return self.array
+
+
+class SamplingProxy(object):
+    """
+    Stand-in for DataProxy that samples an array at the nearest positions,
+    with NaN values outside the array.
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+    def compute_fixed_resolution_buffer(self, bounds):
+        indices = [np.round(np.linspace(*bound)).astype(int) for bound in bounds]
+        inside = [(index >= 0) & (index < size) for index, size in zip(indices, self.array.shape)]
+        result = np.full([bound[2] for bound in bounds], np.nan)
+        result[np.ix_(*inside)] = self.array[np.ix_(*[index[valid] for index, valid
+                                                      in zip(indices, inside)])]
+        return result
+
+
+class CountingProxy(SamplingProxy):
+    """
+    Stand-in for DataProxy that samples an array, has a shape, and counts
+    how many times the fixed resolution buffer is computed.
+    """
+
+    calls = 0
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def compute_fixed_resolution_buffer(self, bounds):
+        self.calls += 1
+        return super(CountingProxy, self).compute_fixed_resolution_buffer(bounds)
+
+
+class BoundsProxy(object):
+    """
+    Stand-in for DataProxy that records the bounds it is called with.
+    """
+
+    def __init__(self):
+        self.bounds = []
+
+    def compute_fixed_resolution_buffer(self, bounds):
+        self.bounds.append(bounds)
+        return np.zeros([bound[2] for bound in bounds], dtype=np.float32)
+
+
+def assemble(shape, chunks):
+    result = None
+    for offset, chunk in chunks:
+        if result is None:
+            result = np.zeros(tuple(shape) + chunk.shape[3:], dtype=chunk.dtype)
+        view = tuple(slice(o, o + s) for o, s in zip(offset, chunk.shape[:3]))
+        result[view] = chunk
+    return result
+
+
+def test_clim_to_rescale():
+    assert clim_to_rescale(None) == (1., 0.)
+    scale, offset = clim_to_rescale((2., 6.))
+    assert_allclose(np.array([2., 4., 6.]) * scale + offset, [0., 0.5, 1.])
+    scale, offset = clim_to_rescale((6., 2.))
+    assert_allclose(np.array([2., 4., 6.]) * scale + offset, [1., 0.5, 0.])
+    assert clim_to_rescale((3., 3.)) == (0., 0.)
+
+
+def test_prepare_chunks_raw_values():
+
+    array = np.random.uniform(-5, 5, (20, 30, 40))
+    bounds = [(0, 19, 20), (0, 29, 30), (0, 39, 40)]
+
+    shape, chunks, has_nan, vrange, cells = prepare_chunks(None, ArrayProxy(array), bounds, 16)
+
+    assert shape == (20, 30, 40)
+    assert not has_nan
+    assert vrange is None
+
+    chunks = list(chunks)
+    assert len(chunks) == 2 * 2 * 3
+
+    result = assemble(shape, chunks)
+    assert result.dtype == np.float32
+    assert_allclose(result, array, rtol=1e-6)
+
+
+def test_prepare_chunks_nan():
+
+    array = np.random.uniform(-5, 5, (20, 30, 40))
+    array[3, 4, 5] = np.nan
+    array[15, 20, 30] = np.nan
+    bounds = [(0, 19, 20), (0, 29, 30), (0, 39, 40)]
+
+    shape, chunks, has_nan, vrange, cells = prepare_chunks(None, ArrayProxy(array), bounds, 16)
+
+    assert has_nan
+
+    result = assemble(shape, chunks)
+    assert result.shape == (20, 30, 40, 2)
+
+    invalid = np.isnan(array)
+    assert_equal(result[..., 1], (~invalid).astype(np.float32))
+    assert_equal(result[..., 0][invalid], 0)
+    assert_allclose(result[..., 0][~invalid], array[~invalid], rtol=1e-6)
+
+    # Check that normalizing with scale * value + offset * valid is the same
+    # as normalizing and then setting NaN values to zero.
+    scale, offset = clim_to_rescale((-2, 3))
+    expected = (array - -2) / 5
+    expected[invalid] = 0
+    assert_allclose(result[..., 0] * scale + offset * result[..., 1], expected, atol=1e-6)
+
+
+@pytest.mark.parametrize(('precision', 'vrange'),
+                         [('float32', None), ('float16', (-5, 5)), ('uint16', (-5, 5)),
+                          ('uint8', (-5, 5))])
+def test_normalize_chunk(monkeypatch, precision, vrange):
+
+    # The chunks are processed in blocks, and the channel with valid values
+    # is only added once NaN values are found, so we check that the result
+    # is the same as processing the whole chunk at once when the NaN values
+    # are in a later block.
+    monkeypatch.setattr(volume_visual, 'NORMALIZE_BLOCK_SIZE', 100)
+
+    values = np.random.uniform(-5, 5, (20, 6, 7))
+    expected, has_nan = normalize_chunk(values, vrange, precision)
+    assert not has_nan
+    assert expected.shape == (20, 6, 7)
+
+    # The channel with valid values can also be requested when there are no
+    # NaN values in the chunk.
+    result, has_nan = normalize_chunk(values, vrange, precision, valid=True)
+    maxval = np.iinfo(result.dtype).max if result.dtype.kind == 'u' else 1
+    assert has_nan
+    assert_equal(result[..., 0], expected)
+    assert_equal(result[..., 1], maxval)
+
+    values[15, 2, 3] = np.nan
+    result, has_nan = normalize_chunk(values, vrange, precision)
+    assert has_nan
+    assert result.shape == (20, 6, 7, 2)
+    assert result.dtype == expected.dtype
+
+    invalid = np.isnan(values)
+    assert_equal(result[..., 0][~invalid], expected[~invalid])
+    assert_equal(result[..., 0][invalid], 0)
+    assert_equal(result[..., 1], (~invalid) * maxval)
+
+    # The input values should not be modified
+    assert np.isnan(values[15, 2, 3])
+
+
+def test_normalize_chunk_no_copy():
+
+    # Contiguous float32 values without NaN values don't need to be copied
+    # if the raw values are kept.
+    values = np.random.random((10, 12, 14)).astype(np.float32)
+    assert normalize_chunk(values)[0] is values
+    assert normalize_chunk(values[:, :6])[0] is not values
+    assert normalize_chunk(values, (0, 1), 'float16')[0] is not values
+    assert normalize_chunk(values, valid=True)[0] is not values
+
+
+def test_contains_nan():
+    values = np.ones((10, 12, 14))
+    assert not contains_nan(values)
+    values[7, 3, 2] = np.inf
+    assert not contains_nan(values)
+    assert not contains_nan(values, (0, 1))
+    # If all the values are mapped to zero, infinite values give NaN
+    assert contains_nan(values, (1, 1))
+    values[8, 3, 2] = np.nan
+    assert contains_nan(values)
+    assert not contains_nan(np.ones((3, 4, 5), dtype=int))
+
+
+def test_data_range():
+    assert data_range(np.array([3., np.nan, -2., 1.])) == (-2., 3.)
+    assert data_range(np.array([3., np.inf, -2., -np.inf])) == (-2., 3.)
+    assert data_range(np.array([np.nan, np.nan])) == (0., 1.)
+    assert data_range(np.array([1, 5, 2])) == (1., 5.)
+
+
+@pytest.mark.parametrize(('precision', 'dtype', 'atol'),
+                         [('float16', np.float32, 1e-6),
+                          ('uint16', np.uint16, 1 / 65535),
+                          ('uint8', np.uint8, 1 / 255)])
+def test_prepare_chunks_quantized(precision, dtype, atol):
+
+    array = np.random.uniform(-5, 5, (20, 30, 40))
+    array[3, 4, 5] = np.nan
+    bounds = [(0, 19, 20), (0, 29, 30), (0, 39, 40)]
+
+    shape, chunks, has_nan, vrange, cells = prepare_chunks(None, ArrayProxy(array), bounds, 16,
+                                                           precision=precision)
+
+    assert has_nan
+    assert vrange == (np.nanmin(array), np.nanmax(array))
+
+    result = assemble(shape, chunks)
+    assert result.dtype == dtype
+
+    # Convert back to values in the range [0:1] as seen by the shader
+    maxval = np.iinfo(dtype).max if result.dtype.kind == 'u' else 1
+    result = result / maxval
+
+    invalid = np.isnan(array)
+    assert_equal(result[..., 1], (~invalid).astype(np.float32))
+    assert_equal(result[..., 0][invalid], 0)
+
+    # Check that the rescale values used by the visual give the same result
+    # as normalizing the raw values
+    scale, offset = clim_to_rescale((-2, 3))
+    offset += scale * vrange[0]
+    scale *= vrange[1] - vrange[0]
+    expected = (array - -2) / 5
+    expected[invalid] = 0
+    assert_allclose(result[..., 0] * scale + offset * result[..., 1], expected,
+                    atol=atol * 2)
+
+
+def test_lazy_textures():
+
+    # Textures should only be created once there is data to upload, with
+    # the shape of the data, and should be released again on deallocation.
+
+    visual = MultiVolumeVisual(resolution=16)
+    visual._data_bounds = [(0, 9, 10), (0, 11, 12), (0, 13, 14)]
+
+    assert visual.textures == []
+
+    visual.allocate('a')
+    visual.allocate('b')
+
+    assert visual.textures == [None] * 2
+
+    visual.set_clim('b', (0, 1))
+    visual.set_data('b', ArrayProxy(np.random.random((10, 12, 14))))
+
+    assert visual.textures[0] is None
+    assert visual.textures[1].shape == (10, 12, 14, 1)
+    assert visual.texture_memory('b') == (10 * 12 * 14 * 4,) * 2
+
+    visual.deallocate('b')
+
+    assert visual.textures == [None] * 2
+
+
+def test_prepare_mask():
+
+    mask = np.zeros((100, 30, 40))
+    mask[10, 5, 5] = 1
+    mask[90, 5, 5] = np.nan
+
+    shape, chunks, cells = prepare_mask(None, ArrayProxy(mask), None)
+
+    assert shape == (100, 30, 40)
+    assert len(chunks) == 2
+
+    result = assemble(shape, [chunk[:2] for chunk in chunks])
+    assert result.dtype == bool
+    assert_equal(result, mask > 0)
+
+    # The digests should only depend on the contents of the chunks
+    assert chunks[0][2] != chunks[1][2]
+    mask[90, 5, 5] = 0
+    assert prepare_mask(None, ArrayProxy(mask), None)[1][1][2] == chunks[1][2]
+
+
+def test_packed_masks():
+
+    # Masks in the same group should share a single texture, with one bit
+    # per mask.
+
+    visual = MultiVolumeVisual(n_volume_max=2, resolution=16)
+    visual._data_bounds = [(0, 9, 10), (0, 11, 12), (0, 13, 14)]
+
+    masks = [np.random.random((10, 12, 14)) > 0.5 for i in range(3)]
+
+    for i, mask in enumerate(masks):
+        visual.allocate(str(i), group='data')
+        visual.set_clim(str(i), None)
+        visual.set_data(str(i), ArrayProxy(mask))
+
+    assert [visual.volumes[str(i)]['slot'] for i in range(3)] == [0, 0, 0]
+    assert [visual.volumes[str(i)]['bit'] for i in range(3)] == [0, 1, 2]
+    assert visual.textures[0].shape == (10, 12, 14, 1)
+    assert len(visual.textures) == 1
+    assert visual.texture_memory('0') == (10 * 12 * 14 * 2 // 3, 10 * 12 * 14 * 4)
+
+    packed = visual._masks[0]['packed'][..., 0]
+    for i, mask in enumerate(masks):
+        assert_equal((packed >> i) & 1, mask)
+
+    # There is one texture slot left, which can be used by another dataset
+    # or by masks from another group, but not both.
+    assert visual.can_allocate()
+    assert visual.can_allocate(group='other')
+    visual.allocate('data')
+    assert not visual.can_allocate()
+    assert not visual.can_allocate(group='other')
+    assert visual.can_allocate(group='data')
+
+    # Removing a mask should clear its bit, which is then used again
+    visual.deallocate('1')
+    assert_equal(packed & 2, 0)
+    visual.allocate('3', group='data')
+    assert visual.volumes['3']['bit'] == 1
+
+    for i in ('0', '2', '3'):
+        visual.deallocate(i)
+    assert visual.textures[0] is None
+    assert visual._masks == {}
+
+
+def test_many_layers():
+
+    # There is no limit on the number of layers other than memory. Masks in
+    # the same group are packed into the channels of a texture, which gains
+    # channels as needed while keeping the other masks.
+
+    visual = MultiVolumeVisual(resolution=16)
+    visual._data_bounds = [(0, 9, 10), (0, 11, 12), (0, 13, 14)]
+
+    masks = [np.random.random((10, 12, 14)) > 0.5 for i in range(70)]
+
+    for i, mask in enumerate(masks):
+        visual.allocate(str(i), group='data')
+        visual.set_clim(str(i), None)
+        visual.set_data(str(i), ArrayProxy(mask))
+        if i == 15:
+            assert visual.textures[0].shape == (10, 12, 14, 1)
+        elif i == 16:
+            assert visual.textures[0].shape == (10, 12, 14, 2)
+
+    assert visual.textures[0].shape == (10, 12, 14, 4)
+    assert visual.textures[1].shape == (10, 12, 14, 1)
+    assert visual.texture_memory('0') == (10 * 12 * 14 * 8 // 64, 10 * 12 * 14 * 4)
+
+    for i, mask in enumerate(masks):
+        slot, bit = divmod(i, 64)
+        channel, bit = divmod(bit, 16)
+        packed = visual._masks[slot]['packed'][..., channel]
+        assert_equal((packed >> bit) & 1, mask)
+
+    for i in range(20):
+        visual.allocate('data{0}'.format(i))
+    assert visual.can_allocate()
+    assert len(visual.textures) == 22
+    assert visual._n_layer_max == 128
+    assert visual.shared_program['u_colormaps_shape'] == (LUT_SIZE, 128)
+
+    # The shader samples the channel that contains the bit for each mask
+    visual.enable('17')
+    assert 'mask_bit(texel_0.g, u_bit_17)' in visual._shader_cache
+
+
+def test_packed_layers():
+
+    # With packing enabled, layers with the same shape and precision should
+    # share a texture, using one channel each (or two for layers with NaN
+    # values), and each texture should only be sampled once per step.
+
+    visual = MultiVolumeVisual(resolution=16, packed=True)
+    visual._data_bounds = [(0, 9, 10), (0, 11, 12), (0, 13, 14)]
+
+    arrays = [np.random.random((10, 12, 14)).astype(np.float32) for i in range(4)]
+    arrays[1][0, 0, 0] = np.nan
+
+    for i in range(4):
+        visual.allocate(str(i))
+    for i, array in enumerate(arrays):
+        visual.set_clim(str(i), (0, 1))
+        visual.set_data(str(i), ArrayProxy(array))
+        visual.enable(str(i))
+
+    assert [(visual.volumes[str(i)]['pack'], visual.volumes[str(i)]['channel'])
+            for i in range(4)] == [(4, 0), (4, 1), (4, 3), (5, 0)]
+    assert visual.textures[:4] == [None] * 4
+    assert visual.textures[4].shape == (10, 12, 14, 4)
+    assert visual.textures[5].shape == (10, 12, 14, 1)
+    assert visual.texture_memory('1') == (10 * 12 * 14 * 8,) * 2
+
+    packed = visual._packs[4]['packed']
+    assert_equal(packed[..., 0], arrays[0])
+    assert_equal(packed[..., 1], np.nan_to_num(arrays[1]))
+    assert_equal(packed[..., 2], ~np.isnan(arrays[1]))
+    assert_equal(packed[..., 3], arrays[2])
+
+    shader = visual._shader_cache
+    assert shader.count('$sample(u_volumetex_4, loc)') == 2
+    assert 'rescale(texel_4.gb, u_rescale_1)' in shader
+    assert 'rescale(texel_4.aa, u_rescale_2)' in shader
+
+    # The channels that are no longer used are released once layers are
+    # removed, and layers with a different precision use another texture.
+    # Until then, these count towards the memory shared by all layers.
+    shared = visual.memory_usage()[None]
+    visual.deallocate('2')
+    assert visual.textures[4].shape == (10, 12, 14, 4)
+    assert visual.memory_usage()[None] == shared + 10 * 12 * 14 * 4
+    visual.deallocate('1')
+    assert visual.textures[4].shape == (10, 12, 14, 1)
+    assert_equal(visual._packs[4]['packed'][..., 0], arrays[0])
+    visual.set_precision('0', 'uint8')
+    assert visual.volumes['0']['pack'] == 1
+    assert visual.textures[1].shape == (10, 12, 14, 1)
+    assert visual.textures[4] is None
+
+    for i in ('0', '3'):
+        visual.deallocate(i)
+    assert visual._packs == {}
+    assert visual.textures == [None] * 6
+
+
+def test_mask_partial_upload(monkeypatch):
+
+    # When a mask changes, only the chunks that have changed should be
+    # uploaded again.
+
+    visual = MultiVolumeVisual(resolution=16)
+    visual._data_bounds = [(0, 99, 100), (0, 29, 30), (0, 39, 40)]
+
+    masks = [np.random.random((100, 30, 40)) > 0.5 for i in range(2)]
+
+    for i, mask in enumerate(masks):
+        visual.allocate(str(i), group='data')
+        visual.set_clim(str(i), None)
+        visual.set_data(str(i), ArrayProxy(mask))
+
+    uploads = []
+    texture = visual.textures[0]
+    monkeypatch.setattr(texture, 'set_data',
+                        lambda data, offset: uploads.append((offset, data.copy())))
+
+    masks[1][80, 20, 30] = ~masks[1][80, 20, 30]
+    visual._update_scaled_data('1')
+
+    assert len(uploads) == 1
+    assert uploads[0][0] == (64, 0, 0)
+    assert_equal(uploads[0][1], visual._masks[0]['packed'][64:])
+
+    packed = visual._masks[0]['packed'][..., 0]
+    for i, mask in enumerate(masks):
+        assert_equal((packed >> i) & 1, mask)
+
+    # If nothing has changed, nothing should be uploaded
+    visual._update_scaled_data('0')
+    assert len(uploads) == 1
+
+
+def test_progressive_levels():
+    assert progressive_levels(32) == [32]
+    assert progressive_levels(64) == [64]
+    assert progressive_levels(100) == [64, 100]
+    assert progressive_levels(512) == [64, 128, 256, 512]
+
+
+def test_level_bounds():
+
+    data_bounds = [(-0.5, 99.5, 200), (2, 3, 8), (0, 10, 400)]
+    bounds = level_bounds(data_bounds, 50)
+
+    assert bounds[1] == (2, 3, 8)
+    assert bounds[0][2] == bounds[2][2] == 50
+
+    # The coarse values should be at the texture coordinates of the middle of
+    # the full resolution values they replace.
+    for (vmin, vmax, n), (cmin, cmax, size) in zip(data_bounds, bounds):
+        coarse = np.linspace(cmin, cmax, size)
+        full = np.linspace(vmin, vmax, n)
+        expected = full.reshape((size, -1)).mean(axis=1)
+        assert_allclose(coarse, expected)
+
+
+def test_progressive_loading(monkeypatch):
+
+    # The polling is normally done with a timer, but we do it by hand here
+    monkeypatch.setattr(MultiVolumeVisual, '_start_polling', lambda self: None)
+
+    # The chunks should be normalized in the worker threads rather than in
+    # the main thread, which only uploads them.
+    threads = []
+
+    def record_thread(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return normalize_chunk(*args, **kwargs)
+
+    monkeypatch.setattr(volume_visual, 'normalize_chunk', record_thread)
+
+    visual = MultiVolumeVisual(resolution=200, background=True, progressive=True)
+    visual._data_bounds = [(0, 199, 200)] * 3
+
+    proxy = BoundsProxy()
+    shapes = []
+    visual.events.upload.connect(lambda event: shapes.append(visual.textures[0].shape[:3]))
+
+    visual.allocate('a')
+    visual.set_clim('a', (0, 1))
+    visual.set_data('a', proxy)
+
+    while visual.pending:
+        time.sleep(0.01)
+        visual._poll_pipeline()
+
+    assert [bounds[0][2] for bounds in proxy.bounds] == [64, 128, 200]
+    assert shapes == [(64, 64, 64), (128, 128, 128), (200, 200, 200)]
+    assert proxy.bounds[-1] == visual._data_bounds
+    assert len(threads) > 0
+    assert threading.main_thread() not in threads
+
+    # Updating the data again should restart from the coarsest level, and
+    # cancel any refinement in progress.
+    del proxy.bounds[:], shapes[:]
+    visual._update_scaled_data('a')
+    visual._update_scaled_data('a')
+    while visual.pending:
+        time.sleep(0.01)
+        visual._poll_pipeline()
+
+    assert shapes == [(64, 64, 64), (128, 128, 128), (200, 200, 200)]
+
+
+@pytest.mark.parametrize(('size', 'ncells'), [(64, 8), (50, 8), (5, 8), (100, 7)])
+def test_cell_windows(size, ncells):
+
+    # Each window should include all the values used when interpolating at
+    # any position inside the cell, using the same convention as OpenGL.
+    windows = cell_windows(size, ncells)
+    for icell, (start, stop) in enumerate(windows):
+        for u in np.linspace(icell / ncells, (icell + 1) / ncells, 101):
+            index = np.floor(u * size - 0.5)
+            for i in (index, index + 1):
+                assert start <= np.clip(i, 0, size - 1) < stop
+
+
+def test_reduce_cells():
+
+    array = np.random.random((20, 30, 17))
+    array[3:9, 4:7, 2:5] = np.nan
+    grid = (4, 3, 5)
+
+    result = reduce_cells(array, grid, np.fmax)
+    assert result.shape == grid
+
+    windows = [cell_windows(n, ncells) for n, ncells in zip(array.shape, grid)]
+    for index in np.ndindex(*grid):
+        view = tuple(slice(*windows[axis][i]) for axis, i in enumerate(index))
+        assert result[index] == np.nanmax(array[view])
+
+    assert reduce_cells(np.zeros((0, 3, 3)), grid, np.fmax) is None
+
+
+def test_occupancy():
+
+    visual = MultiVolumeVisual(resolution=32)
+    visual.transform = NestedSTTransform()
+
+    array = np.full((32, 32, 32), np.nan)
+    array[0:8, 0:8, 0:8] = 3.
+    array[24:, 24:, 24:] = 1.
+
+    visual.allocate('a')
+    visual.set_clim('a', (0, 5))
+    visual.set_data('a', ArrayProxy(array))
+    visual._update_slice_transform(0, 31, 0, 31, 0, 31)
+
+    # Nothing is occupied until the layer is enabled
+    assert not visual._occupied_cells().any()
+
+    visual.enable('a')
+
+    windows = [cell_windows(32, 4)] * 3
+
+    for clim in [(0, 5), (2, 5), (2, 0)]:
+        visual.set_clim('a', clim)
+        scale, offset = clim_to_rescale(clim)
+        expected = np.zeros((4, 4, 4), dtype=bool)
+        for index in np.ndindex(4, 4, 4):
+            view = tuple(slice(*windows[axis][i]) for axis, i in enumerate(index))
+            expected[index] = np.nanmax(array[view] * scale + offset, initial=0) > 0
+        assert_equal(visual._occupied_cells(), expected)
+        assert expected.any() and not expected.all()
+
+
+def test_render_mode():
+
+    visual = MultiVolumeVisual(resolution=32)
+    visual.transform = NestedSTTransform()
+
+    lut = np.ones((256, 4), dtype=np.float32)
+    lut[:, 3] = np.linspace(0, 1, 256)
+
+    visual.allocate('a')
+    visual.set_cmap('a', lut)
+    visual.set_clim('a', (0, 1))
+    visual.set_data('a', ArrayProxy(np.zeros((32, 32, 32))))
+    visual.enable('a')
+    visual._update_slice_transform(-0.5, 63.5, -0.5, 31.5, -0.5, 31.5)
+
+    assert 'max_val_0' in visual._shader_cache
+    assert 'composite' not in visual._shader_cache
+
+    visual.set_render_mode('composite')
+    assert 'max_val_0' not in visual._shader_cache
+    assert 'composite.a > 0.99' in visual._shader_cache
+    assert 'occupancy(loc) == 0.' in visual._shader_cache
+
+    # The opacity is corrected for texture voxels covering two voxels of
+    # the data along x.
+    assert visual.shared_program['u_voxel_scale'] == 2
+
+    # Empty regions can't be skipped if the colormap is opaque for zero values
+    lut[:, 3] = 1
+    visual.set_cmap('a', lut)
+    assert 'occupancy(loc) == 0.' not in visual._shader_cache
+
+    with pytest.raises(ValueError):
+        visual.set_render_mode('mip')
+
+
+def test_shader_layers():
+
+    # Only the layers that are shown are included in the shader, and the
+    # program for each shader is reused when showing the same layers again.
+
+    visual = MultiVolumeVisual(resolution=32)
+
+    for label in 'abc':
+        visual.allocate(label)
+
+    assert 'u_volumetex' not in visual._shader_cache
+
+    visual.enable('a')
+    program_a = visual._program
+    assert 'u_volumetex_0' in visual._shader_cache
+    assert 'u_volumetex_1' not in visual._shader_cache
+    assert 'u_enabled' not in visual._shader_cache
+
+    # Layers that are multiplied by another layer also sample the texture for
+    # that layer, even if it isn't shown.
+    visual.set_multiply('c', 'b')
+    visual.enable('c')
+    program_ac = visual._program
+    assert program_ac is not program_a
+    assert 'u_volumetex_1' in visual._shader_cache
+    assert 'u_weight_1' not in visual._shader_cache
+    assert 'u_weight_2' in visual._shader_cache
+
+    visual.disable('c')
+    assert visual._program is program_a
+    visual.enable('c')
+    assert visual._program is program_ac
+    assert len(visual._programs) == 3
+
+    assert visual.enabled[:3] == [True, False, True]
+
+
+def test_sampled_textures():
+
+    # Only a limited number of textures can be sampled at once, so layers
+    # can't be shown or added once these are all in use, and the shader never
+    # samples more textures than that.
+
+    visual = MultiVolumeVisual(resolution=16)
+
+    def n_sampled():
+        return len(re.findall(r'uniform \S+ u_volumetex_\d+;', visual._shader_cache))
+
+    for i in range(MAX_SAMPLED_TEXTURES + 1):
+        visual.allocate(str(i))
+    for i in range(MAX_SAMPLED_TEXTURES):
+        visual.enable(str(i))
+    assert n_sampled() == MAX_SAMPLED_TEXTURES
+
+    last = str(MAX_SAMPLED_TEXTURES)
+    assert not visual.can_enable(last)
+    assert not visual.can_allocate()
+    with pytest.raises(NoFreeSlotsError):
+        visual.enable(last)
+    assert not visual.enabled[MAX_SAMPLED_TEXTURES]
+
+    # Layers that are already shown can be enabled again
+    assert visual.can_enable('3')
+
+    # Hiding a layer frees up a texture
+    visual.disable('0')
+    assert visual.can_allocate()
+    visual.enable(last)
+    assert n_sampled() == MAX_SAMPLED_TEXTURES
+
+    # If a layer is multiplied by a layer that isn't shown, its texture is
+    # also sampled, so the layers added last are no longer shown.
+    visual.set_multiply('1', '0')
+    assert n_sampled() == MAX_SAMPLED_TEXTURES
+    assert 'u_weight_1' in visual._shader_cache
+    assert 'u_weight_{0}'.format(MAX_SAMPLED_TEXTURES) not in visual._shader_cache
+
+
+def test_bytes_per_voxel():
+
+    # The memory per voxel only depends on the layers and their precisions,
+    # assuming that all the layers have a channel for NaN values.
+    visual = MultiVolumeVisual()
+    assert visual.bytes_per_voxel() == 0
+
+    visual.allocate('a')
+    visual.allocate('b')
+    assert visual.bytes_per_voxel() == 16
+
+    visual.set_precision('b', 'uint8')
+    assert visual.bytes_per_voxel() == 10
+
+    # Masks use 16-bit channels shared by the masks in each group
+    for i in range(17):
+        visual.allocate('m{0}'.format(i), group='g')
+    assert visual.bytes_per_voxel() == 14
+
+
+def test_gpu_memory_budget(monkeypatch):
+
+    # Once the GPU memory budget is exceeded, the textures of the layers that
+    # are hidden are evicted, starting with the least recently shown ones,
+    # and are prepared again once the layers are used again.
+
+    tracker = GPUMemoryTracker(budget=None)
+    monkeypatch.setattr(volume_visual, 'gpu_memory', tracker)
+
+    visual = MultiVolumeVisual(resolution=16)
+    visual._data_bounds = [(0, 9, 10), (0, 11, 12), (0, 13, 14)]
+    nbytes = 10 * 12 * 14 * 4
+
+    for label in 'abc':
+        visual.allocate(label)
+        visual.set_clim(label, (0, 1))
+        visual.set_data(label, ArrayProxy(np.random.random((10, 12, 14))))
+        visual.enable(label)
+
+    usage = visual.memory_usage()
+    assert [usage[label] for label in 'abc'] == [nbytes] * 3
+    assert usage[None] > 0
+    assert tracker.nbytes == sum(usage.values())
+
+    visual.disable('b')
+    visual.disable('a')
+    assert [label for _, label in sorted(visual.evictable())] == ['b', 'a']
+
+    tracker.set_budget(tracker.nbytes - 1)
+    assert visual.texture_memory('b') == (0, 0)
+    assert visual.textures[visual.volumes['b']['slot']] is None
+    assert visual.texture_memory('a')[0] == nbytes
+    assert tracker.evictions == 1
+
+    # Showing the layer again prepares its texture, which means that the
+    # other hidden layer now needs to be evicted.
+    visual.enable('b')
+    assert visual.texture_memory('b')[0] == nbytes
+    assert visual.texture_memory('a') == (0, 0)
+
+    # Layers used to multiply a layer that is shown are also in use
+    visual.set_multiply('c', 'a')
+    assert visual.texture_memory('a')[0] == nbytes
+    assert visual.evictable() == []
+
+
+def test_bricks():
+
+    # If the resolution is lower than that of the data, the visible bricks
+    # should be loaded into the brick cache at the resolution of the data.
+
+    visual = MultiVolumeVisual(resolution=16, bricked=True)
+    visual.transform = NestedSTTransform()
+
+    # This value isn't sampled at the resolution of the viewer
+    array = np.zeros((40, 64, 64))
+    array[38, 50, 50] = 2.
+
+    visual.allocate('a')
+    visual.set_clim('a', (0, 1))
+    visual.set_data('a', SamplingProxy(array))
+    visual.allocate('mask', group='data')
+    visual.set_clim('mask', None)
+    visual.set_data('mask', SamplingProxy(array > 1))
+    visual._update_slice_transform(-0.5, 63.5, -0.5, 63.5, -0.5, 39.5)
+
+    assert visual._brick_grid == ((0, 0, 0), (2, 2, 2))
+    assert visual.volumes['a']['bricked']
+    assert not visual.volumes['mask']['bricked']
+
+    # The rays are only sampled more finely once bricks are loaded
+    assert visual.shared_program['u_downsample'] == 1
+
+    # Bricks are only loaded for enabled layers, once the view is known.
+    # Here, we make sure everything is visible.
+    visual._brick_matrix = np.diag([1e-3, 1e-3, 1e-3, 1])
+    assert len(visual._brick_cache) == 0
+    visual.enable('a')
+    visual.enable('mask')
+    assert sorted(visual._brick_cache.keys()) == [('a', brick) for brick in np.ndindex(2, 2, 2)]
+    assert visual.shared_program['u_downsample'] == 0.25
+
+    # The bricks aren't sampled while the layer is hidden
+    visual.disable('a')
+    assert visual.shared_program['u_downsample'] == 1
+    visual.enable('a')
+    assert visual.shared_program['u_downsample'] == 0.25
+
+    # No bricks are loaded while the view is changed interactively, and the
+    # visible bricks are found again once the interaction stops.
+    visual.set_interacting(True)
+    visual._discard_bricks('a')
+    visual._request_bricks()
+    assert len(visual._brick_cache) == 0
+    visual.set_interacting(False)
+    assert visual._brick_matrix is None
+    visual._brick_matrix = np.diag([1e-3, 1e-3, 1e-3, 1])
+    visual._request_bricks()
+    assert len(visual._brick_cache) == 8
+    assert visual._brick_cache.value(('a', (1, 1, 1))) == (0., 2.)
+    assert visual._brick_cache.value(('a', (0, 0, 0))) == (0., 0.)
+
+    # The occupancy at the resolution of the viewer misses the value, but
+    # the bricks don't.
+    assert visual.volumes['a']['cells'][1][-1, -1, -1] == 0
+    assert visual._occupied_cells()[-1, -1, -1]
+    assert not visual._occupied_cells()[0, 0, 0]
+
+    # Changing the data should reload the bricks
+    array[...] = 3.
+    visual._update_scaled_data('a')
+    assert visual._brick_cache.value(('a', (0, 0, 0))) == (3., 3.)
+
+    # The bricks are kept when zooming in, since they are on the grid of the
+    # reference data, but aren't used if the resolution is high enough.
+    visual._update_slice_transform(-0.5, 39.5, -0.5, 63.5, -0.5, 39.5)
+    assert visual._brick_grid == ((0, 0, 0), (2, 2, 2))
+    assert len(visual._brick_cache) == 8
+    visual._update_slice_transform(-0.5, 15.5, -0.5, 15.5, -0.5, 15.5)
+    assert visual._brick_grid is None
+    assert not visual.volumes['a']['bricked']
+    assert visual.shared_program['u_downsample'] == 1
+
+    visual.deallocate('a')
+    assert len(visual._brick_cache) == 0
+
+
+def test_pyramid(monkeypatch):
+
+    # Once the pyramid for a layer has been built, zooming and panning should
+    # resample the pyramid rather than computing the fixed resolution buffer.
+
+    monkeypatch.setattr(MultiVolumeVisual, '_start_polling', lambda self: None)
+
+    uploads = []
+    upload_chunks = MultiVolumeVisual._upload_chunks
+
+    def record_chunks(self, label, shape, chunks, *args):
+        chunks = list(chunks)
+        uploads.append(assemble(shape, chunks))
+        return upload_chunks(self, label, shape, chunks, *args)
+
+    monkeypatch.setattr(MultiVolumeVisual, '_upload_chunks', record_chunks)
+
+    def wait(visual):
+        while visual.pending:
+            time.sleep(0.01)
+            visual._poll_pipeline()
+
+    visual = MultiVolumeVisual(resolution=32, background=True, progressive=True)
+    visual.transform = NestedSTTransform()
+
+    array = np.random.random((40, 50, 60))
+    proxy = CountingProxy(array)
+
+    visual.allocate('a')
+    visual.set_clim('a', (0, 1))
+    visual.set_data('a', proxy)
+    visual._update_slice_transform(-0.5, 59.5, -0.5, 49.5, -0.5, 39.5)
+    wait(visual)
+
+    # One call for the texture and one for the pyramid
+    assert proxy.calls == 2
+    assert visual.volumes['a']['pyramid'] is not None
+
+    del uploads[:]
+    visual._update_slice_transform(9.5, 39.5, 4.5, 34.5, 19.5, 49.5)
+    wait(visual)
+
+    assert proxy.calls == 2
+    assert len(uploads) == 1
+    # The view extends beyond the data, so the texture includes whether each
+    # value is valid.
+    expected = proxy.compute_fixed_resolution_buffer(visual._data_bounds)
+    valid = ~np.isnan(expected)
+    assert_equal(uploads[0][..., 1], valid)
+    assert_equal(uploads[0][..., 0][valid], expected[valid].astype(np.float32))
+
+    # Changing the data invalidates the pyramid
+    array[...] = 0.5
+    visual._update_scaled_data('a')
+    assert 'pyramid' not in visual.volumes['a']
+    wait(visual)
+    assert visual.volumes['a']['pyramid'].levels[0][1].max() == 0.5
+
+    # When showing the maximum along each ray, the coarser levels keep the
+    # maximum values, and when compositing they are averaged, so the pyramid
+    # is built again when the render mode changes.
+    assert visual.volumes['a']['pyramid'].reduction == 'max'
+    visual.set_render_mode('composite')
+    wait(visual)
+    assert visual.volumes['a']['pyramid'].reduction == 'mean'
+
+
+def test_pan_reuses_values(monkeypatch):
+
+    # When panning, only the values that come into view should be computed.
+
+    uploads = []
+    upload_chunks = MultiVolumeVisual._upload_chunks
+
+    def record_chunks(self, label, shape, chunks, *args):
+        chunks = list(chunks)
+        uploads.append(assemble(shape, chunks))
+        return upload_chunks(self, label, shape, chunks, *args)
+
+    monkeypatch.setattr(MultiVolumeVisual, '_upload_chunks', record_chunks)
+
+    visual = MultiVolumeVisual(resolution=16)
+    visual.transform = NestedSTTransform()
+
+    array = np.random.random((64, 64, 64))
+    sampling = SamplingProxy(array)
+    proxy = SamplingProxy(array)
+
+    calls = []
+
+    def compute(bounds):
+        calls.append(bounds)
+        return sampling.compute_fixed_resolution_buffer(bounds)
+
+    proxy.compute_fixed_resolution_buffer = compute
+
+    visual.allocate('a')
+    visual.set_clim('a', (0, 1))
+    visual.set_data('a', proxy)
+    visual._update_slice_transform(-0.5, 31.5, -0.5, 31.5, -0.5, 31.5)
+    assert len(calls) == 1
+
+    # Pan by about two steps along x - the bounds are moved slightly so that
+    # they are on the same grid as before.
+    visual._update_slice_transform(3.5, 35.5, -0.5, 31.5, -0.5, 31.5)
+    assert_allclose(visual._data_bounds[2], (-0.5 + 64 / 15, 31.5 + 64 / 15, 16))
+    assert len(calls) == 2
+    assert calls[1][2][2] == 2
+    expected = sampling.compute_fixed_resolution_buffer(visual._data_bounds)
+    assert_equal(uploads[-1], expected.astype(np.float32))
+
+    # Zooming needs all the values to be computed again
+    visual._update_slice_transform(3.5, 19.5, -0.5, 31.5, -0.5, 31.5)
+    assert len(calls) == 3
+    assert calls[2] == visual._data_bounds
+
+    # As does changing the data
+    visual._update_scaled_data('a')
+    assert len(calls) == 4
+
+
+def test_axis_resolutions():
+
+    # There are no more voxels than pixels along each axis
+    assert axis_resolutions((2048, 2048, 64), 256) == (256, 256, 64)
+    assert axis_resolutions((10, 20.5, 30), 256) == (10, 21, 30)
+
+    # With a budget, the voxels are about the same size along each axis
+    assert axis_resolutions((2048, 2048, 64), 256, voxel_budget=2 ** 20) == (256, 256, 16)
+    assert axis_resolutions((2048, 2048, 64), 2048, voxel_budget=256 ** 3) == (803, 803, 26)
+    assert axis_resolutions((100, 100, 100), 256, voxel_budget=1000) == (10, 10, 10)
+
+
+def test_anisotropic_resolution():
+
+    visual = MultiVolumeVisual(resolution=32)
+    visual.transform = NestedSTTransform()
+
+    array = np.random.random((8, 64, 64))
+    proxy = SamplingProxy(array)
+
+    visual.allocate('a')
+    visual.set_clim('a', (0, 1))
+    visual.set_data('a', proxy)
+    visual._update_slice_transform(-0.5, 63.5, -0.5, 63.5, -0.5, 7.5)
+
+    assert visual._data_bounds == [(-0.5, 7.5, 8), (-0.5, 63.5, 32), (-0.5, 63.5, 32)]
+    assert visual.textures[0].shape[:3] == (8, 32, 32)
+    assert visual._vol_shape == (8, 32, 32)
+    assert_allclose(visual.shared_program['u_shape'], (32, 32, 8))
+    assert_allclose(visual.transform.inner.scale[:3], (2, 2, 1))
+
+    visual.set_resolution(64, voxel_budget=64 * 64 * 4)
+    visual._update_slice_transform(-0.5, 63.5, -0.5, 63.5, -0.5, 7.5)
+    assert visual.textures[0].shape[:3] == (6, 49, 49)
+
+    # When downsampling, the number of steps is based on the shortest axis,
+    # so elongated volumes aren't rendered more coarsely than cubes, and
+    # thin volumes don't take more steps than without downsampling.
+    visual.downsample()
+    assert visual.shared_program['u_downsample'] == 1
+    visual.set_resolution(200)
+    visual._update_slice_transform(-0.5, 199.5, -0.5, 199.5, -0.5, 39.5)
+    assert visual._vol_shape == (40, 200, 200)
+    visual.downsample()
+    assert visual.shared_program['u_downsample'] == 2
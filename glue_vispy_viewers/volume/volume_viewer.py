@@ -1,6 +1,7 @@
 import sys
 import numpy as np
 
+from echo import CallbackProperty, SelectionCallbackProperty
 from glue.config import settings
 from glue.viewers.volume3d.viewer_state import VolumeViewerState3D as Vispy3DVolumeViewerState
 
@@ -8,17 +9,79 @@ from ..common.vispy_data_viewer import BaseVispyViewerMixin
 from .layer_artist import VolumeLayerArtist
 
 from ..scatter.layer_artist import ScatterLayerArtist
+from .buffer_cache import buffer_cache
 from .volume_visual import MultiVolume
+from .shaders import RENDER_MODES
 
 from ..common import tools as _tools, selection_tools  # noqa
 from . import volume_toolbar  # noqa
 
+# When the resolution is chosen automatically, the textures for all the layers
+# use at most this much memory (in bytes), assuming the worst case of values
+# with a second channel for NaN values (see MultiVolume.bytes_per_voxel).
+# Before any layers are added, we assume a single layer with 32-bit values.
+AUTO_MEMORY_BUDGET = 512 * 1024 ** 2
+AUTO_BYTES_PER_VOXEL = 8
+
+# The automatic resolution is a multiple of this, so that it doesn't change
+# for small changes in the size of the viewer.
+AUTO_RESOLUTION_STEP = 32
+AUTO_RESOLUTION_MAX = 2048
+
+RENDER_MODE_LABELS = {'max': 'Maximum intensity',
+                      'composite': 'Compositing'}
+
+
+def auto_resolution(size):
+    """
+    Return the resolution to use for a volume that is ``size`` pixels across
+    on the screen.
+    """
+    steps = int(np.ceil(size / AUTO_RESOLUTION_STEP))
+    return int(np.clip(steps * AUTO_RESOLUTION_STEP, AUTO_RESOLUTION_STEP, AUTO_RESOLUTION_MAX))
+
+
+class VispyVolumeViewerState(Vispy3DVolumeViewerState):
+    """
+    The state for the volume viewers, which adds an ``'auto'`` choice for the
+    resolution, with which the resolution is chosen from the size of the
+    volume on the screen, options to draw the scene at a lower resolution
+    while interacting with the viewer and to refine the rendering once the
+    interaction has finished, and a choice of how the layers are rendered
+    (see `MultiVolume.set_render_mode`).
+    """
+
+    downscale = CallbackProperty(False, docstring='Whether to draw the scene at '
+                                                  'a lower resolution while '
+                                                  'interacting with the viewer')
+    refine = CallbackProperty(False, docstring='Whether to refine the rendering '
+                                               'by averaging several frames '
+                                               'when not interacting with the '
+                                               'viewer')
+    render_mode = SelectionCallbackProperty(default_index=0,
+                                            docstring='How the layers are rendered')
+
+    def __init__(self, **kwargs):
+        # The choices for the resolution and render mode are only set up
+        # below, so we need to set these afterwards.
+        resolution = kwargs.pop('resolution', None)
+        render_mode = kwargs.pop('render_mode', None)
+        super().__init__(**kwargs)
+        choices = Vispy3DVolumeViewerState.resolution.get_choices(self)
+        Vispy3DVolumeViewerState.resolution.set_choices(self, ['auto'] + list(choices))
+        VispyVolumeViewerState.render_mode.set_choices(self, RENDER_MODES)
+        VispyVolumeViewerState.render_mode.set_display_func(self, RENDER_MODE_LABELS.get)
+        if resolution is not None:
+            self.resolution = resolution
+        if render_mode is not None:
+            self.render_mode = render_mode
+
 
 class VispyVolumeViewerMixin(BaseVispyViewerMixin):
 
     LABEL = "3D Volume Rendering"
 
-    _state_cls = Vispy3DVolumeViewerState
+    _state_cls = VispyVolumeViewerState
 
     tools = BaseVispyViewerMixin.tools + ['vispy:lasso', 'vispy:rectangle',
                                           'vispy:circle', 'volume3d:floodfill']
@@ -36,8 +99,18 @@ class VispyVolumeViewerMixin(BaseVispyViewerMixin):
         emulate_texture = (sys.platform == 'win32' and
                            sys.version_info[0] < 3)
 
+        # The textures are prepared in a background thread so that updating
+        # large volumes doesn't freeze the user interface, and are loaded
+        # progressively so that something is shown as soon as possible. If
+        # the resolution is lower than that of the data, the visible parts of
+        # the data are also loaded at full resolution. The layers are not
+        # packed into the channels of shared textures, since this keeps a copy
+        # of the packed textures in memory (see MultiVolumeVisual).
         multivol = MultiVolume(emulate_texture=emulate_texture,
-                               bgcolor=settings.BACKGROUND_COLOR)
+                               bgcolor=settings.BACKGROUND_COLOR,
+                               background=True, progressive=True, packed=False,
+                               bricked=True)
+        multivol.events.pending.connect((self, '_update_volume_status'))
 
         self._vispy_widget.add_data_visual(multivol)
         self._vispy_widget._multivol = multivol
@@ -46,7 +119,11 @@ class VispyVolumeViewerMixin(BaseVispyViewerMixin):
         self.state.add_callback('y_att', self._update_slice_transform)
         self.state.add_callback('z_att', self._update_slice_transform)
         self.state.add_callback('resolution', self._update_resolution)
+        self.state.add_callback('refine', self._update_refinement)
+        self.state.add_callback('render_mode', self._update_render_mode)
         self._update_resolution()
+        self._update_render_mode()
+        self._update_refinement()
 
     def _update_clip(self, force=False):
         if hasattr(self._vispy_widget, '_multivol'):
@@ -55,8 +132,9 @@ class VispyVolumeViewerMixin(BaseVispyViewerMixin):
                 dy = self.state.y_stretch * self.state.aspect[1]
                 dz = self.state.z_stretch * self.state.aspect[2]
                 coords = np.array([[-dx, -dy, -dz], [dx, dy, dz]])
-                coords = (self._vispy_widget._multivol.transform.imap(coords)[:, :3] /
-                          self._vispy_widget._multivol.resolution)
+                # The visual coordinates have one unit per voxel along each axis
+                multivol = self._vispy_widget._multivol
+                coords = multivol.transform.imap(coords)[:, :3] / multivol._vol_shape[::-1]
                 self._vispy_widget._multivol.set_clip(self.state.clip_data, coords.ravel())
             else:
                 self._vispy_widget._multivol.set_clip(False, [0, 0, 0, 1, 1, 1])
@@ -66,11 +144,105 @@ class VispyVolumeViewerMixin(BaseVispyViewerMixin):
                                                              self.state.y_min, self.state.y_max,
                                                              self.state.z_min, self.state.z_max)
 
+    def _max_level_of_detail(self):
+        # At most, there are about 20 steps across the shortest axis of the
+        # volume, which is the same as MultiVolume.downsample() with no factor.
+        if not hasattr(self._vispy_widget, '_multivol'):
+            return 1.
+        multivol = self._vispy_widget._multivol
+        return min(multivol._vol_shape) / 20 / multivol._step_size
+
+    def _update_level_of_detail(self, level):
+        if hasattr(self._vispy_widget, '_multivol'):
+            if level > 1:
+                self._vispy_widget._multivol.downsample(level)
+            else:
+                self._vispy_widget._multivol.upsample()
+
+    def _update_jitter(self, index):
+        if hasattr(self._vispy_widget, '_multivol'):
+            self._vispy_widget._multivol.set_jitter(index)
+
+    def _update_volume_status(self, event):
+        if event.pending:
+            self.show_status('Updating volume rendering...')
+        else:
+            self.show_status('')
+
     def _update_resolution(self, *event):
-        self._vispy_widget._multivol.set_resolution(self.state.resolution)
+        if self.state.resolution == 'auto':
+            resolution, voxel_budget = self._auto_resolution()
+        else:
+            resolution, voxel_budget = self.state.resolution, None
+        self._vispy_widget._multivol.set_resolution(resolution, voxel_budget=voxel_budget)
         self._update_slice_transform()
         self._update_clip()
 
+    def _update_render_mode(self, *event):
+        self._vispy_widget._multivol.set_render_mode(self.state.render_mode)
+
+    def _start_interaction(self):
+        super()._start_interaction()
+        self._vispy_widget._multivol.set_interacting(True)
+
+    def _stop_interaction(self, *event):
+        super()._stop_interaction(*event)
+        self._vispy_widget._multivol.set_interacting(False)
+        # Once zooming, panning or resizing has settled, we choose the
+        # resolution again if needed.
+        self._update_auto_resolution()
+
+    def _update_auto_resolution(self, *event):
+        """
+        Choose the resolution again if it is chosen automatically, e.g. once
+        the size of the viewer or the zoom level has changed.
+        """
+        if self.state.resolution == 'auto':
+            self._update_resolution()
+
+    def _auto_resolution(self):
+        """
+        Return the resolution and voxel budget to use based on the size of the
+        volume on the screen and on AUTO_MEMORY_BUDGET.
+        """
+
+        # With the turntable camera, the smallest dimension of the canvas
+        # shows ``scale_factor`` units of the scene at the center of the
+        # camera (exactly so for orthographic projection). This doesn't depend
+        # on the rotation, so the resolution doesn't change when rotating.
+        pixels = min(self._vispy_widget.canvas.physical_size)
+        pixels_per_unit = pixels / self._vispy_widget.view.camera.scale_factor
+
+        # The volume spans the region from -aspect * stretch to aspect *
+        # stretch along each axis in the scene (see _update_clip). The number
+        # of voxels along each axis also depends on the zoom level, since
+        # there are never more voxels than pixels of the data.
+        stretch = (self.state.x_stretch, self.state.y_stretch, self.state.z_stretch)
+        size = 2 * max(s * a for s, a in zip(stretch, self.state.aspect)) * pixels_per_unit
+
+        # The budget only depends on the layers and their precisions, and not
+        # on the textures currently allocated, since these depend on the
+        # resolution that we are choosing.
+        bytes_per_voxel = self._vispy_widget._multivol.bytes_per_voxel() or AUTO_BYTES_PER_VOXEL
+        voxel_budget = AUTO_MEMORY_BUDGET // bytes_per_voxel
+
+        return auto_resolution(size), voxel_budget
+
+    def _update_data(self, message):
+        # This is called when the numerical values change, when components
+        # are added or replaced and when the links change, in which case the
+        # buffers computed for the data (and its subsets) by any viewer may be
+        # out of date.
+        buffer_cache.invalidate(message.data.uuid)
+        super()._update_data(message)
+
+    def _update_subset(self, message):
+        # The subset state may have been changed in place, in which case the
+        # key for the buffers of the subset doesn't change.
+        if message.attribute != 'style':
+            buffer_cache.invalidate(message.subset.data.uuid, message.subset.uuid)
+        super()._update_subset(message)
+
     def get_data_layer_artist(self, layer=None, layer_state=None):
         if layer.ndim == 1:
             cls = ScatterLayerArtist
@@ -118,12 +290,16 @@ class VispyVolumeViewerMixin(BaseVispyViewerMixin):
                 self._update_slice_transform()
 
             self._show_free_layer_warning = True
+            self._update_auto_resolution()
 
         return added
 
     def add_subset(self, subset):
 
-        if not self._has_free_volume_layers:
+        # Subsets of the same dataset share a texture, so there may be room for
+        # a subset even if there is no room for another dataset.
+        if (hasattr(self._vispy_widget, '_multivol') and
+                not self._vispy_widget._multivol.can_allocate(group=subset.data.uuid)):
             self._warn_no_free_volume_layers()
             return False
 
@@ -131,6 +307,7 @@ class VispyVolumeViewerMixin(BaseVispyViewerMixin):
 
         if added:
             self._show_free_layer_warning = True
+            self._update_auto_resolution()
 
         return added
 
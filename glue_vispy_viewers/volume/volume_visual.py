@@ -36,24 +36,580 @@
 # This modified version is released under the BSD license given in the LICENSE
 # file in this repository.
 
-from collections import defaultdict
+import hashlib
+import threading
+import weakref
+import warnings
+from collections import Counter, OrderedDict, defaultdict
 
 import numpy as np
 from glue.utils import iterate_chunks
 
-from vispy.gloo import Texture3D, TextureEmulated3D, VertexBuffer, IndexBuffer
+from vispy import app
+from vispy.gloo import Texture2D, Texture3D, TextureEmulated3D, VertexBuffer, IndexBuffer
 from vispy.visuals import VolumeVisual, Visual
-from vispy.visuals.shaders import Function
-from vispy.color import get_colormap, Color
+from vispy.color import Color
 from vispy.scene.visuals import create_visual_node
-
-from .shaders import get_frag_shader, VERT_SHADER
+from vispy.util.event import Event
+
+from ..common.gpu_memory import gpu_memory
+from ..common.shader_cache import CachedMultiProgram
+from ..compat.gloo import fix_internalformats
+from .buffer_cache import uncached
+from .bricks import (BRICK_BATCH_SIZE, BRICK_CACHE_SHAPE, BRICK_SIZE, BrickCache, brick_grid,
+                     page_table, prepare_bricks)
+from .colors import LUT_SIZE, get_lut
+from .pipeline import ChunkQueue, TexturePipeline, map_chunks
+from .pyramid import PYRAMID_MAX_SIZE, build_pyramid
+from .slabs import SlabBuffer, snap_bounds
+from .shaders import (get_frag_shader, sampled_slots, shown_layers, MAX_SAMPLED_TEXTURES,
+                      RENDER_MODES, VERT_SHADER)
 
 
 class NoFreeSlotsError(Exception):
     pass
 
 
+def clim_to_rescale(clim):
+    """
+    Convert color limits to the ``(scale, offset)`` pair that the fragment
+    shader uses to normalize the raw texture values.
+    """
+    if clim is None:
+        return 1., 0.
+    if clim[1] == clim[0]:
+        return 0., 0.
+    scale = 1. / (clim[1] - clim[0])
+    return scale, -clim[0] * scale
+
+
+# The two-channel textures used for layers with NaN values need the correct
+# internal formats to be defined in VisPy.
+fix_internalformats()
+
+# The precisions that can be used for the volume textures. For each one we
+# give the suffix of the OpenGL internal format, the dtype used to upload the
+# data (VisPy can't upload float16 arrays, so for half-float textures we
+# upload float32 values and let OpenGL do the conversion), and the number of
+# bytes used on the GPU for each value.
+TEXTURE_PRECISIONS = {'float32': ('32f', np.float32, 4),
+                      'float16': ('16f', np.float32, 2),
+                      'uint16': ('16', np.uint16, 2),
+                      'uint8': ('8', np.uint8, 1)}
+
+# Masks (such as subsets) are stored as bits in the channels of 16-bit integer
+# textures, so that up to MASK_BITS * MASK_CHANNELS masks in the same group can
+# share a single texture. The texture only has as many channels as needed for
+# the masks in the group.
+MASK_BITS = 16
+MASK_CHANNELS = 4
+MASK_FORMATS = [('red', 'r16'), ('rg', 'rg16'), ('rgb', 'rgb16'), ('rgba', 'rgba16')]
+
+# When enabled, the layers other than masks are packed into the channels of
+# textures shared with other layers once these are loaded at full resolution,
+# so that the shader can sample up to PACK_CHANNELS layers with one texture
+# fetch. Layers with NaN values use two adjacent channels.
+PACK_CHANNELS = 4
+
+# The chunks of volume textures are normalized in blocks of at most this many
+# values, so that the successive operations on each block are done while it
+# is in the CPU cache rather than going through memory once per operation.
+NORMALIZE_BLOCK_SIZE = 2 ** 16
+
+# Masks are split into chunks of this size, and only the chunks that have
+# changed since the last update are uploaded. We use smaller chunks than for
+# other textures so that small changes (e.g. when refining a subset) only
+# need a small part of the texture to be uploaded.
+MASK_CHUNK_SIZE = 64
+
+# When progressive loading is enabled, volumes are first shown at this
+# resolution, which is then doubled until the full resolution is reached.
+PROGRESSIVE_MIN_SIZE = 64
+
+# The size, in voxels at the full resolution, of the cells of the occupancy
+# grid that is used to skip over empty regions when raytracing.
+OCCUPANCY_CELL_SIZE = 8
+
+# Empty space skipping is only used if at most this fraction of the cells of
+# the occupancy grid are occupied.
+OCCUPANCY_MAX_FRACTION = 0.75
+
+# The number of rows in the colormap texture to start with, which is doubled
+# whenever there are more layers.
+COLORMAP_ROWS = 16
+
+# The shader only includes the layers that are shown, so the shader code
+# changes whenever a layer is shown or hidden. The programs compiled for the
+# most recently used shaders are kept so that these can be used again without
+# compiling the shaders again.
+MAX_PROGRAMS = 16
+
+
+def texture_format(has_nan, precision='float32'):
+    """
+    Return the ``(format, internalformat)`` to use for volume textures.
+    """
+    return channels_format(2 if has_nan else 1, precision)
+
+
+def channels_format(n_channels, precision='float32'):
+    """
+    Return the ``(format, internalformat)`` to use for volume textures with
+    ``n_channels`` channels.
+    """
+    format = ['red', 'rg', 'rgb', 'rgba'][n_channels - 1]
+    return format, format.replace('red', 'r') + TEXTURE_PRECISIONS[precision][0]
+
+
+def texture_nbytes(texture):
+    """
+    Return the number of bytes used by a texture on the GPU, based on its
+    shape and internal format.
+    """
+    internalformat = texture.internalformat or ''
+    if '32' in internalformat:
+        itemsize = 4
+    elif '16' in internalformat:
+        itemsize = 2
+    else:
+        itemsize = 1
+    return int(np.prod(texture.shape)) * itemsize
+
+
+def data_range(array):
+    """
+    Return the range of the finite values in ``array``, or ``(0, 1)`` if there
+    are no finite values.
+    """
+    if array.size == 0:
+        return 0., 1.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        vmin, vmax = np.nanmin(array), np.nanmax(array)
+    if not np.isfinite(vmin) or not np.isfinite(vmax):
+        array = array[np.isfinite(array)]
+        if array.size == 0:
+            return 0., 1.
+        vmin, vmax = array.min(), array.max()
+    return float(vmin), float(vmax)
+
+
+def max_texture_value(precision):
+    """
+    Return the value that [0:1] is mapped to for textures with the given
+    precision, i.e. the maximum of the integer type for integer textures.
+    """
+    dtype = np.dtype(TEXTURE_PRECISIONS[precision][1])
+    return np.iinfo(dtype).max if dtype.kind == 'u' else 1.
+
+
+def add_valid_channel(chunk, precision):
+    """
+    Return a copy of a chunk with a second channel indicating that all the
+    values are valid.
+    """
+    result = np.empty(chunk.shape + (2,), dtype=chunk.dtype)
+    result[..., 0] = chunk
+    result[..., 1] = max_texture_value(precision)
+    return result
+
+
+# The scratch buffers used by normalize_chunk, which are reused for all the
+# blocks processed in each thread.
+_scratch = threading.local()
+
+
+def scratch_buffers(shape):
+    """
+    Return float32 and boolean scratch arrays with the given shape, which are
+    reused by subsequent calls in the same thread.
+    """
+    size = int(np.prod(shape))
+    buffers = getattr(_scratch, 'buffers', None)
+    if buffers is None or buffers[0].size < size:
+        buffers = _scratch.buffers = (np.empty(size, dtype=np.float32),
+                                      np.empty(size, dtype=bool))
+    return buffers[0][:size].reshape(shape), buffers[1][:size].reshape(shape)
+
+
+def normalization_factor(vrange, precision):
+    """
+    Return the factor by which values are multiplied, once ``vrange[0]`` has
+    been subtracted, to map ``vrange`` to the range of the texture values.
+    """
+    maxval = max_texture_value(precision)
+    return np.float32(maxval / (vrange[1] - vrange[0]) if vrange[1] > vrange[0] else 0.)
+
+
+def contains_nan(values, vrange=None):
+    """
+    Return whether normalizing ``values`` with `normalize_chunk` gives NaN
+    values. The values are checked in blocks using a scratch buffer, so this
+    doesn't allocate any memory.
+    """
+    if values.dtype.kind != 'f':
+        return False
+    # If all the values are mapped to zero, infinite values give NaN too
+    if vrange is not None and normalization_factor(vrange, 'float32') == 0:
+        check = np.isfinite
+    else:
+        check = np.isnan
+    rows = max(1, NORMALIZE_BLOCK_SIZE // max(1, int(np.prod(values.shape[1:]))))
+    for start in range(0, values.shape[0], rows):
+        block = values[start:start + rows]
+        invalid = scratch_buffers(block.shape)[1]
+        check(block, out=invalid)
+        if check is np.isfinite:
+            np.logical_not(invalid, out=invalid)
+        if invalid.any():
+            return True
+    return False
+
+
+def normalize_chunk(values, vrange=None, precision='float32', valid=False):
+    """
+    Convert a chunk of raw ``values`` to the values to upload to a texture
+    with the given precision. If ``vrange`` is given, the values are mapped
+    from that range to [0:1] (or the full range of the integer type),
+    otherwise the raw values are kept.
+
+    NaN values are set to zero and, if present (or if ``valid`` is `True`),
+    recorded in a second channel that contains the value that 1 is mapped to
+    for valid values and 0 for NaN values. Returns the converted chunk and
+    whether it has that second channel.
+
+    The chunk is processed in blocks that fit in the CPU cache, using
+    ``out=`` arguments and scratch buffers that are reused, so that the values
+    only go through memory once. Chunks of contiguous float32 values without
+    NaN values are returned without copying them if the raw values are kept.
+    """
+
+    dtype = np.dtype(TEXTURE_PRECISIONS[precision][1])
+    check_nan = values.dtype.kind == 'f'
+
+    maxval = max_texture_value(precision)
+    if vrange is None:
+        vmin = factor = None
+    else:
+        vmin = np.float32(vrange[0])
+        factor = normalization_factor(vrange, precision)
+
+    if (vrange is None and values.dtype == np.float32 and dtype == np.float32 and
+            values.flags.c_contiguous and not valid and not contains_nan(values)):
+        return values, False
+
+    rows = max(1, NORMALIZE_BLOCK_SIZE // max(1, int(np.prod(values.shape[1:]))))
+    blocks = [slice(start, start + rows) for start in range(0, values.shape[0], rows)]
+
+    if valid:
+        chunk = np.empty(values.shape + (2,), dtype=dtype)
+        chunk[..., 1] = maxval
+    else:
+        chunk = np.empty(values.shape, dtype=dtype)
+    has_nan = valid
+
+    for view in blocks:
+
+        block = values[view]
+        scratch, invalid = scratch_buffers(block.shape)
+
+        # Unless we need to convert the values to integers, we can work
+        # directly in the chunk.
+        if dtype.kind == 'u':
+            work = scratch
+        else:
+            work = chunk[view, ..., 0] if has_nan else chunk[view]
+
+        if vrange is None:
+            np.copyto(work, block, casting='unsafe')
+        else:
+            np.subtract(block, vmin, out=work, dtype=np.float32, casting='unsafe')
+            np.multiply(work, factor, out=work)
+            if dtype.kind == 'u':
+                np.add(work, 0.5, out=work)
+                np.clip(work, 0, maxval, out=work)
+
+        if check_nan and np.isnan(work, out=invalid).any():
+            # The second channel is only added once we find NaN values, which
+            # means copying the values processed so far.
+            if not has_nan:
+                chunk = add_valid_channel(chunk, precision)
+                has_nan = True
+                if dtype.kind != 'u':
+                    work = chunk[view, ..., 0]
+            np.copyto(work, 0, where=invalid)
+            valid = chunk[view, ..., 1]
+            np.logical_not(invalid, out=valid, casting='unsafe')
+            if dtype.kind == 'u':
+                np.multiply(valid, maxval, out=valid, casting='unsafe')
+
+        if dtype.kind == 'u':
+            np.copyto(chunk[view, ..., 0] if has_nan else chunk[view], work, casting='unsafe')
+
+    return chunk, has_nan
+
+
+def progressive_levels(resolution):
+    """
+    Return the resolutions at which to compute a volume when loading it
+    progressively, ending with ``resolution``.
+    """
+    levels = []
+    size = PROGRESSIVE_MIN_SIZE
+    while size < resolution:
+        levels.append(size)
+        size *= 2
+    levels.append(resolution)
+    return levels
+
+
+def axis_resolutions(extents, resolution, voxel_budget=None):
+    """
+    Return the number of voxels to use along each axis for a region with the
+    given ``extents`` in pixels of the reference data.
+
+    There are at most ``resolution`` voxels along each axis, and no more than
+    the number of pixels along that axis, since these would not add any
+    detail. If ``voxel_budget`` is given, the total number of voxels is also
+    limited to that, and the voxels are then chosen to have about the same
+    size in pixels along each axis.
+    """
+
+    limits = [max(1, min(resolution, int(np.ceil(extent - 1e-6)))) for extent in extents]
+
+    if voxel_budget is None or np.prod(limits) <= voxel_budget:
+        return tuple(limits)
+
+    def counts(size):
+        return [max(1, min(limit, int(np.ceil(extent / size - 1e-6))))
+                for extent, limit in zip(extents, limits)]
+
+    # Find the smallest voxel size, in pixels, such that the number of voxels
+    # is within the budget.
+    low, high = 0., max(extents)
+    for iteration in range(60):
+        size = 0.5 * (low + high)
+        if np.prod(counts(size)) > voxel_budget:
+            low = size
+        else:
+            high = size
+
+    return tuple(counts(high))
+
+
+def level_bounds(data_bounds, size):
+    """
+    Return the bounds to use to compute a coarser version of the buffer for
+    ``data_bounds``, with at most ``size`` values along each axis.
+
+    The textures are stretched over the same region regardless of their
+    shape, so the bounds are chosen such that the coarse values are at the
+    center of the region covered by the full resolution values they replace.
+    """
+    bounds = []
+    for vmin, vmax, n in data_bounds:
+        if n > size:
+            offset = (n / size - 1) / 2 * (vmax - vmin) / (n - 1)
+            bounds.append((vmin + offset, vmax - offset, size))
+        else:
+            bounds.append((vmin, vmax, n))
+    return bounds
+
+
+def occupancy_grid(data_bounds):
+    """
+    Return the shape of the occupancy grid for ``data_bounds``.
+    """
+    return tuple(int(np.ceil(n / OCCUPANCY_CELL_SIZE)) for _, _, n in data_bounds)
+
+
+def cell_windows(size, ncells):
+    """
+    Return the ``(start, stop)`` range of values along an axis of length
+    ``size`` that contribute to the interpolated values inside each of
+    ``ncells`` cells covering the axis.
+    """
+    windows = []
+    for icell in range(ncells):
+        start = int(np.floor(icell * size / ncells - 0.5))
+        stop = int(np.floor((icell + 1) * size / ncells - 0.5)) + 2
+        windows.append((max(start, 0), min(stop, size)))
+    return windows
+
+
+def reduce_cells(array, grid, ufunc):
+    """
+    Reduce ``array`` over the cells of a grid with shape ``grid`` using
+    ``ufunc`` (e.g. ``np.fmax``). Each cell includes the values just outside
+    it, since these contribute to the interpolated values inside the cell.
+    Returns `None` if the array is empty.
+    """
+    if array.size == 0:
+        return None
+    for axis, ncells in enumerate(grid):
+        windows = cell_windows(array.shape[axis], ncells)
+        array = np.stack([ufunc.reduce(array[(slice(None),) * axis + (slice(start, stop),)],
+                                       axis=axis)
+                          for start, stop in windows], axis=axis)
+    return array
+
+
+def prepare_chunks(job, data, data_bounds, resolution, precision='float32', grid=None):
+    """
+    Compute the fixed resolution buffer for ``data`` and split it into
+    chunks ready to be uploaded to a texture.
+
+    This does not touch any OpenGL state so it can be called from a worker
+    thread. ``job`` can be `None` or a `~glue_vispy_viewers.volume.pipeline.TextureJob`
+    that is checked for cancellation between chunks.
+
+    For the ``'float32'`` precision, the chunks contain the raw values.
+    Otherwise, the values are mapped from the range of the data to [0:1]
+    (or the full range of the integer type) to make the best use of the
+    available precision.
+
+    Returns
+    -------
+    shape : tuple
+        The shape of the full buffer
+    chunks : iterator or `~glue_vispy_viewers.volume.pipeline.ChunkQueue`
+        The ``(offset, chunk)`` tuples. Without ``job``, this is an iterator
+        that computes each chunk as it is needed. Otherwise, the job computes
+        the chunks and adds them to the queue, which is handed back with
+        `~glue_vispy_viewers.volume.pipeline.TextureJob.publish` before they
+        are ready.
+    has_nan : bool
+        Whether the data contains NaN values, in which case the chunks have
+        a second channel indicating which values are valid.
+    vrange : tuple or `None`
+        The range of values that was mapped to [0:1], or `None` if the
+        chunks contain the raw values.
+    cells : tuple or `None`
+        If ``grid`` is given, the minimum and maximum values in each cell of
+        the occupancy grid with that shape (NaN for cells without valid
+        values), otherwise `None`.
+    """
+
+    sliced_data = data.compute_fixed_resolution_buffer(data_bounds)
+
+    if grid is None:
+        cells = None
+    else:
+        if job is not None:
+            job.check()
+        vmin = reduce_cells(sliced_data, grid, np.fmin)
+        vmax = reduce_cells(sliced_data, grid, np.fmax)
+        cells = None if vmin is None else (vmin, vmax)
+
+    if precision == 'float32':
+        vrange = None
+    else:
+        vrange = data_range(sliced_data)
+
+    # With certain graphics cards, sending the data in one chunk to OpenGL
+    # causes artifacts in the rendering - see e.g.
+    # https://github.com/vispy/vispy/issues/1412
+    # To avoid this, we process the data in chunks. Since we need to do
+    # this, we can also do the copy and conversion on the chunk to avoid
+    # excessive memory usage. Note that the values are not normalized using
+    # the color limits here - these are applied in the fragment shader so
+    # that changing them doesn't require the data to be uploaded again.
+
+    # Determine the chunk shape - the value of 128 as the minimum value
+    # is arbitrary but appears to work nicely. We can reduce that in future
+    # if needed.
+
+    chunk_shape = [min(x, 128, resolution) for x in sliced_data.shape]
+
+    # NaN values are set to zero and, if present, recorded in a second
+    # channel that contains 1 for valid values and 0 for NaN values. The
+    # shader then normalizes values with ``scale * value + offset * valid``
+    # which gives the same result as normalizing the values and then
+    # setting NaN values to 0, including once the values are interpolated.
+    # If any chunk contains NaN values, all the chunks need that channel, so
+    # we check for NaN values first. The chunks are processed in parallel
+    # since this mostly happens in Numpy operations that release the GIL (see
+    # normalize_chunk).
+
+    views = [view for view in iterate_chunks(sliced_data.shape, chunk_shape=chunk_shape)
+             if all(s.stop > s.start for s in view)]
+
+    has_nan = any(map_chunks(job, lambda view: contains_nan(sliced_data[view], vrange), views))
+
+    def normalize(view):
+        return (tuple([s.start for s in view]),
+                normalize_chunk(np.asarray(sliced_data[view]), vrange, precision,
+                                valid=has_nan)[0])
+
+    # Without a job, the chunks are normalized as they are consumed. In a
+    # worker thread, the job normalizes the chunks itself and hands them to
+    # the main thread through a bounded queue as soon as they are ready, so
+    # that in both cases only a few of them exist at once rather than a copy
+    # of the whole buffer.
+
+    if job is None:
+        return sliced_data.shape, map_chunks(None, normalize, views), has_nan, vrange, cells
+
+    chunks = ChunkQueue(job)
+    result = sliced_data.shape, chunks, has_nan, vrange, cells
+    job.publish(result)
+    for chunk in map_chunks(job, normalize, views):
+        chunks.put(chunk)
+    chunks.close()
+
+    return result
+
+
+def prepare_mask(job, data, data_bounds, grid=None):
+    """
+    Compute the fixed resolution buffer for the mask ``data`` and split it
+    into boolean chunks.
+
+    Like `prepare_chunks`, this can be called from a worker thread.
+
+    Returns
+    -------
+    shape : tuple
+        The shape of the full buffer
+    chunks : list
+        A list of ``(offset, chunk, digest)`` tuples, where ``digest`` is a
+        hash of the chunk that can be used to find out which chunks have
+        changed since the mask was last uploaded.
+    cells : `~numpy.ndarray` or `None`
+        If ``grid`` is given, whether the mask is set anywhere in each cell
+        of the occupancy grid with that shape, otherwise `None`.
+    """
+
+    mask = data.compute_fixed_resolution_buffer(data_bounds)
+
+    chunk_shape = [min(x, MASK_CHUNK_SIZE) for x in mask.shape]
+
+    chunks = []
+
+    for view in iterate_chunks(mask.shape, chunk_shape=chunk_shape):
+
+        if job is not None:
+            job.check()
+
+        chunk = np.greater(mask[view], 0)
+
+        if chunk.size == 0:
+            continue
+
+        digest = hashlib.blake2b(chunk.data, digest_size=16).digest()
+
+        offset = tuple([s.start for s in view])
+
+        chunks.append((offset, chunk, digest))
+
+    if grid is None:
+        cells = None
+    else:
+        cells = reduce_cells(np.greater(mask, 0), grid, np.logical_or)
+
+    return mask.shape, chunks, cells
+
+
 class MultiVolumeVisual(VolumeVisual):
     """
     Displays multiple 3D volumes simultaneously.
@@ -68,31 +624,146 @@ class MultiVolumeVisual(VolumeVisual):
         Use 2D textures to emulate a 3D texture. OpenGL ES 2.0 compatible,
         but has lower performance on desktop platforms.
     n_volume_max : int
-        Absolute maximum number of volumes that can be shown.
+        Maximum number of volume textures that can be used, or `None` (the
+        default) for no limit other than the available memory. Each volume
+        uses its own texture, except for volumes allocated with a ``group``,
+        which are masks that share a texture with up to ``MASK_BITS *
+        MASK_CHANNELS - 1`` other masks in the same group. Only the textures
+        of the layers that are shown are sampled when drawing, and at most
+        ``MAX_SAMPLED_TEXTURES`` of them at once, so layers can only be shown
+        if their textures can be sampled along with those of the other layers
+        (see `can_enable`).
+    background : bool
+        Whether to prepare the textures in a background thread. If `True`,
+        the textures are updated asynchronously once the data is ready, and
+        the ``pending`` event is emitted whenever the visual starts or stops
+        waiting for data. In both cases, the ``upload`` event is emitted once
+        the texture for a layer has been updated.
+    progressive : bool
+        Whether to load volumes progressively when preparing the textures in
+        the background. If `True`, volumes are first shown at a low resolution
+        which is then refined until the full resolution is reached. This does
+        not apply to masks, which share textures with other masks.
+    packed : bool
+        Whether to pack the textures of layers into the channels of textures
+        shared with other layers, so that up to ``PACK_CHANNELS`` layers are
+        sampled with a single texture fetch. Layers are only packed once these
+        are loaded at full resolution, and a copy of the values of the packed
+        textures is kept so that the layers can be updated separately, which
+        uses as much memory on the host as the packed textures use on the GPU
+        for as long as the layers are packed. This does not apply to masks,
+        and is only used if ``n_volume_max`` is `None` since the packed
+        textures use additional texture slots.
+    bricked : bool
+        Whether to show layers at the resolution of the reference data where
+        this is higher than ``resolution``. The parts of the layers that are
+        visible are then loaded on demand as bricks into a cache texture of
+        fixed size, and the textures at ``resolution`` are used for the parts
+        that aren't loaded. This does not apply to masks.
+    voxel_budget : int
+        The maximum total number of voxels in the textures for each layer. If
+        not given, there are ``resolution`` voxels along each axis (or fewer
+        if there are fewer pixels in the reference data along that axis).
+        Otherwise, the number of voxels along each axis is chosen to fit in
+        the budget while following the aspect of the region shown.
     """
 
-    def __init__(self, n_volume_max=16, emulate_texture=False, bgcolor='white', resolution=256):
+    def __init__(self, n_volume_max=None, emulate_texture=False, bgcolor='white', resolution=256,
+                 background=False, progressive=False, packed=False, bricked=False,
+                 voxel_budget=None):
 
         # Choose texture class
-        tex_cls = TextureEmulated3D if emulate_texture else Texture3D
+        self._tex_cls = TextureEmulated3D if emulate_texture else Texture3D
 
         self._n_volume_max = n_volume_max
+
+        # Since masks share textures, there can be more layers than textures.
+        # This is the number of rows of the colormap texture, which has one
+        # row per layer and grows as needed.
+        self._n_layer_max = COLORMAP_ROWS
         self._vol_shape = (resolution, resolution, resolution)
         self._need_vertex_update = True
         self._data_bounds = None
 
         self.resolution = resolution
+        self.voxel_budget = voxel_budget
 
         # We deliberately don't use super here because we don't want to call
-        # VolumeVisual.__init__
-        Visual.__init__(self, vcode=VERT_SHADER, fcode="")
+        # VolumeVisual.__init__. The programs use a cache shared between all
+        # visuals for the work that only depends on the shader code.
+        Visual.__init__(self, program=CachedMultiProgram(VERT_SHADER, ""))
+
+        self.events.add(pending=Event, upload=Event)
+
+        # The GPU memory used by the visual counts towards a budget shared by
+        # all visuals, and the textures of layers that are not shown can be
+        # evicted if the budget is exceeded (see evict).
+        gpu_memory.register(self)
 
         self.volumes = defaultdict(dict)
 
+        # The packed mask textures, indexed by texture slot. For each one we
+        # keep the group, the bit used by each layer, and a copy of the
+        # packed values so that one mask can be updated without the others.
+        self._masks = {}
+
+        # The textures into which layers are packed, indexed by texture slot.
+        # For each one we keep the shape and precision of the texture, the
+        # first channel and number of channels used by each layer, and a copy
+        # of the packed values.
+        self._packed = packed
+        self._packs = {}
+
+        # If requested, set up the pipeline used to prepare textures in the
+        # background. The timer is used to pick up the results in the main
+        # thread and is only created once it is needed.
+        self._pipeline = TexturePipeline() if background else None
+        self._poll_timer = None
+        self._progressive = progressive
+
+        # The uploads for which chunks are still being prepared in the
+        # background, by label (see _continue_upload).
+        self._uploads = {}
+
+        # Empty space skipping is enabled by default, but can be turned off
+        # e.g. for benchmarking. The occupancy grid is set once the bounds of
+        # the data are known.
+        self._skip_empty = True
+        self._occupancy_grid = None
+
+        # The layers are shown as maximum intensity projections by default
+        # (see set_render_mode).
+        self._render_mode = 'max'
+
+        # If requested, layers are also shown at the resolution of the
+        # reference data using bricks, which are kept in a cache with a
+        # fixed number of slots. The grid of bricks covering the bounds of
+        # the data is set once these are known, and the matrix from the
+        # reference data to clip coordinates is used to find which bricks are
+        # visible. For each layer we keep the visible bricks so that these
+        # aren't evicted from the cache when loading bricks for other layers.
+        self._bricked = bricked
+        self._brick_cache = BrickCache(BRICK_CACHE_SHAPE)
+        self._brick_grid = None
+        self._brick_matrix = None
+        self._brick_visible = {}
+        self._interacting = False
+        self._brick_atlas = None
+        self._brick_table = None
+
+        # The step size along rays, relative to the size of the voxels at
+        # the resolution of the viewer, which is reduced while bricks are
+        # loaded for layers that are shown.
+        self._step_size = 1.
+
         # We turn on clipping straight away - the following variable is needed
         # by _update_shader
         self._clip_data = True
 
+        # The programs compiled for each shader code (see _update_shader)
+        self._programs = OrderedDict()
+        self._shader_cache = None
+
         # Set up initial shader so that we can start setting shader variables
         # that don't depend on what volumes are actually active.
         self._update_shader()
@@ -131,26 +802,53 @@ class MultiVolumeVisual(VolumeVisual):
         self._vol_shape = (resolution, resolution, resolution)
         self.shared_program['u_shape'] = self._vol_shape
 
-        self.textures = []
-        for i in range(n_volume_max):
-
-            # Set up texture object
-            self.textures.append(tex_cls(self._vol_shape, interpolation='linear',
-                                         wrapping='clamp_to_edge'))
+        # The textures for the volumes are only created once there is data to
+        # upload, and are deleted again when the volume is deallocated. Until
+        # then, the samplers point to a small placeholder texture. The list of
+        # textures grows as texture slots are allocated (see _add_slot).
+        format, internalformat = texture_format(False)
+        self._empty_texture = self._tex_cls(np.zeros((1, 1, 1, 1), dtype=np.float32),
+                                            interpolation='linear',
+                                            wrapping='clamp_to_edge', format=format,
+                                            internalformat=internalformat)
 
-            # Pass texture object to shader program
-            self.shared_program['u_volumetex_{0}'.format(i)] = self.textures[i]
+        self.textures = []
 
-            # Make sure all textures are disabled
-            self.shared_program['u_enabled_{0}'.format(i)] = 0
-            self.shared_program['u_weight_{0}'.format(i)] = 1
+        # The colormaps for all layers are stored as lookup tables in the rows
+        # of a single texture, so that changing a colormap only requires a
+        # texture update rather than a change to the shader code.
+        self._colormaps = Texture2D((self._n_layer_max, LUT_SIZE, 4), interpolation='linear',
+                                    wrapping='clamp_to_edge', format='rgba',
+                                    internalformat='rgba32f')
+        self.shared_program['u_colormaps'] = self._colormaps
+        self.shared_program['u_colormaps_shape'] = LUT_SIZE, self._n_layer_max
+
+        # The occupancy texture indicates which cells of a coarse grid contain
+        # non-zero values for any of the enabled layers, so that the shader
+        # can skip empty regions. Initially, all of the volume is occupied.
+        self._occupancy = self._tex_cls(np.ones((1, 1, 1, 1), dtype=np.uint8) * 255,
+                                        interpolation='nearest',
+                                        wrapping='clamp_to_edge', format='red',
+                                        internalformat='r8')
+        self.shared_program['u_occupancy'] = self._occupancy
+        self.shared_program['u_occupancy_shape'] = 1, 1, 1
+        self.shared_program['u_skip_empty'] = 0
+
+        # The brick atlas and page table are only created once bricks are
+        # loaded.
+        self.shared_program['u_brick_atlas'] = self._empty_texture
+        self.shared_program['u_brick_atlas_shape'] = 1, 1, 1
+        self.shared_program['u_brick_table'] = self._empty_texture
+        self.shared_program['u_brick_size'] = BRICK_SIZE
 
         # Don't use downsampling initially (1 means show 1:1 resolution)
         self.shared_program['u_downsample'] = 1.
+        self.shared_program['u_jitter'] = 0.
+        self.shared_program['u_voxel_scale'] = 1.
 
         # Set up texture sampler
-        self.shared_program.frag['sampler_type'] = self.textures[0].glsl_sampler_type
-        self.shared_program.frag['sample'] = self.textures[0].glsl_sample
+        self.shared_program.frag['sampler_type'] = self._empty_texture.glsl_sampler_type
+        self.shared_program.frag['sample'] = self._empty_texture.glsl_sample
 
         # Set initial background color
         self.shared_program['u_bgcolor'] = Color(bgcolor).rgba
@@ -164,31 +862,128 @@ class MultiVolumeVisual(VolumeVisual):
             pass
 
     def _update_shader(self, force=False):
+        # When compositing, empty regions can only be skipped if the colormaps
+        # are transparent for zero values.
+        skip_empty = self._skip_empty
+        if self._render_mode == 'composite':
+            skip_empty &= all(volume['cmap'][0, 3] == 0 for volume in self.volumes.values()
+                              if 'cmap' in volume)
         shader = get_frag_shader(self.volumes, clipped=self._clip_data,
-                                 n_volume_max=self._n_volume_max)
+                                 skip_empty=skip_empty, render_mode=self._render_mode)
         # We only actually update the shader in OpenGL if the code has changed
         # to avoid any overheads in uploading the new shader code
-        if force or getattr(self, '_shader_cache', None) != shader:
-            self.shared_program.frag = shader
+        if force or self._shader_cache != shader:
+            self._use_program(shader, force=force)
             self._shader_cache = shader
 
+    def _use_program(self, shader, force=False):
+        """
+        Draw with the program for the given shader code, which is compiled
+        only if there isn't already a program for it in the cache.
+        """
+
+        program = self._programs.pop(shader, None)
+
+        if program is None and not self._programs:
+            # The first shader is set on the shared program, which is then
+            # used as a template for the programs for the other shaders.
+            self.shared_program.frag = shader
+            program = self._program
+        elif program is None:
+            # The new program is kept up to date with the variables set on the
+            # shared program, and we need to set up the transforms and the
+            # hooks used by filters in the same way as for the view program.
+            program = self.shared_program.add_program()
+            program.frag = shader
+            for (shader_type, position), hook in self._hooks.items():
+                getattr(program, shader_type)[position] = hook
+        elif force:
+            program.frag = shader
+
+        self._programs[shader] = program
+        self._program = program
+        self._prepare_transforms(self)
+
+        while len(self._programs) > MAX_PROGRAMS:
+            self._programs.popitem(last=False)[1].delete()
+
     # The following methods change things which require the shader code to be updated
 
-    def allocate(self, label):
+    def allocate(self, label, group=None):
+        """
+        Allocate a layer. If ``group`` is given, the data for the layer is
+        treated as a mask, and the masks of layers in the same group (for
+        example the subsets of one dataset) are packed as bits into a single
+        texture.
+        """
         if label in self.volumes:
             raise ValueError("Label {0} already exists".format(label))
-        index = self._free_slot_index
+        index = self._free_index
+        if group is None:
+            slot, bit = self._free_slot_index, None
+        else:
+            slot, bit = self._free_mask_bit(group)
+        self._add_slot(slot)
+        self._add_index(index)
         self.volumes[label] = {}
         self.volumes[label]['index'] = index
-        self.shared_program['u_enabled_{0}'.format(index)] = 0
+        self.volumes[label]['slot'] = slot
+        if bit is not None:
+            if slot not in self._masks:
+                self._masks[slot] = {'group': group, 'bits': {}, 'packed': None,
+                                     'texture_shape': None}
+            self._masks[slot]['bits'][label] = bit
+            self.volumes[label]['bit'] = bit
+            self.volumes[label]['channel'] = bit // MASK_BITS
+            self.shared_program['u_bit_{0}'.format(index)] = float(2 ** (bit % MASK_BITS))
+        self.volumes[label]['enabled'] = False
+        self._update_rescale(label)
         self._update_shader()
 
+    def _add_slot(self, slot):
+        # Add texture slots up to the given one, with samplers that point to
+        # the placeholder texture.
+        while len(self.textures) <= slot:
+            self.shared_program['u_volumetex_{0}'.format(len(self.textures))] = self._empty_texture
+            self.textures.append(None)
+
+    def _add_index(self, index):
+        # If needed, add rows to the colormap texture (which means that the
+        # colormaps of the other layers need to be uploaded again), and then
+        # reset the weight for the layer.
+        if index >= self._n_layer_max:
+            while index >= self._n_layer_max:
+                self._n_layer_max *= 2
+            self._colormaps.resize((self._n_layer_max, LUT_SIZE, 4), format='rgba',
+                                   internalformat='rgba32f')
+            for volume in self.volumes.values():
+                if 'cmap' in volume:
+                    self._colormaps.set_data(volume['cmap'][np.newaxis],
+                                             offset=(volume['index'], 0))
+            self.shared_program['u_colormaps_shape'] = LUT_SIZE, self._n_layer_max
+        self.shared_program['u_weight_{0}'.format(index)] = 1
+
     def deallocate(self, label):
         if label not in self.volumes:
             return  # layer already deallocated
         self.disable(label)
-        self.volumes.pop(label)
-        self._update_shader()
+        self._unpack(label, trim=True)
+        volume = self.volumes.pop(label)
+        self._discard_upload(label)
+        if self._pipeline is not None:
+            # We wait for any running job to finish so that it doesn't touch
+            # the data after the caller has cleaned up.
+            self._pipeline.cancel(label, wait=True)
+            self._pipeline.cancel(('bricks', label), wait=True)
+            self._pipeline.cancel(('pyramid', label), wait=True)
+            self._poll_pipeline()
+        if 'bit' in volume:
+            self._release_mask_bit(label, volume['slot'], volume['bit'])
+        else:
+            self._release_texture(volume['slot'])
+        self._discard_bricks(label)
+        self._update_bricked()
+        self._update_occupancy()
 
     def set_clip(self, clip_data, clip_limits):
         self._clip_data = int(clip_data)
@@ -199,48 +994,195 @@ class MultiVolumeVisual(VolumeVisual):
 
     def set_multiply(self, label, label_other):
         self.volumes[label]['multiply'] = label_other
+        self._restore_evicted()
+        self._update_shader()
+        self._update_occupancy()
+
+    def set_skip_empty(self, skip_empty):
+        """
+        Set whether to skip over empty regions of the volumes when raytracing.
+        This doesn't change the result, so is mostly useful for benchmarking.
+        """
+        self._skip_empty = bool(skip_empty)
         self._update_shader()
 
-    # The following methods don't require any changes to the shader code, so we
-    # don't update the shader after setting the OpenGL variables.
+    def set_render_mode(self, render_mode):
+        """
+        Set how the layers are rendered: ``'max'`` shows the maximum value of
+        each layer along each ray, and ``'composite'`` composites the colors
+        along each ray from front to back, stopping once the ray is opaque.
+        """
+        if render_mode not in RENDER_MODES:
+            raise ValueError("render_mode should be one of {0}".format(RENDER_MODES))
+        if render_mode == self._render_mode:
+            return
+        self._render_mode = render_mode
+        self._update_shader()
+        # The values of the pyramids are combined differently for each render
+        # mode (see _pyramid_reduction), so these are built again.
+        for label, volume in self.volumes.items():
+            if 'pyramid' in volume and 'bit' not in volume:
+                volume.pop('pyramid')
+                if self._pipeline is not None:
+                    self._pipeline.cancel(('pyramid', label))
+                    self._build_pyramid(label)
 
     def enable(self, label):
-        index = self.volumes[label]['index']
-        self.shared_program['u_enabled_{0}'.format(index)] = 1
+        if label not in self.volumes:
+            return  # layer already deallocated
+        if not self.can_enable(label):
+            raise NoFreeSlotsError("Not enough texture units to show this layer along with "
+                                   "the layers already shown. To show this layer, hide "
+                                   "other layers and try again.")
+        self.volumes[label]['enabled'] = True
+        self.volumes[label]['viewed'] = gpu_memory.tick()
+        self._restore_evicted()
+        self._update_step_size()
+        self._update_shader()
+        self._update_occupancy()
+        self._request_bricks([label])
 
     def disable(self, label):
-        index = self.volumes[label]['index']
-        self.shared_program['u_enabled_{0}'.format(index)] = 0
+        if label not in self.volumes:
+            return  # layer already deallocated
+        self.volumes[label]['enabled'] = False
+        self.volumes[label]['viewed'] = gpu_memory.tick()
+        self._update_step_size()
+        self._update_shader()
+        # The bricks for the layer can now be evicted from the cache, and the
+        # texture can be evicted if the GPU memory budget is exceeded.
+        self._brick_visible.pop(label, None)
+        self._update_occupancy()
+        gpu_memory.enforce()
 
-    def downsample(self):
-        min_dimension = min(self._vol_shape)
-        self.shared_program['u_downsample'] = min_dimension / 20
+    # The following methods don't require any changes to the shader code, so we
+    # don't update the shader after setting the OpenGL variables.
+
+    def downsample(self, factor=None):
+        """
+        Take ``factor`` times fewer steps along each ray, or by default about
+        20 steps across the shortest axis of the volume (but never more steps
+        than without downsampling).
+        """
+        if factor is None:
+            self.shared_program['u_downsample'] = max(min(self._vol_shape) / 20,
+                                                      self._step_size)
+        else:
+            self.shared_program['u_downsample'] = factor * self._step_size
 
     def upsample(self):
-        self.shared_program['u_downsample'] = 1.
+        self.shared_program['u_downsample'] = self._step_size
+
+    def set_interacting(self, interacting):
+        """
+        Set whether the view is being changed interactively. In the meantime,
+        no bricks are loaded since the visible bricks would change on every
+        frame, and these are found again once the interaction stops.
+        """
+        if interacting == self._interacting:
+            return
+        self._interacting = interacting
+        if interacting:
+            if self._pipeline is not None:
+                for label in self.volumes:
+                    self._pipeline.cancel(('bricks', label))
+        else:
+            self._brick_matrix = None
+            self.update()
+
+    def set_jitter(self, index):
+        """
+        Offset the samples along each ray by a random fraction of a step that
+        depends on ``index``, or not at all if ``index`` is zero. Averaging
+        frames drawn with different values of ``index`` refines the rendering.
+        """
+        self.shared_program['u_jitter'] = float(index)
 
     def set_background(self, color):
         self.shared_program['u_bgcolor'] = Color(color).rgba
 
-    def set_resolution(self, resolution):
+    def set_resolution(self, resolution, voxel_budget=None):
+        """
+        Set the maximum number of voxels along each axis, and optionally the
+        maximum total number of voxels (see `axis_resolutions`). This takes
+        effect the next time the bounds are set.
+        """
         self.resolution = resolution
-        self._vol_shape = (resolution, resolution, resolution)
-        self.shared_program['u_shape'] = self._vol_shape[::-1]
+        self.voxel_budget = voxel_budget
 
     def set_cmap(self, label, cmap):
-        if isinstance(cmap, str):
-            cmap = get_colormap(cmap)
-        self.volumes[label]['cmap'] = cmap
+        """
+        Set the colormap for a layer. This can be a ``(n, 4)`` RGBA lookup
+        table such as the ones returned by the functions in
+        `glue_vispy_viewers.volume.colors`, or a VisPy colormap or colormap name.
+        """
+        lut = get_lut(cmap)
+        self.volumes[label]['cmap'] = lut
         index = self.volumes[label]['index']
-        self.shared_program.frag['cmap{0:d}'.format(index)] = Function(cmap.glsl_map)
+        self._colormaps.set_data(lut[np.newaxis], offset=(index, 0))
+        if self._render_mode == 'composite':
+            self._update_shader()
 
     def set_clim(self, label, clim):
         # Avoid setting the same limits again
         if 'clim' in self.volumes[label] and self.volumes[label]['clim'] == clim:
             return
         self.volumes[label]['clim'] = clim
-        if 'data' in self.volumes[label]:
-            self._update_scaled_data(label)
+        # The data is normalized in the fragment shader so we only need to
+        # update the uniform rather than uploading the data again.
+        self._update_rescale(label)
+        self._update_occupancy()
+
+    def _update_rescale(self, label):
+        index = self.volumes[label]['index']
+        scale, offset = clim_to_rescale(self.volumes[label].get('clim'))
+        # If the texture values were mapped from the data range to [0:1], we
+        # fold the inverse of this into the scale and offset.
+        vrange = self.volumes[label].get('vrange')
+        if vrange is not None:
+            offset += scale * vrange[0]
+            scale *= vrange[1] - vrange[0]
+        has_nan = float(self.volumes[label].get('has_nan', False))
+        self.shared_program['u_rescale_{0:d}'.format(index)] = scale, offset, has_nan
+        # The bricks always contain the raw values
+        self.shared_program['u_brick_rescale_{0:d}'.format(index)] = \
+            clim_to_rescale(self.volumes[label].get('clim'))
+
+    def set_precision(self, label, precision):
+        """
+        Set the precision of the texture for a layer, which should be one of
+        ``'float32'``, ``'float16'``, ``'uint16'``, or ``'uint8'``. This has
+        no effect for masks, which are always stored as bits.
+        """
+        if precision not in TEXTURE_PRECISIONS:
+            raise ValueError("precision should be one of {0}".format(
+                "/".join(TEXTURE_PRECISIONS)))
+        if self.volumes[label].get('precision', 'float32') == precision:
+            return
+        self.volumes[label]['precision'] = precision
+        if 'data' in self.volumes[label] and 'bit' not in self.volumes[label]:
+            self._update_texture(label)
+
+    def texture_memory(self, label):
+        """
+        Return the number of bytes used by the texture for a layer, as well as
+        the number of bytes it would use with the ``'float32'`` precision. For
+        masks, the memory used by the shared texture is split between the
+        layers sharing it.
+        """
+        if 'bit' in self.volumes[label]:
+            mask = self._masks[self.volumes[label]['slot']]
+            if mask['packed'] is None:
+                return 0, 0
+            size = int(np.prod(mask['packed'].shape[:3]))
+            return (mask['packed'].nbytes // len(mask['bits']),
+                    size * TEXTURE_PRECISIONS['float32'][2])
+        shape = self.volumes[label].get('texture_shape')
+        if shape is None:
+            return 0, 0
+        precision = self.volumes[label].get('precision', 'float32')
+        size = int(np.prod(shape))
+        return size * TEXTURE_PRECISIONS[precision][2], size * TEXTURE_PRECISIONS['float32'][2]
 
     def set_weight(self, label, weight):
         index = self.volumes[label]['index']
@@ -261,57 +1203,914 @@ class MultiVolumeVisual(VolumeVisual):
 
     def _update_scaled_data(self, label):
 
+        # The data has changed, so any bricks loaded for the layer are out of
+        # date.
+        self._discard_bricks(label)
+        self._update_bricked()
+
+        # Likewise for the pyramid, which is built again once the texture has
+        # been updated, and the buffer used to reuse values when panning.
+        self.volumes[label].pop('pyramid', None)
+        self.volumes[label].pop('buffer', None)
+        if self._pipeline is not None:
+            self._pipeline.cancel(('pyramid', label))
+
+        self._update_texture(label)
+        self._request_bricks([label])
+
+    def _update_texture(self, label):
+
         # If the data slice hasn't been set yet, we should stop here
         if self._data_bounds is None:
             return
 
-        index = self.volumes[label]['index']
-        clim = self.volumes[label].get('clim', None)
-        data = self.volumes[label]['data']
+        # The textures of evicted layers are only prepared again once these
+        # are in use (see _restore_evicted).
+        if self.volumes[label].get('evicted'):
+            return
 
-        # With certain graphics cards, sending the data in one chunk to OpenGL
-        # causes artifacts in the rendering - see e.g.
-        # https://github.com/vispy/vispy/issues/1412
-        # To avoid this, we process the data in chunks. Since we need to do
-        # this, we can also do the copy and renormalization on the chunk to
-        # avoid excessive memory usage.
+        size = max(n for _, _, n in self._data_bounds)
 
-        # To start off we need to tell the texture about the new shape
-        self.shared_program['u_volumetex_{0:d}'.format(index)].resize(data.shape)
+        if self._pipeline is None:
+            func, args = self._prepare_func(label, size)
+            self._upload(label, func(None, *args))
+            return
 
-        # Determine the chunk shape - the value of 128 as the minimum value
-        # is arbitrary but appears to work nicely. We can reduce that in future
-        # if needed.
+        # If requested, we first compute coarser versions of the volume, each
+        # of which is uploaded as soon as it is ready while the next one is
+        # being computed. Submitting a new job for the layer cancels any
+        # refinement that is still in progress.
+        # Coarser versions are not needed if the pyramid for the layer can be
+        # resampled at full resolution or if the previous values can be
+        # reused, since that is fast.
+        if (self._progressive and 'bit' not in self.volumes[label] and
+                self._pyramid(label, self._data_bounds) is None and
+                not self._buffer(label).can_shift(self._data_bounds)):
+            levels = progressive_levels(size)
+        else:
+            levels = [size]
 
-        sliced_data = data.compute_fixed_resolution_buffer(self._data_bounds)
+        self.volumes[label]['levels'] = levels[1:]
+        self._submit(label, levels[0])
 
-        chunk_shape = [min(x, 128, self.resolution) for x in sliced_data.shape]
+    def _prepare_func(self, label, size):
 
-        # FIXME: shouldn't be needed!
-        zeros = np.zeros(self._vol_shape, dtype=np.float32)
-        self.shared_program['u_volumetex_{0:d}'.format(index)].set_data(zeros)
+        if 'bit' in self.volumes[label]:
+            bounds = self._data_bounds
+        else:
+            bounds = level_bounds(self._data_bounds, size)
+
+        # If possible, we resample the pyramid for the layer rather than
+        # computing the fixed resolution buffer of the data again. Otherwise,
+        # at full resolution, we go through the buffer that reuses the values
+        # from the previous bounds when panning. The coarser levels are only
+        # needed once, so these aren't kept in the buffer cache.
+        data = self._pyramid(label, bounds)
+        if data is None:
+            if bounds == self._data_bounds:
+                data = self._buffer(label)
+            else:
+                data = uncached(self.volumes[label]['data'])
+
+        if 'bit' in self.volumes[label]:
+            return prepare_mask, (data, bounds, self._occupancy_grid)
+        else:
+            return prepare_chunks, (data, bounds, size,
+                                    self.volumes[label].get('precision', 'float32'),
+                                    self._occupancy_grid)
+
+    def _buffer(self, label):
+        if 'buffer' not in self.volumes[label]:
+            self.volumes[label]['buffer'] = SlabBuffer(self.volumes[label]['data'])
+        return self.volumes[label]['buffer']
+
+    def _pyramid(self, label, bounds):
+        """
+        Return the pyramid for the layer if it can be resampled for the given
+        bounds, and `None` otherwise.
+        """
+        pyramid = self.volumes[label].get('pyramid')
+        if pyramid is not None and pyramid.can_resample(bounds):
+            return pyramid
+        return None
+
+    def _submit(self, label, size):
+        func, args = self._prepare_func(label, size)
+        self._pipeline.submit(label, func, *args)
+        self._start_polling()
+
+    def _refine(self, label):
+        if self.volumes[label].get('evicted'):
+            return
+        levels = self.volumes[label].get('levels')
+        if levels:
+            self._submit(label, levels.pop(0))
+        elif 'pyramid' not in self.volumes[label]:
+            self._build_pyramid(label)
+
+    def _build_pyramid(self, label):
+
+        # The pyramid covers the pixel grid of the reference data, which is
+        # the same as that of the layer since only datasets that are linked
+        # pixel-by-pixel to the reference data can be shown.
+        data = uncached(self.volumes[label]['data'])
+        shape = getattr(data, 'shape', None)
+        if shape is None:
+            return
 
-        # Now loop over chunks
+        # The pyramid is set to None until it is ready, so that it is only
+        # built once.
+        self.volumes[label]['pyramid'] = None
+        self._pipeline.submit(('pyramid', label), build_pyramid, data, tuple(shape),
+                              PYRAMID_MAX_SIZE, self._pyramid_reduction(label))
+        self._start_polling()
+
+    def _pyramid_reduction(self, label):
+        # When showing the maximum along each ray, the coarser levels keep the
+        # maximum of the values they replace, so that the rendering doesn't
+        # get fainter as we zoom out. This is also the case for masks, which
+        # can't be averaged. Otherwise, the values are averaged.
+        if self._render_mode == 'max' or 'bit' in self.volumes[label]:
+            return 'max'
+        else:
+            return 'mean'
+
+    def _upload(self, label, result):
+        """
+        Upload the result of a job, returning whether the layer has been
+        updated. This isn't the case yet if the chunks for the layer are still
+        being prepared in the background, in which case these are uploaded as
+        they arrive (see `_continue_upload`).
+        """
+        if self.volumes[label].get('evicted'):
+            return False
+        if 'bit' in self.volumes[label]:
+            self._upload_mask(label, *result)
+            return True
+        else:
+            return self._upload_chunks(label, *result)
+
+    def _upload_chunks(self, label, shape, chunks, has_nan, vrange, cells):
 
-        for view in iterate_chunks(sliced_data.shape, chunk_shape=chunk_shape):
+        # The chunks are uploaded to a new texture, or kept if the layer can be
+        # packed into a texture shared with other layers, and the layer only
+        # switches to the new values once all the chunks have been uploaded,
+        # so that partially uploaded textures are never shown.
+        self._discard_upload(label)
 
-            chunk = sliced_data[view]
-            chunk = chunk.astype(np.float32)
-            if clim is not None:
-                chunk -= clim[0]
-                chunk *= 1 / (clim[1] - clim[0])
+        upload = {'shape': tuple(shape), 'chunks': chunks, 'has_nan': has_nan,
+                  'vrange': vrange, 'cells': cells}
 
-            # PERF: nan_to_num doesn't actually help memory usage as it runs
-            # isnan internally, and it's slower, so we just use the following
-            # methind. In future we could do this directly with a C extension.
-            chunk[np.isnan(chunk)] = 0.
+        # Once the layer is loaded at full resolution, it can be packed into a
+        # texture shared with other layers, in which case its own texture is
+        # no longer needed. Otherwise, it uses its own texture.
+        full_shape = tuple(n for _, _, n in self._data_bounds)
+        if self._packed and tuple(shape) == full_shape:
+            upload['received'] = []
+        else:
+            upload['texture'] = self._new_texture(label, shape, has_nan)
+
+        self._uploads[label] = upload
+
+        return self._continue_upload(label)
+
+    def _continue_upload(self, label):
+        """
+        Upload the chunks for a layer that are ready, and switch the layer to
+        the new values once all of them have been uploaded. Returns whether
+        the upload is complete.
+        """
+
+        upload = self._uploads[label]
+        chunks = upload['chunks']
+
+        if isinstance(chunks, ChunkQueue):
+            # The job was cancelled or failed, in which case a newer job is
+            # preparing the layer, or the error is raised when polling.
+            if chunks.failed:
+                self._discard_upload(label)
+                return False
+            ready = chunks.get_ready()
+            finished = chunks.finished
+        else:
+            ready, finished = chunks, True
+
+        if 'texture' in upload:
+            for offset, chunk in ready:
+                upload['texture'].set_data(chunk, offset=offset)
+        else:
+            upload['received'].extend(ready)
 
+        if not finished:
+            return False
+
+        del self._uploads[label]
+        self._finish_upload(label, upload)
+
+        return True
+
+    def _finish_upload(self, label, upload):
+
+        shape, has_nan = upload['shape'], upload['has_nan']
+        n_channels = 2 if has_nan else 1
+
+        volume = self.volumes[label]
+        volume['has_nan'] = has_nan
+        volume['vrange'] = upload['vrange']
+        volume['texture_shape'] = shape + (n_channels,)
+        volume['cells'] = upload['cells']
+        self._update_rescale(label)
+
+        if 'texture' in upload:
+            self._unpack(label)
+            self._set_texture(volume['slot'], upload['texture'])
+        elif self._pack(label, n_channels):
+            self._release_texture(volume['slot'])
+            self._upload_packed(label, upload['received'])
+        else:
+            self._unpack(label)
+            texture = self._new_texture(label, shape, has_nan)
+            for offset, chunk in upload['received']:
+                texture.set_data(chunk, offset=offset)
+            self._set_texture(volume['slot'], texture)
+
+        self._update_shader()
+        self._update_occupancy()
+        gpu_memory.enforce()
+
+        self.events.upload(label=label)
+
+    def _discard_upload(self, label):
+        upload = self._uploads.pop(label, None)
+        if upload is not None and 'texture' in upload:
+            upload['texture'].delete()
+
+    def _new_texture(self, label, shape, has_nan):
+        # The texture includes the channel with valid values if needed. The
+        # chunks cover the whole texture so we don't need to initialize it.
+        precision = self.volumes[label].get('precision', 'float32')
+        format, internalformat = texture_format(has_nan, precision)
+        return self._tex_cls(tuple(shape) + (2 if has_nan else 1,), interpolation='linear',
+                             wrapping='clamp_to_edge', format=format,
+                             internalformat=internalformat)
+
+    def _set_texture(self, index, texture):
+        self._release_texture(index)
+        self.textures[index] = texture
+        self.shared_program['u_volumetex_{0:d}'.format(index)] = texture
+
+    def _upload_mask(self, label, shape, chunks, cells):
+
+        slot = self.volumes[label]['slot']
+        channel, bit = divmod(self.volumes[label]['bit'], MASK_BITS)
+        mask = self._masks[slot]
+
+        # The texture needs enough channels for all the masks in the group
+        n_channels = max(mask['bits'].values()) // MASK_BITS + 1
+        format, internalformat = MASK_FORMATS[n_channels - 1]
+        texture_shape = tuple(shape) + (n_channels,)
+
+        # If the shape has changed, we start from scratch - the other masks
+        # in the texture will be updated too since this happens when the
+        # bounds or resolution change. If there are now more channels, we keep
+        # the bits for the other masks, which are uploaded again. The bits
+        # can't be interpolated, so we use nearest-neighbor sampling.
+        if mask['packed'] is None or mask['packed'].shape[:3] != tuple(shape):
+            mask['packed'] = np.zeros(texture_shape, dtype=np.uint16)
+            texture = self.textures[slot]
+            if texture is None:
+                texture = self._tex_cls(texture_shape, interpolation='nearest',
+                                        wrapping='clamp_to_edge', format=format,
+                                        internalformat=internalformat)
+                self.textures[slot] = texture
+                self.shared_program['u_volumetex_{0:d}'.format(slot)] = texture
+            else:
+                texture.resize(texture_shape, format=format, internalformat=internalformat)
+            for other in mask['bits']:
+                self.volumes[other].pop('digests', None)
+        elif mask['packed'].shape[3] < n_channels:
+            packed = np.zeros(texture_shape, dtype=np.uint16)
+            packed[..., :mask['packed'].shape[3]] = mask['packed']
+            mask['packed'] = packed
+            self.textures[slot].resize(texture_shape, format=format,
+                                       internalformat=internalformat)
+            self.textures[slot].set_data(packed)
+
+        texture = self.textures[slot]
+        packed = mask['packed']
+        keep = np.uint16(~(1 << bit) & 0xffff)
+
+        # We only update and upload the chunks that have changed since the
+        # last time the mask was uploaded. Since the chunks cover the whole
+        # texture, all of it is uploaded the first time.
+        digests = self.volumes[label].setdefault('digests', {})
+
+        for offset, chunk, digest in chunks:
+            if digests.get(offset) == digest:
+                continue
+            view = tuple([slice(o, o + n) for o, n in zip(offset, chunk.shape)])
+            values = packed[view + (channel,)]
+            values[...] = (values & keep) | np.left_shift(chunk.astype(np.uint16), bit)
+            texture.set_data(np.ascontiguousarray(packed[view]), offset=offset)
+            digests[offset] = digest
+
+        self.volumes[label]['cells'] = cells
+        self._update_occupancy()
+        gpu_memory.enforce()
+
+        self.events.upload(label=label)
+
+    def _cells_occupied(self, label):
+        """
+        Return which cells of the occupancy grid contain non-zero values for a
+        layer, not taking into account whether the layer is enabled.
+        """
+        cells = self.volumes[label].get('cells')
+        grid = self._occupancy_grid
+        if isinstance(cells, tuple):
+            if cells[0].shape != grid:
+                return np.ones(grid, dtype=bool)
+            # The values are normalized using the color limits, so we check
+            # whether either end of the range in each cell ends up above zero.
+            # Cells that only contain NaN values are empty.
+            scale, offset = clim_to_rescale(self.volumes[label].get('clim'))
+            with np.errstate(invalid='ignore'):
+                occupied = np.fmax(cells[0] * scale + offset, cells[1] * scale + offset) > 0
+        elif cells is None or cells.shape != grid:
+            # We don't know anything about the layer yet
+            return np.ones(grid, dtype=bool)
+        else:
+            occupied = cells
+        # The loaded bricks can contain values that are not in the texture at
+        # the resolution of the viewer.
+        if self.volumes[label].get('bricked'):
+            occupied = occupied | self._bricks_occupied(label)
+        return occupied
+
+    def _bricks_occupied(self, label):
+        """
+        Return which cells of the occupancy grid overlap with loaded bricks
+        that contain non-zero values for a layer.
+        """
+        occupied = np.zeros(self._occupancy_grid, dtype=bool)
+        scale, offset = clim_to_rescale(self.volumes[label].get('clim'))
+        for key in self._brick_cache.keys():
+            vrange = self._brick_cache.value(key)
+            if key[0] != label or vrange is None:
+                continue
+            if max(vrange[0] * scale + offset, vrange[1] * scale + offset) <= 0:
+                continue
+            view = []
+            for brick, (vmin, vmax, _), ncells in zip(key[1], self._data_bounds,
+                                                      self._occupancy_grid):
+                start = (brick * BRICK_SIZE - 0.5 - vmin) / (vmax - vmin) * ncells
+                stop = ((brick + 1) * BRICK_SIZE - 0.5 - vmin) / (vmax - vmin) * ncells
+                view.append(slice(max(int(np.floor(start)), 0), max(int(np.floor(stop)) + 1, 0)))
+            occupied[tuple(view)] = True
+        return occupied
+
+    def _occupied_cells(self):
+
+        occupancy = np.zeros(self._occupancy_grid, dtype=bool)
+
+        for label in self.volumes:
+            if not self.volumes[label]['enabled']:
+                continue
+            occupied = self._cells_occupied(label)
+            label_other = self.volumes[label].get('multiply')
+            if label_other is not None and label_other in self.volumes:
+                occupied = occupied & self._cells_occupied(label_other)
+            occupancy |= occupied
+
+        return occupancy
+
+    def _update_occupancy(self):
+        if self._occupancy_grid is None:
+            return
+        occupancy = self._occupied_cells()
+        self._occupancy.set_data(occupancy.astype(np.uint8)[..., np.newaxis] * 255)
+        self.shared_program['u_occupancy_shape'] = occupancy.shape[::-1]
+        # Checking the occupancy has a small cost, so we don't do it if most of
+        # the volume is occupied.
+        self.shared_program['u_skip_empty'] = int(occupancy.mean() < OCCUPANCY_MAX_FRACTION)
+
+    def _release_mask_bit(self, label, slot, bit):
+        mask = self._masks[slot]
+        del mask['bits'][label]
+        if len(mask['bits']) == 0:
+            del self._masks[slot]
+            self._release_texture(slot)
+        elif mask['packed'] is not None and bit // MASK_BITS < mask['packed'].shape[3]:
+            # Clear the bit so that it is empty if it gets used again
+            channel, bit = divmod(bit, MASK_BITS)
+            packed = mask['packed']
+            keep = np.uint16(~(1 << bit) & 0xffff)
+            chunk_shape = [min(x, MASK_CHUNK_SIZE) for x in packed.shape[:3]]
+            for view in iterate_chunks(packed.shape[:3], chunk_shape=chunk_shape):
+                if np.any(packed[view + (channel,)] & ~keep):
+                    packed[view + (channel,)] &= keep
+                    offset = tuple([s.start for s in view])
+                    self.textures[slot].set_data(np.ascontiguousarray(packed[view]),
+                                                 offset=offset)
+
+    # The following methods are used to pack layers into shared textures
+
+    def _pack(self, label, n_channels):
+        """
+        Choose the texture into which to pack a layer that is loaded at full
+        resolution and uses ``n_channels`` channels, moving it from the one it
+        is currently packed into if needed. Returns `False` if there is no
+        texture slot available for a new packed texture.
+        """
+
+        volume = self.volumes[label]
+        key = (tuple(volume['texture_shape'][:3]),
+               volume.get('precision', 'float32'))
+
+        # The layer can stay where it is if nothing has changed
+        if 'pack' in volume:
+            pack = self._packs[volume['pack']]
+            if pack['key'] == key and pack['channels'][label][1] == n_channels:
+                return True
+            self._unpack(label)
+
+        # Otherwise we use the first free channels in a texture with the same
+        # shape and precision, or start a new texture.
+        for slot, pack in sorted(self._packs.items()):
+            if pack['key'] != key:
+                continue
+            used = set()
+            for first, n in pack['channels'].values():
+                used.update(range(first, first + n))
+            for channel in range(PACK_CHANNELS - n_channels + 1):
+                if used.isdisjoint(range(channel, channel + n_channels)):
+                    break
+            else:
+                continue
+            break
+        else:
+            if self._n_volume_max is not None:
+                return False
+            slot, channel = self._free_slot_index, 0
+            self._add_slot(slot)
+            pack = self._packs[slot] = {'key': key, 'channels': {}, 'packed': None}
+
+        pack['channels'][label] = channel, n_channels
+        volume['pack'] = slot
+        volume['channel'] = channel
+
+        return True
+
+    def _unpack(self, label, trim=False):
+        """
+        Remove a layer from the texture it is packed into, if any. The
+        texture is released once no layers are packed into it, and if
+        ``trim`` is `True`, the channels that are no longer used at the end of
+        the texture are released straight away.
+        """
+
+        volume = self.volumes[label]
+        if 'pack' not in volume:
+            return
+
+        slot = volume.pop('pack')
+        volume.pop('channel')
+        pack = self._packs[slot]
+        del pack['channels'][label]
+
+        if len(pack['channels']) == 0:
+            del self._packs[slot]
+            self._release_texture(slot)
+        elif trim and self._resize_pack(slot):
+            self._upload_pack(slot)
+
+    def _resize_pack(self, slot):
+        """
+        Make sure that a packed texture has as many channels as needed for the
+        layers packed into it, keeping the values for these layers. Returns
+        whether the texture was resized, in which case all of it needs to be
+        uploaded again.
+        """
+
+        # Three-channel textures are often slower to sample, and padded to four
+        # channels by the drivers anyway, so we use four channels instead.
+        pack = self._packs[slot]
+        shape, precision = pack['key']
+        n_channels = max(first + n for first, n in pack['channels'].values())
+        if n_channels == 3:
+            n_channels = 4
+
+        previous = pack['packed']
+        if previous is not None and previous.shape[3] == n_channels:
+            return False
+
+        packed = np.zeros(shape + (n_channels,), dtype=TEXTURE_PRECISIONS[precision][1])
+        if previous is not None:
+            n = min(n_channels, previous.shape[3])
+            packed[..., :n] = previous[..., :n]
+        pack['packed'] = packed
+
+        format, internalformat = channels_format(n_channels, precision)
+        texture = self.textures[slot]
+        if texture is None:
+            texture = self._tex_cls(packed.shape, interpolation='linear',
+                                    wrapping='clamp_to_edge', format=format,
+                                    internalformat=internalformat)
+            self.textures[slot] = texture
+            self.shared_program['u_volumetex_{0:d}'.format(slot)] = texture
+        else:
+            texture.resize(packed.shape, format=format, internalformat=internalformat)
+
+        return True
+
+    def _upload_packed(self, label, chunks):
+
+        slot = self.volumes[label]['pack']
+        pack = self._packs[slot]
+        first, n_channels = pack['channels'][label]
+
+        resized = self._resize_pack(slot)
+
+        # OpenGL can't update some of the channels of a texture, so we update
+        # the copy of the packed values and upload the values for all the
+        # layers in each chunk, or all of the texture if it has been resized.
+        views = []
+        for offset, chunk in chunks:
+            view = tuple([slice(o, o + n) for o, n in zip(offset, chunk.shape[:3])])
+            values = pack['packed'][view + (slice(first, first + n_channels),)]
+            values[...] = chunk.reshape(values.shape)
+            views.append(view)
+
+        self._upload_pack(slot, None if resized else views)
+
+    def _upload_pack(self, slot, views=None):
+        # Upload the packed values in the given views, or by default in chunks
+        # covering the whole texture.
+        packed = self._packs[slot]['packed']
+        if views is None:
+            chunk_shape = [min(x, 128) for x in packed.shape[:3]]
+            views = iterate_chunks(packed.shape[:3], chunk_shape=chunk_shape)
+        for view in views:
             offset = tuple([s.start for s in view])
+            self.textures[slot].set_data(np.ascontiguousarray(packed[view]), offset=offset)
+
+    # The following methods are used to show layers using bricks
+
+    def _update_bricked(self):
+        """
+        Update which layers are shown using bricks, and the page table and
+        step size to use for these.
+        """
+
+        for label, volume in self.volumes.items():
+            volume['bricked'] = (self._brick_grid is not None and
+                                 'bit' not in volume and 'data' in volume)
 
-            if chunk.size == 0:
+        self._update_brick_table()
+        self._update_shader()
+
+    def _update_step_size(self):
+
+        # While bricks are loaded for layers that are shown, the steps along
+        # the rays should be about the size of the voxels in the reference
+        # data. Otherwise, the textures are at the resolution of the viewer
+        # and smaller steps would only make drawing slower.
+        sampled = any(self.volumes[label].get('bricked') and self.volumes[label]['enabled']
+                      for label in set(key[0] for key in self._brick_cache.keys())
+                      if label in self.volumes)
+
+        if sampled:
+            self._step_size = min([1.] + [n / (vmax - vmin) for vmin, vmax, n in self._data_bounds])
+        else:
+            self._step_size = 1.
+        if self.shared_program['u_downsample'] <= 1:
+            self.shared_program['u_downsample'] = self._step_size
+
+    def _update_brick_table(self):
+        """
+        Update the page table, which contains a block of rows for each layer
+        shown using bricks, with the position of each brick in the atlas if it
+        is loaded.
+        """
+
+        self._update_step_size()
+
+        labels = sorted([label for label in self.volumes if self.volumes[label].get('bricked')],
+                        key=lambda label: self.volumes[label]['slot'])
+
+        if not labels:
+            return
+
+        for row, label in enumerate(labels):
+            self.shared_program['u_brick_row_{0:d}'.format(self.volumes[label]['index'])] = row
+
+        first, shape = self._brick_grid
+        table = page_table(self._brick_cache, labels, first, shape)
+
+        if self._brick_table is None:
+            self._brick_table = self._tex_cls(table, interpolation='nearest',
+                                              wrapping='clamp_to_edge', format='rgba',
+                                              internalformat='rgba8')
+            self.shared_program['u_brick_table'] = self._brick_table
+        else:
+            self._brick_table.set_data(table)
+
+        self.shared_program['u_brick_table_shape'] = shape[::-1]
+        self.shared_program['u_brick_table_size'] = table.shape[:3][::-1]
+
+    def _discard_bricks(self, label):
+        if self._pipeline is not None:
+            self._pipeline.cancel(('bricks', label))
+        self._brick_cache.discard([key for key in self._brick_cache.keys() if key[0] == label])
+        self._brick_visible.pop(label, None)
+
+    def _request_bricks(self, labels=None):
+        """
+        Find the visible bricks for the given layers (by default all layers)
+        and load the ones that are not in the cache yet.
+        """
+
+        if self._brick_matrix is None or self._brick_grid is None or self._interacting:
+            return
+
+        first, shape = self._brick_grid
+        capacity = self._brick_cache.capacity
+
+        for label in (self.volumes if labels is None else labels):
+
+            if label not in self.volumes or not self.volumes[label].get('bricked'):
+                continue
+
+            if not self.volumes[label]['enabled']:
+                continue
+
+            loaded = set(key[1] for key in self._brick_cache.keys() if key[0] == label)
+            args = (uncached(self.volumes[label]['data']), first, shape, self._brick_matrix,
+                    loaded, capacity)
+
+            # When loading bricks in the background, we load them in batches
+            # so that the first ones are shown as soon as possible.
+            if self._pipeline is None:
+                self._upload_bricks(label, *prepare_bricks(None, *args, capacity))
+            else:
+                self._pipeline.submit(('bricks', label), prepare_bricks, *args,
+                                      BRICK_BATCH_SIZE)
+                self._start_polling()
+
+    def _upload_bricks(self, label, visible, bricks):
+
+        if label not in self.volumes or not self.volumes[label].get('bricked'):
+            return
+
+        cache = self._brick_cache
+
+        # The visible bricks are marked as used, with the ones closest to the
+        # center of the view used most recently, and shouldn't be evicted to
+        # make space for the new bricks.
+        keys = [(label, brick) for brick in visible]
+        self._brick_visible[label] = set(keys)
+        cache.touch(keys[::-1])
+        keep = set().union(*self._brick_visible.values())
+
+        if self._brick_atlas is None:
+            shape = tuple(np.multiply(cache.shape, BRICK_SIZE + 2)) + (2,)
+            self._brick_atlas = self._tex_cls(shape, interpolation='linear',
+                                              wrapping='clamp_to_edge', format='rg',
+                                              internalformat='rg32f')
+            self.shared_program['u_brick_atlas'] = self._brick_atlas
+            self.shared_program['u_brick_atlas_shape'] = shape[:3][::-1]
+            gpu_memory.enforce()
+
+        complete = True
+        for brick, values, vrange in bricks:
+            try:
+                cache.insert((label, brick), vrange, keep=keep)
+            except KeyError:
+                complete = False
+                break
+            offset = tuple(int(i) * (BRICK_SIZE + 2) for i in cache.slot((label, brick)))
+            self._brick_atlas.set_data(values, offset=offset)
+
+        self._update_brick_table()
+        self._update_occupancy()
+
+        # Carry on until all the visible bricks are loaded, or there is no
+        # space left in the cache.
+        if complete and bricks and any(key not in cache for key in keys):
+            self._request_bricks([label])
+
+    def _data_to_clip(self, view):
+        """
+        Return the 4x4 matrix that maps pixel coordinates in the reference
+        data to clip coordinates.
+        """
+
+        # The transforms from the visual to clip coordinates are linear in
+        # homogeneous coordinates, so we can find the matrix by mapping the
+        # origin and the unit vectors.
+        transform = view.transforms.get_transform('visual', 'render')
+        points = transform.map(np.array([[0, 0, 0, 1],
+                                         [1, 0, 0, 1],
+                                         [0, 1, 0, 1],
+                                         [0, 0, 1, 1]], dtype=float))
+        matrix = np.zeros((4, 4))
+        matrix[:, 3] = points[0]
+        matrix[:, :3] = (points[1:] - points[0]).T
+
+        # The visual coordinates are the positions in the textures at the
+        # resolution of the viewer (see _update_slice_transform)
+        to_visual = np.identity(4)
+        for axis, (vmin, vmax, n) in enumerate(self._data_bounds[::-1]):
+            step = (vmax - vmin) / n
+            to_visual[axis, axis] = 1 / step
+            to_visual[axis, 3] = -vmin / step
+
+        return matrix @ to_visual
+
+    def _release_texture(self, index):
+        texture = self.textures[index]
+        if texture is not None:
+            self.shared_program['u_volumetex_{0:d}'.format(index)] = self._empty_texture
+            self.textures[index] = None
+            texture.delete()
+
+    # The following methods are used to keep track of the GPU memory used by
+    # the visual (see glue_vispy_viewers.common.gpu_memory)
+
+    def bytes_per_voxel(self):
+        """
+        Return the number of bytes of GPU memory that the textures of all the
+        layers use for each voxel at most, assuming that all the layers other
+        than masks have NaN values. This only depends on the layers and their
+        precisions, and not on the textures that are currently allocated.
+        """
+        nbytes = sum(2 * TEXTURE_PRECISIONS[volume.get('precision', 'float32')][2]
+                     for volume in self.volumes.values() if 'bit' not in volume)
+        # Masks are stored as bits in 16-bit channels shared by each group
+        nbytes += sum(2 * (max(mask['bits'].values()) // MASK_BITS + 1)
+                      for mask in self._masks.values() if mask['bits'])
+        return nbytes
+
+    def memory_usage(self):
+        """
+        Return the number of bytes of GPU memory used by each layer, including
+        the bricks loaded for it, with the key `None` for the memory shared by
+        all layers (the colormaps, the occupancy grid, the brick page table,
+        and the parts of the brick atlas and of packed textures that aren't in
+        use).
+        """
+
+        brick_nbytes = (BRICK_SIZE + 2) ** 3 * 2 * 4
+        if self._brick_atlas is None:
+            bricks = Counter()
+        else:
+            bricks = Counter(key[0] for key in self._brick_cache.keys())
+
+        usage = {}
+        for label in self.volumes:
+            usage[label] = self.texture_memory(label)[0] + bricks[label] * brick_nbytes
+
+        usage[None] = sum(texture_nbytes(texture)
+                          for texture in (self._empty_texture, self._colormaps, self._occupancy,
+                                          self._brick_table, self._brick_atlas)
+                          if texture is not None) - sum(bricks.values()) * brick_nbytes
+
+        # The channels of packed textures that are not used by any layer
+        for slot, pack in self._packs.items():
+            texture = self.textures[slot]
+            if texture is not None:
+                used = sum(n for _, n in pack['channels'].values())
+                n_channels = texture.shape[-1]
+                usage[None] += texture_nbytes(texture) // n_channels * (n_channels - used)
+
+        return usage
+
+    def evictable(self):
+        """
+        Return a list of ``(viewed, label)`` tuples for the layers whose
+        texture can be evicted, where ``viewed`` indicates when the layer was
+        last shown. Masks can only be evicted if none of the masks sharing the
+        same texture are in use.
+        """
+        evictable = []
+        for label, volume in self.volumes.items():
+            if volume.get('evicted') or self.texture_memory(label)[0] == 0:
                 continue
+            if 'bit' in volume:
+                labels = self._masks[volume['slot']]['bits']
+            else:
+                labels = [label]
+            if not any(self._in_use(other) for other in labels):
+                evictable.append((volume.get('viewed', 0), label))
+        return evictable
+
+    def evict(self, label):
+        """
+        Release the texture used by a layer that is not in use, as well as the
+        bricks loaded for it. The texture is prepared again once the layer is
+        in use. For masks, this releases the texture shared by all the masks
+        in the same group. For layers packed into a texture shared with other
+        layers, the channels used by the layer are released if possible.
+        """
+
+        volume = self.volumes[label]
+
+        if 'bit' in volume:
+            mask = self._masks[volume['slot']]
+            mask['packed'] = None
+            labels = list(mask['bits'])
+        else:
+            labels = [label]
+
+        for other in labels:
+            if self._pipeline is not None:
+                self._pipeline.cancel(other)
+            self._discard_upload(other)
+            self.volumes[other]['evicted'] = True
+            for key in ('texture_shape', 'levels', 'digests'):
+                self.volumes[other].pop(key, None)
+            self._discard_bricks(other)
+            if 'bit' not in self.volumes[other]:
+                self._unpack(other, trim=True)
+
+        self._release_texture(volume['slot'])
+        self._update_brick_table()
+
+    def _in_use(self, label):
+        """
+        Whether a layer is shown, or used to multiply a layer that is shown.
+        """
+        if self.volumes[label]['enabled']:
+            return True
+        return any(volume['enabled'] and volume.get('multiply') == label
+                   for volume in self.volumes.values())
+
+    def _restore_evicted(self):
+        # Prepare the textures again for the evicted layers that are now in use
+        for label in list(self.volumes):
+            if self.volumes[label].get('evicted') and self._in_use(label):
+                self.volumes[label].pop('evicted')
+                self._update_texture(label)
+
+    # The following methods are used to manage the background pipeline
+
+    @property
+    def pending(self):
+        """
+        Whether any texture is still being prepared or uploaded in the
+        background.
+        """
+        return self._pipeline is not None and (self._pipeline.pending or len(self._uploads) > 0)
+
+    def call_in_main_thread(self, func, *args):
+        """
+        Call ``func`` in the main thread. If this is called from a worker
+        thread, the call is deferred until the results are next collected.
+        """
+        if self._pipeline is None:
+            func(*args)
+        else:
+            self._pipeline.call_in_main_thread(func, *args)
 
-            self.shared_program['u_volumetex_{0:d}'.format(index)].set_data(chunk, offset=offset)
+    def _start_polling(self):
+        if self._poll_timer is None:
+            # The timer only keeps a weak reference to the visual, and is
+            # stopped if the visual is garbage collected while it is running.
+            self._poll_timer = app.Timer(interval=0.02, connect=(self, '_poll_pipeline'))
+            weakref.finalize(self, self._poll_timer.stop)
+        if not self._poll_timer.running:
+            self._poll_timer.start()
+            self.events.pending(pending=True)
+
+    def _poll_pipeline(self, event=None):
+
+        if self._pipeline is None:
+            return
+
+        try:
+            results = self._pipeline.poll()
+            updated = len(results) > 0
+            for label, result in results:
+                if isinstance(label, tuple) and label[0] == 'bricks':
+                    self._upload_bricks(label[1], *result)
+                elif isinstance(label, tuple) and label[0] == 'pyramid':
+                    if label[1] in self.volumes:
+                        self.volumes[label[1]]['pyramid'] = result
+                elif label in self.volumes:
+                    if self._upload(label, result):
+                        self._refine(label)
+            for label in list(self._uploads):
+                if self._continue_upload(label):
+                    self._refine(label)
+                    updated = True
+        finally:
+            if not self.pending and self._poll_timer is not None:
+                if self._poll_timer.running:
+                    self._poll_timer.stop()
+                    self.events.pending(pending=False)
+
+        if updated:
+            self.update()
 
     def label_for_layer(self, layer):
         for label in self.volumes:
@@ -321,45 +2120,118 @@ class MultiVolumeVisual(VolumeVisual):
 
     @property
     def has_free_slots(self):
+        return self.can_allocate()
+
+    def can_allocate(self, group=None):
+        """
+        Whether a layer can be allocated in ``group`` (see `allocate`) and
+        then shown along with the layers already shown.
+        """
         try:
-            self._free_slot_index
+            self._free_index
+            if group is None:
+                slot = self._free_slot_index
+            else:
+                slot, _ = self._free_mask_bit(group)
         except NoFreeSlotsError:
             return False
-        else:
-            return True
+        slots = sampled_slots(self.volumes)
+        return slot in slots or len(slots) < MAX_SAMPLED_TEXTURES
+
+    def can_enable(self, label):
+        """
+        Whether the layer can be shown along with the layers already shown,
+        given that at most ``MAX_SAMPLED_TEXTURES`` textures can be sampled
+        at once.
+        """
+        shown = shown_layers(self.volumes)
+        volumes = dict(self.volumes)
+        volumes[label] = dict(volumes[label], enabled=True)
+        return shown_layers(volumes) == sorted(set(shown) | {label})
+
+    @property
+    def _free_index(self):
+        # There are no more indices than layers, and the colormap texture is
+        # extended as needed (see _add_index).
+        indices = set(self.volumes[label]['index'] for label in self.volumes)
+        return min(set(range(len(indices) + 1)) - indices)
 
     @property
     def _free_slot_index(self):
-        indices = [self.volumes[label]['index'] for label in self.volumes]
-        for index in range(self._n_volume_max):
-            if index not in indices:
-                return index
+        slots = set(self.volumes[label]['slot'] for label in self.volumes) | set(self._packs)
+        if self._n_volume_max is None:
+            return min(set(range(len(slots) + 1)) - slots)
+        for slot in range(self._n_volume_max):
+            if slot not in slots:
+                return slot
         raise NoFreeSlotsError("No free slots")
 
+    def _free_mask_bit(self, group):
+        for slot, mask in sorted(self._masks.items()):
+            if mask['group'] == group and len(mask['bits']) < MASK_BITS * MASK_CHANNELS:
+                bits = set(mask['bits'].values())
+                return slot, min(set(range(MASK_BITS * MASK_CHANNELS)) - bits)
+        return self._free_slot_index, 0
+
     def _update_slice_transform(self, x_min, x_max, y_min, y_max, z_min, z_max):
 
         # TODO: simplify this to get bounds, for FRB
 
-        x_step = (x_max - x_min) / self.resolution
-        y_step = (y_max - y_min) / self.resolution
-        z_step = (z_max - z_min) / self.resolution
+        nx, ny, nz = axis_resolutions((x_max - x_min, y_max - y_min, z_max - z_min),
+                                      self.resolution, voxel_budget=self.voxel_budget)
+
+        data_bounds = [(z_min, z_max, nz), (y_min, y_max, ny), (x_min, x_max, nx)]
 
-        data_bounds = [(z_min, z_max, self.resolution),
-                       (y_min, y_max, self.resolution),
-                       (x_min, x_max, self.resolution)]
+        # When panning, we move the bounds by a whole number of steps so that
+        # the values that are still in view can be reused (see SlabBuffer).
+        # This moves the volume by less than half a step.
+        if self._data_bounds is not None:
+            data_bounds = snap_bounds(self._data_bounds, data_bounds)
+            (z_min, z_max, _), (y_min, y_max, _), (x_min, x_max, _) = data_bounds
+
+        x_step = (x_max - x_min) / nx
+        y_step = (y_max - y_min) / ny
+        z_step = (z_max - z_min) / nz
 
         # We should stop at this point if the bounds are the same as before
         if data_bounds == self._data_bounds:
             return
         else:
             self._data_bounds = data_bounds
+            self._occupancy_grid = occupancy_grid(data_bounds)
+
+        # The box covering the volume has one unit per voxel along each axis
+        self._vol_shape = (nz, ny, nx)
+        self.shared_program['u_shape'] = nx, ny, nz
+
+        # When compositing, the opacity of the colormaps is for a step of one
+        # voxel of the data, whereas the steps are in voxels of the textures.
+        self.shared_program['u_voxel_scale'] = max(x_step, y_step, z_step)
 
         self.transform.inner.scale = [x_step, y_step, z_step]
         self.transform.inner.translate = [x_min, y_min, z_min]
 
+        # Bricks are only used if the resolution of the viewer is lower than
+        # that of the reference data. The bricks that are already loaded can
+        # still be used if the bounds change.
+        if self._bricked and any(vmax - vmin > n for vmin, vmax, n in data_bounds):
+            self._brick_grid = brick_grid(data_bounds)
+        else:
+            self._brick_grid = None
+
+        if self._brick_grid is not None:
+            first, shape = self._brick_grid
+            self.shared_program['u_brick_first'] = first[::-1]
+            self.shared_program['u_brick_origin'] = x_min, y_min, z_min
+            self.shared_program['u_brick_extent'] = x_max - x_min, y_max - y_min, z_max - z_min
+
+        self._update_bricked()
+
         # We need to update the data in OpenGL if the slice has changed
         for label in self.volumes:
-            self._update_scaled_data(label)
+            self._update_texture(label)
+
+        self._request_bricks()
 
         # The following is needed to make sure that VisPy recognizes the changes
         # to the transforms.
@@ -379,19 +2251,30 @@ class MultiVolumeVisual(VolumeVisual):
         view.view_program.vert['viewtransformf'] = view_tr_f
         view.view_program.vert['viewtransformi'] = view_tr_i
 
+    def _prepare_draw(self, view):
+
+        # If the view has changed, different bricks might be visible
+        if not self._interacting and any(volume.get('bricked')
+                                         for volume in self.volumes.values()):
+            matrix = self._data_to_clip(view)
+            if self._brick_matrix is None or not np.allclose(matrix, self._brick_matrix):
+                self._brick_matrix = matrix
+                self._request_bricks()
+
+        return super(MultiVolumeVisual, self)._prepare_draw(view)
+
     @property
     def enabled(self):
-        return [self.shared_program['u_enabled_{0}'.format(i)] == 1
-                for i in range(self._n_volume_max)]
+        enabled = [False] * self._n_layer_max
+        for volume in self.volumes.values():
+            enabled[volume['index']] = volume['enabled']
+        return enabled
 
     def draw(self):
         if not any(self.enabled):
             return
         else:
-            try:
-                super(MultiVolumeVisual, self).draw()
-            except Exception:
-                pass
+            super(MultiVolumeVisual, self).draw()
 
 
 MultiVolume = create_visual_node(MultiVolumeVisual)